@@ -0,0 +1,46 @@
+"""Compares writing a large compiled module serially and with worker processes.
+
+    python benchmarks/bench_emit.py [num_functions] [num_workers] [language]
+"""
+
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from alang.compiler import Compiler
+from alang.nodes import CodeOptions, Module
+
+def build_module(num_functions: int) -> Module:
+    m = Module("lib")
+    for i in range(num_functions):
+        f = m.define(f"f{i}", ("x", "float"), ("y", "float"))
+        for j in range(8):
+            f.set(f"z{j}", f"x * y + {i * 8 + j}")
+        f.ret("z0 * z1 - z2 + z3 * z4 - z5 + z6 * z7")
+    return m
+
+def emit(c: Compiler, options: CodeOptions, language: str) -> tuple[str, float]:
+    c.options = options
+    out = io.StringIO()
+    t0 = time.perf_counter()
+    c.write_code(out, language)
+    return out.getvalue(), time.perf_counter() - t0
+
+def main():
+    num_functions = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    num_workers = int(sys.argv[2]) if len(sys.argv) > 2 else (os.cpu_count() or 1)
+    language = sys.argv[3] if len(sys.argv) > 3 else "c"
+    c = Compiler(build_module(num_functions), CodeOptions())
+    c.compile()
+    serial, serial_dt = emit(c, CodeOptions(), language)
+    parallel, parallel_dt = emit(c, CodeOptions(emit_workers=max(2, num_workers)), language)
+    assert parallel == serial
+    print(f"{num_functions} functions, {len(serial)} characters of {language}, {max(2, num_workers)} workers, {os.cpu_count()} cores")
+    print(f"  serial:   {serial_dt * 1e3:8.1f} ms")
+    print(f"  parallel: {parallel_dt * 1e3:8.1f} ms ({serial_dt / parallel_dt:.2f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""Compares the memory and time cost of the slotted node layout with the
+original dict-and-list layout, and of indexed reachability queries with
+walking the tree.
+
+    python benchmarks/bench_nodes.py [num_terms]
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+from typing import Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from alang.exprs import Binop, Constant, Name, bop_from_op
+from alang.stmts import Return
+from alang.funcs import Function
+from alang.nodes import Node, NodeType
+
+# The layout nodes had before they were slotted, reduced to what the benchmark needs
+
+class LegacyNode:
+    def __init__(self, type: str):
+        self.node_type = type
+        self.attributes = {}
+        self.links = []
+        self.last_backlink = None
+        self.resolved_type = None
+        self.resolved_node = None
+    def get_rels(self, rel: str):
+        return [child for (crel, child) in self.links if crel == rel]
+    def get_rel(self, rel: str):
+        cs = self.get_rels(rel)
+        return cs[0] if len(cs) > 0 else None
+    def link(self, child, rel: str):
+        self.links.append((rel, child))
+        child.last_backlink = self
+        return self
+
+class LegacyNodeAttr:
+    def __set_name__(self, owner, name: str):
+        self.name = name
+        self.private_name = f"_{name}"
+    def __get__(self, obj, objtype=None):
+        return getattr(obj, self.private_name, None)
+    def __set__(self, obj, value):
+        obj.attributes[self.name] = self
+        setattr(obj, self.private_name, value)
+
+class LegacyNodeLink:
+    def __set_name__(self, owner, name: str):
+        self.rel = name
+    def __get__(self, obj, objtype=None):
+        return obj.get_rel(self.rel)
+    def __set__(self, obj, value: Optional[LegacyNode]):
+        i = 0
+        while i < len(obj.links):
+            if obj.links[i][0] == self.rel:
+                ch = obj.links.pop(i)[1]
+                ch.last_backlink = None
+            else:
+                i += 1
+        if value is not None:
+            obj.link(value, self.rel)
+
+def legacy_parse_expr(expr):
+    if isinstance(expr, LegacyNode):
+        return expr
+    return LegacyConstant(expr)
+
+class LegacyName(LegacyNode):
+    name = LegacyNodeAttr()
+    def __init__(self, name: str):
+        super().__init__("name")
+        self.name = name
+
+class LegacyConstant(LegacyNode):
+    value = LegacyNodeAttr()
+    def __init__(self, value):
+        super().__init__("constant")
+        self.value = value
+
+class LegacyBinop(LegacyNode):
+    left = LegacyNodeLink()
+    right = LegacyNodeLink()
+    operator = LegacyNodeAttr()
+    def __init__(self, left, operator: str, right):
+        super().__init__("binop")
+        self.operator = bop_from_op[operator]
+        self.left = legacy_parse_expr(left)
+        self.right = legacy_parse_expr(right)
+
+class LegacyReturn(LegacyNode):
+    value = LegacyNodeLink()
+    def __init__(self, value):
+        super().__init__("return")
+        self.value = value
+
+class LegacyFunction(LegacyNode):
+    return_type = LegacyNodeLink()
+    def __init__(self, name: str):
+        super().__init__("function")
+        self.return_type = None
+
+def build_sum(binop, name, constant, num_terms: int):
+    # Same shape as the unrolled matmul inner products: a[(r * K) + k] * b[(k * N) + c] summed
+    acc = None
+    for k in range(num_terms):
+        a = binop(binop(name("out_r"), "*", constant(num_terms)), "+", constant(k))
+        b = binop(binop(constant(k), "*", constant(num_terms)), "+", name("out_c"))
+        term = binop(a, "*", b)
+        acc = term if acc is None else binop(acc, "+", term)
+    return acc
+
+def best_time(f, repeat: int = 5) -> float:
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        f()
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best
+
+def measure_build(binop, name, constant, num_terms: int):
+    dt = best_time(lambda: build_sum(binop, name, constant, num_terms))
+    tracemalloc.start()
+    root = build_sum(binop, name, constant, num_terms)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return root, size, dt
+
+def measure_fan_out(function, ret, constant, fan_out: int, num_updates: int):
+    f = function("f")
+    for i in range(fan_out):
+        f.link(ret(constant(i)), "statements")
+    def update():
+        for i in range(num_updates):
+            f.return_type = constant(i)
+            f.return_type
+    return best_time(update)
+
+def measure_queries(num_terms: int, num_queries: int):
+    f = Function("f", None)
+    f.link(Return(build_sum(Binop, Name, Constant, num_terms)), "statements")
+    walked = best_time(lambda: [Node.find_reachable_with_type(f, NodeType.RETURN) for _ in range(num_queries)], repeat=1)
+    indexed = best_time(lambda: [f.find_reachable_with_type(NodeType.RETURN) for _ in range(num_queries)], repeat=1)
+    return walked, indexed
+
+def main():
+    num_terms = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+    num_nodes = num_terms * 11 - 1
+    print(f"Building an unrolled sum of {num_terms} products ({num_nodes} nodes)")
+    _, legacy_size, legacy_dt = measure_build(LegacyBinop, LegacyName, LegacyConstant, num_terms)
+    _, slotted_size, slotted_dt = measure_build(Binop, Name, Constant, num_terms)
+    print(f"  legacy:  {legacy_size / num_nodes:8.1f} bytes/node  {legacy_dt * 1e3:8.1f} ms")
+    print(f"  slotted: {slotted_size / num_nodes:8.1f} bytes/node  {slotted_dt * 1e3:8.1f} ms")
+    print(f"  memory ratio: {legacy_size / slotted_size:.2f}x")
+    fan_out = 5000
+    num_updates = 2000
+    print(f"Reassigning a NodeLink {num_updates} times on a node with {fan_out} other children")
+    legacy_dt = measure_fan_out(LegacyFunction, LegacyReturn, LegacyConstant, fan_out, num_updates)
+    slotted_dt = measure_fan_out(lambda name: Function(name, None), Return, Constant, fan_out, num_updates)
+    print(f"  legacy:  {legacy_dt * 1e3:8.1f} ms")
+    print(f"  slotted: {slotted_dt * 1e3:8.1f} ms")
+    num_queries = 100
+    print(f"Finding the returns of a function with {num_nodes} nodes {num_queries} times")
+    walked_dt, indexed_dt = measure_queries(num_terms, num_queries)
+    print(f"  walked:  {walked_dt * 1e3:8.1f} ms")
+    print(f"  indexed: {indexed_dt * 1e3:8.1f} ms")
+
+if __name__ == "__main__":
+    main()
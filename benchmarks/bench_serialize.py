@@ -0,0 +1,37 @@
+"""Compares loading a compiled module from bytes with building and compiling it.
+
+    python benchmarks/bench_serialize.py [num_functions]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from alang.compiler import Compiler
+from alang.nodes import CodeOptions, Module
+
+def build_and_compile(num_functions: int) -> Compiler:
+    m = Module("lib")
+    for i in range(num_functions):
+        m.define(f"f{i}", ("x", "float"), ("y", "float")).set("z", f"x * y + {i}").ret("z * z - x")
+    c = Compiler(m, CodeOptions())
+    c.compile()
+    return c
+
+def main():
+    num_functions = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    t0 = time.perf_counter()
+    c = build_and_compile(num_functions)
+    build_dt = time.perf_counter() - t0
+    data = c.to_bytes()
+    t0 = time.perf_counter()
+    Compiler.from_bytes(data, CodeOptions())
+    load_dt = time.perf_counter() - t0
+    print(f"{num_functions} functions, {len(data)} bytes")
+    print(f"  build and compile: {build_dt * 1e3:8.1f} ms")
+    print(f"  load:              {load_dt * 1e3:8.1f} ms")
+
+if __name__ == "__main__":
+    main()
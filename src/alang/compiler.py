@@ -1,6 +1,13 @@
-from typing import Optional
+import json
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Optional, TextIO, Union
 
-from alang.nodes import BreadthFirstVisitor, CodeOptions, DepthFirstVisitor, Node, NodeType
+import alang.nodes as nodes
+from alang.nodes import Block, BreadthFirstVisitor, CodeOptions, CompileSession, DepthFirstWalker, Node, NodeType, Scope, get_entered_session
 from alang.typs import void_type
 from alang.funcs import Function
 
@@ -37,7 +44,98 @@ class Diagnostics:
     def warning(self, message: str, node: Optional[Node] = None):
         self.message(DiagnosticKind.WARNING, message, node)
 
-class TypeResolutionPass(DepthFirstVisitor):
+class PassStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.num_runs = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.num_nodes_visited = 0
+        # num_changes and num_need_info of each iteration
+        self.iterations: list[tuple[int, int]] = []
+        # What the pass did, like the loops it unrolled, by name
+        self.counts: dict[str, int] = {}
+    @property
+    def num_iterations(self) -> int:
+        return len(self.iterations)
+    def add_iteration(self, num_changes: int, num_need_info: int):
+        self.iterations.append((num_changes, num_need_info))
+    def add_count(self, name: str, n: int = 1):
+        self.counts[name] = self.counts.get(name, 0) + n
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "num_runs": self.num_runs,
+            "wall_time": self.wall_time,
+            "cpu_time": self.cpu_time,
+            "num_nodes_visited": self.num_nodes_visited,
+            "num_iterations": self.num_iterations,
+            "iterations": [{"num_changes": c, "num_need_info": n} for c, n in self.iterations],
+            "counts": dict(self.counts),
+        }
+
+class CompileStats:
+    """Where a compile spent its time. Passes are timed by name and the steps
+    within a pass are named after it, like resolve.names."""
+    def __init__(self):
+        self.passes: dict[str, PassStats] = {}
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.incremental = False
+        self.num_support_definitions = 0
+        self.num_support_groups = 0
+        self.num_shared_support_groups = 0
+    def get_pass(self, name: str) -> PassStats:
+        ps = self.passes.get(name)
+        if ps is None:
+            ps = PassStats(name)
+            self.passes[name] = ps
+        return ps
+    @contextmanager
+    def time_pass(self, name: str):
+        ps = self.get_pass(name)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield ps
+        finally:
+            ps.num_runs += 1
+            ps.wall_time += time.perf_counter() - wall
+            ps.cpu_time += time.process_time() - cpu
+    def record_support_definitions(self, defs: "SupportDefinitions"):
+        self.num_support_definitions = sum(len(d) for d in defs.definitions.values())
+        self.num_support_groups = len(defs.definitions)
+        self.num_shared_support_groups = len(defs.shared_groups)
+    def to_dict(self) -> dict:
+        return {
+            "wall_time": self.wall_time,
+            "cpu_time": self.cpu_time,
+            "incremental": self.incremental,
+            "num_support_definitions": self.num_support_definitions,
+            "num_support_groups": self.num_support_groups,
+            "num_shared_support_groups": self.num_shared_support_groups,
+            "passes": [ps.to_dict() for ps in self.passes.values()],
+        }
+    def to_json(self, indent: Optional[int] = None) -> str:
+        return json.dumps(self.to_dict(), indent=indent)
+    def format(self) -> str:
+        lines = [f"{'pass':<28} {'runs':>5} {'wall ms':>10} {'cpu ms':>10} {'visited':>9} {'iters':>6} {'changes':>8} {'need info':>9}"]
+        for ps in self.passes.values():
+            num_changes = sum(c for c, n in ps.iterations)
+            num_need_info = ps.iterations[-1][1] if len(ps.iterations) > 0 else 0
+            lines.append(f"{ps.name:<28} {ps.num_runs:>5} {ps.wall_time * 1e3:>10.3f} {ps.cpu_time * 1e3:>10.3f} {ps.num_nodes_visited:>9} {ps.num_iterations:>6} {num_changes:>8} {num_need_info:>9}")
+            if len(ps.counts) > 0:
+                lines.append("    " + ", ".join(f"{name} {n}" for name, n in ps.counts.items()))
+        kind = "incremental" if self.incremental else "full"
+        lines.append(f"{kind} compile: {self.wall_time * 1e3:.3f} ms wall, {self.cpu_time * 1e3:.3f} ms cpu")
+        lines.append(f"support definitions: {self.num_support_definitions} in {self.num_support_groups} groups ({self.num_shared_support_groups} shared)")
+        return "\n".join(lines)
+    def print(self):
+        print(self.format())
+    def __str__(self) -> str:
+        return self.format()
+
+class TypeResolutionPass(DepthFirstWalker):
     def __init__(self, diags: Diagnostics):
         super().__init__()
         self.diags = diags
@@ -45,7 +143,7 @@ class TypeResolutionPass(DepthFirstVisitor):
         self.num_need_info = 0
         self.num_errors = 0
     def run(self, node: Node):
-        self.visit(node, None, None, None)
+        self.visit(node, None, None)
     def visit_node(self, node: Node, parent: Node, rel: str, acc):
         if node.resolved_type is not None:
             return
@@ -65,46 +163,41 @@ class NameResolutionPass(BreadthFirstVisitor):
         self.num_need_info = 0
         self.num_errors = 0
     def run(self, node: Node):
-        self.visit(node, None, None, dict())
-    def visit_name(self, node: Node, parent: Node, rel: str, env: dict): # type: ignore
+        self.visit(node, None, None, None)
+    def visit_name(self, node: Node, parent: Node, rel: str, scope: Optional[Scope]): # type: ignore
         if node.resolved_node is not None:
-            return env
-        elif node.name in env:
-            node.resolved_node = env[node.name]
+            return scope
+        target = scope.lookup(node.name) if scope is not None else None
+        if target is not None:
+            node.resolved_node = target
             self.num_changes += 1
-            return env
+            return scope
         else:
             self.diags.error(f"Name {node.name} not found", node)
             self.num_errors += 1
-            return env
-    def visit_module(self, node: Node, parent: Node, rel: str, env: dict):
-        new_env = dict(env)
-        for c in node.functions:
-            new_env[c.name] = c
-        for v in node.variables:
-            new_env[v.name] = v
-        return new_env
-    def visit_function(self, node: Function, parent: Node, rel: str, env: dict):
-        new_env = dict(env)
-        for p in node.parameters:
-            new_env[p.name] = p
-        for v in node.variables:
-            new_env[v.name] = v
-        return new_env
+            return scope
+    def visit_module(self, node: Node, parent: Node, rel: str, scope: Optional[Scope]):
+        return Scope(node, scope)
+    def visit_function(self, node: Function, parent: Node, rel: str, scope: Optional[Scope]):
+        return Scope(node, scope)
+    def visit_loop(self, node: Node, parent: Node, rel: str, scope: Optional[Scope]):
+        return Scope(node, scope)
 
-class InferFunctionReturnTypePass(DepthFirstVisitor):
+class InferFunctionReturnTypePass(DepthFirstWalker):
     def __init__(self, diags: Diagnostics):
         super().__init__()
         self.diags = diags
+        self.inferred: list[Function] = []
         self.num_changes = 0
         self.num_need_info = 0
         self.num_errors = 0
     def run(self, node: Node):
-        self.visit(node, None, None, None)
+        self.visit(node, None, None)
     def set_return_type(self, node: Function, return_type: str):
         node.return_type = return_type
+        self.inferred.append(node)
         self.num_changes += 1
-    def visit_function(self, node: Function, parent: Node, rel: str, cvals: list):
+    def visit_function(self, node: Function, parent: Node, rel: str, acc):
         if node.return_type is not None:
             return
         return_values: list[Node] = [x.value for x in node.find_reachable_with_type(NodeType.RETURN)]
@@ -128,7 +221,7 @@ class InferFunctionReturnTypePass(DepthFirstVisitor):
         return_type = list(distinct_types.values())[0]
         self.set_return_type(node, return_type)
 
-class InferVariableTypePass(DepthFirstVisitor):
+class InferVariableTypePass(DepthFirstWalker):
     def __init__(self, diags: Diagnostics):
         super().__init__()
         self.diags = diags
@@ -136,11 +229,11 @@ class InferVariableTypePass(DepthFirstVisitor):
         self.num_need_info = 0
         self.num_errors = 0
     def run(self, node: Node):
-        self.visit(node, None, None, None)
+        self.visit(node, None, None)
     def set_return_type(self, node: Function, return_type: str):
         node.return_type = return_type
         self.num_changes += 1
-    def visit_variable(self, node: Node, parent: Node, rel: str, cvals: list):
+    def visit_variable(self, node: Node, parent: Node, rel: str, acc):
         if node.resolved_type is not None:
             return
         if node.initial_value is None:
@@ -156,18 +249,34 @@ class InferVariableTypePass(DepthFirstVisitor):
 class SupportDefinitions:
     def __init__(self):
         self.definitions: dict[str, list[Node]] = dict()
+        self.groups_by_fingerprint: dict[tuple[bytes, ...], str] = dict()
+        self.shared_groups: set[str] = set()
         self.num_changes = 0
     def add(self, group: str, defs: list[Node]):
         if group in self.definitions:
             return
+        # Groups with identical definitions share the first group's nodes
+        fingerprint = tuple(d.fingerprint() for d in defs)
+        same_group = self.groups_by_fingerprint.get(fingerprint)
+        if same_group is not None:
+            self.definitions[group] = self.definitions[same_group]
+            self.shared_groups.add(group)
+            return
+        self.groups_by_fingerprint[fingerprint] = group
         self.definitions[group] = defs
         self.num_changes += 1
     def get(self, name: str):
         return self.definitions.get(name)
     def needs(self, name: str):
         return name not in self.definitions
+    def flatten(self) -> list[Node]:
+        flattened = []
+        for k, v in self.definitions.items():
+            if k not in self.shared_groups:
+                flattened.extend(v)
+        return flattened
 
-class CollectSupportDefinitions(DepthFirstVisitor):
+class CollectSupportDefinitions(DepthFirstWalker):
     def __init__(self):
         super().__init__()
         self.defs = SupportDefinitions()
@@ -176,15 +285,468 @@ class CollectSupportDefinitions(DepthFirstVisitor):
         return self.defs.num_changes
     @property
     def support_definitions(self):
-        flattened = []
-        for k, v in self.defs.definitions.items():
-            flattened.extend(v)
-        return flattened
+        return self.defs.flatten()
     def run(self, node: Node):
-        self.visit(node, None, None, None)
+        self.visit(node, None, None)
     def visit_node(self, node: Node, parent: Node, rel: str, acc):
         node.get_support_definitions(self.defs)
-        super().visit_node(node, parent, rel, acc)
+        return super().visit_node(node, parent, rel, acc)
+
+def iter_subtree(root: Node):
+    """The unfrozen nodes under root, each once, in pre-order"""
+    seen = set()
+    stack = [root]
+    while len(stack) > 0:
+        n = stack.pop()
+        if n.frozen or n.id in seen:
+            continue
+        seen.add(n.id)
+        yield n
+        links = n.links
+        for i in range(len(links) - 1, -1, -1):
+            stack.append(links[i][1])
+
+def iter_post_order(root: Node):
+    """The unfrozen nodes under root, each once, in the order DepthFirstWalker visits them"""
+    seen = set()
+    stack = [(root, False)]
+    while len(stack) > 0:
+        n, children_done = stack.pop()
+        if children_done:
+            yield n
+            continue
+        if n.frozen or n.id in seen:
+            continue
+        seen.add(n.id)
+        stack.append((n, True))
+        links = n.links
+        for i in range(len(links) - 1, -1, -1):
+            stack.append((links[i][1], False))
+
+class TypeInference:
+    """Resolves types with a worklist. A node is only visited again when
+    something it waits on gets its type: a child, the declaration a name
+    resolved to, or for functions, the values they return."""
+    def __init__(self, diags: Diagnostics):
+        self.diags = diags
+        self.return_pass = InferFunctionReturnTypePass(diags)
+        self.variable_pass = InferVariableTypePass(diags)
+        self.dependents: dict[int, list[Node]] = {}
+        self.num_visits = 0
+        self.num_resolved = 0
+    @property
+    def inferred(self) -> list[Function]:
+        return self.return_pass.inferred
+    def add_dependencies(self, nodes: list[Node]):
+        ids = set(n.id for n in nodes)
+        dependents = self.dependents
+        for n in nodes:
+            for rel, child in n.links:
+                if child.id in ids:
+                    dependents.setdefault(child.id, []).append(n)
+            if n.node_type == NodeType.NAME:
+                target = n.resolved_node
+                if target is not None and target.id in ids:
+                    dependents.setdefault(target.id, []).append(n)
+            elif n.node_type == NodeType.FUNCTION and n.return_type is None:
+                for r in n.find_reachable_with_type(NodeType.RETURN):
+                    v = r.value
+                    if v is not None and v.id in ids:
+                        dependents.setdefault(v.id, []).append(n)
+    def resolve_new_subtree(self, node: Node):
+        # Nodes linked in by inference, like a function's new return type
+        for n in reversed(list(iter_subtree(node))):
+            if n.resolved_type is None:
+                n.resolved_type = n.resolve_type(self.diags)
+    def run(self, nodes: list[Node]):
+        """Resolves as much of nodes as possible. They should be in post-order
+        so that most are resolved on their first visit."""
+        self.add_dependencies(nodes)
+        queue = deque(nodes)
+        queued = set(n.id for n in nodes)
+        while len(queue) > 0:
+            n = queue.popleft()
+            queued.discard(n.id)
+            self.num_visits += 1
+            if n.resolved_type is None:
+                t = n.resolve_type(self.diags)
+                if t is not None:
+                    n.resolved_type = t
+                    self.num_resolved += 1
+            if n.node_type == NodeType.FUNCTION:
+                if n.return_type is None:
+                    self.return_pass.visit_function(n, None, None, None)
+                    if n.return_type is not None:
+                        self.resolve_new_subtree(n.return_type)
+                        if n.resolved_type is None:
+                            n.resolved_type = n.resolve_type(self.diags)
+                        self.num_resolved += 1
+            elif n.node_type == NodeType.VARIABLE and n.resolved_type is None:
+                self.variable_pass.visit_variable(n, None, None, None)
+                if n.resolved_type is not None:
+                    self.num_resolved += 1
+            if n.resolved_type is not None:
+                for d in self.dependents.pop(n.id, ()):
+                    if d.id not in queued and (d.resolved_type is None or d.node_type == NodeType.FUNCTION):
+                        queue.append(d)
+                        queued.add(d.id)
+
+def type_changed(a: Optional[Node], b: Optional[Node]) -> bool:
+    if a is b:
+        return False
+    return a is None or b is None or not a.structurally_equals(b)
+
+class CompileState:
+    """What the last compile of a block resolved. It's kept on the block so the
+    next compile only redoes the nodes that changed and the nodes that depend on them."""
+    def __init__(self, root: Block):
+        self.root = root
+        self.lock = threading.Lock()
+        self.compiling = False
+        # Filled in by Node.record_change between compiles
+        self.changed: dict[int, Node] = {}
+        self.added: dict[int, Node] = {}
+        self.removed: list[Node] = []
+        # users[id] are the nodes that depend on node id: names resolved to it,
+        # nodes whose type it is, and parents that link to it but don't own it
+        self.users: dict[int, dict[int, Node]] = {}
+        self.uses: dict[int, list[int]] = {}
+        self.names_by_string: dict[str, dict[int, Node]] = {}
+        self.name_strings: dict[int, str] = {}
+        self.declared_names: dict[int, str] = {}
+        self.unresolved: dict[int, Node] = {}
+        self.provided: dict[int, tuple[Node, dict[str, list[Node]]]] = {}
+        self.inferred: set[int] = set()
+        self.child_positions: dict[int, dict[int, int]] = {}
+        self.num_processed = 0
+        root.track_changes()
+    def track(self, n: Node):
+        uses = []
+        name = getattr(n, "name", None)
+        if isinstance(name, str) and n.node_type != NodeType.NAME:
+            self.declared_names[n.id] = name
+        if n.node_type == NodeType.NAME:
+            self.name_strings[n.id] = n.name
+            self.names_by_string.setdefault(n.name, {})[n.id] = n
+            if n.resolved_node is not None:
+                uses.append(n.resolved_node)
+            else:
+                self.unresolved[n.id] = n
+        t = n.resolved_type
+        if t is None:
+            self.unresolved[n.id] = n
+        elif t is not n and not t.frozen:
+            uses.append(t)
+        for rel, child in n.links:
+            if child.last_backlink is not n and not child.frozen:
+                uses.append(child)
+        if len(uses) > 0:
+            for u in uses:
+                self.users.setdefault(u.id, {})[n.id] = n
+            self.uses[n.id] = [u.id for u in uses]
+        if type(n).get_support_definitions is not Node.get_support_definitions:
+            defs = SupportDefinitions()
+            n.get_support_definitions(defs)
+            if len(defs.definitions) > 0:
+                self.provided[n.id] = (n, defs.definitions)
+    def untrack(self, n: Node):
+        for uid in self.uses.pop(n.id, ()):
+            users = self.users.get(uid)
+            if users is not None:
+                users.pop(n.id, None)
+                if len(users) == 0:
+                    del self.users[uid]
+        s = self.name_strings.pop(n.id, None)
+        if s is not None:
+            names = self.names_by_string[s]
+            names.pop(n.id, None)
+            if len(names) == 0:
+                del self.names_by_string[s]
+        self.declared_names.pop(n.id, None)
+        self.unresolved.pop(n.id, None)
+        self.provided.pop(n.id, None)
+        self.child_positions.pop(n.id, None)
+    def track_all(self, inferred: list[Function]) -> bool:
+        """Tracks the whole tree. Returns False if some of its nodes are owned by
+        another tree since their edits would not be seen."""
+        subtree = list(iter_subtree(self.root))
+        ids = set(n.id for n in subtree)
+        for n in subtree:
+            if n is not self.root and (n.last_backlink is None or n.last_backlink.id not in ids):
+                return False
+        for n in subtree:
+            self.track(n)
+        self.inferred.update(f.id for f in inferred)
+        return True
+    def contains(self, n: Node) -> bool:
+        seen = set()
+        while n is not None and n.id not in seen:
+            if n is self.root:
+                return True
+            seen.add(n.id)
+            n = n.last_backlink
+        return False
+    def get_order_key(self, n: Node, post_order: bool) -> tuple[int, ...]:
+        path = []
+        while n is not self.root:
+            p = n.last_backlink
+            positions = self.child_positions.get(p.id)
+            if positions is None:
+                positions = {}
+                for i, (rel, child) in enumerate(p.links):
+                    positions.setdefault(child.id, i)
+                self.child_positions[p.id] = positions
+            path.append(positions[n.id])
+            n = p
+        path.reverse()
+        if post_order:
+            # Descendants sort before their ancestors
+            path.append(sys.maxsize)
+        return tuple(path)
+    def get_scope(self, n: Node, scopes: dict[int, Optional[Scope]]) -> Optional[Scope]:
+        blocks = []
+        p = n.last_backlink
+        while p is not None:
+            if p.node_type == NodeType.MODULE or p.node_type == NodeType.FUNCTION or p.node_type == NodeType.LOOP:
+                blocks.append(p)
+            if p is self.root:
+                break
+            p = p.last_backlink
+        if len(blocks) == 0:
+            return None
+        scope = scopes.get(blocks[0].id)
+        if scope is None:
+            for b in reversed(blocks):
+                scope = Scope(b, scope)
+            scopes[blocks[0].id] = scope
+        return scope
+    def add_captured_names(self, decl: Node, pending: list[Node]):
+        """Adds the names in the declaration's block that it could now resolve to"""
+        name = getattr(decl, "name", None)
+        block = decl.last_backlink
+        if decl.node_type == NodeType.NAME or not isinstance(name, str) or not isinstance(block, Block):
+            return
+        for n in self.names_by_string.get(name, {}).values():
+            p = n.last_backlink
+            while p is not None and p is not block and p is not self.root:
+                p = p.last_backlink
+            if p is block:
+                pending.append(n)
+    def collect_changes(self) -> Optional[list[Node]]:
+        for a in self.added.values():
+            if a.last_backlink is not None and not self.contains(a):
+                # Linked in from another tree
+                return None
+        pending: list[Node] = []
+        for r in self.removed:
+            if self.contains(r):
+                continue
+            for n in iter_subtree(r):
+                users = self.users.pop(n.id, None)
+                if users is not None:
+                    pending.extend(users.values())
+                self.untrack(n)
+                self.inferred.discard(n.id)
+        for n in self.changed.values():
+            self.child_positions.pop(n.id, None)
+            pending.append(n)
+            users = self.users.get(n.id)
+            if users is not None:
+                pending.extend(users.values())
+            if self.declared_names.get(n.id) != getattr(n, "name", None):
+                self.add_captured_names(n, pending)
+        for a in self.added.values():
+            for n in iter_subtree(a):
+                pending.append(n)
+                self.add_captured_names(n, pending)
+        self.removed = []
+        self.changed = {}
+        self.added = {}
+        return [n for n in pending if self.contains(n)]
+    def get_batch(self, pending: list[Node]) -> list[Node]:
+        batch: dict[int, Node] = {}
+        for n in pending:
+            while n is not None and n.id not in batch and not n.frozen:
+                batch[n.id] = n
+                if n is self.root:
+                    break
+                n = n.last_backlink
+        return sorted(batch.values(), key=lambda n: self.get_order_key(n, True))
+    def reset_return_type(self, f: Function):
+        rt = f.return_type
+        if rt is not None and rt.last_backlink is f:
+            for n in iter_subtree(rt):
+                self.untrack(n)
+        f.return_type = None
+        self.inferred.discard(f.id)
+    def resolve(self, batch: list[Node]) -> TypeInference:
+        scopes: dict[int, Optional[Scope]] = {}
+        for n in batch:
+            if n.node_type == NodeType.NAME and n.resolved_node is None:
+                scope = self.get_scope(n, scopes)
+                n.resolved_node = scope.lookup(n.name) if scope is not None else None
+        inference = TypeInference(Diagnostics())
+        inference.run(batch)
+        return inference
+    def resolve_batch(self, batch: list[Node], stats: Optional[PassStats] = None) -> list[Node]:
+        """Resolves the batch again and returns the users outside it whose
+        inputs changed"""
+        old = []
+        for n in batch:
+            old.append((n.resolved_type, n.resolved_node if n.node_type == NodeType.NAME else None))
+            self.untrack(n)
+            if n.node_type == NodeType.NAME:
+                n.resolved_node = None
+            if n.resolved_type is not n:
+                n.resolved_type = None
+            if n.node_type == NodeType.FUNCTION and n.id in self.inferred:
+                self.reset_return_type(n)
+        inference = self.resolve(batch)
+        for f in inference.inferred:
+            self.inferred.add(f.id)
+            for n in iter_subtree(f.return_type):
+                if n.last_backlink is f or n is not f.return_type:
+                    self.track(n)
+        self.num_processed += len(batch)
+        batch_ids = set(n.id for n in batch)
+        pending = []
+        num_changes = 0
+        for n, (old_type, old_node) in zip(batch, old):
+            self.track(n)
+            if type_changed(old_type, n.resolved_type) or (n.node_type == NodeType.NAME and old_node is not n.resolved_node):
+                num_changes += 1
+                users = self.users.get(n.id)
+                if users is not None:
+                    pending.extend(u for u in users.values() if u.id not in batch_ids)
+        if stats is not None:
+            stats.num_nodes_visited += inference.num_visits
+            stats.add_iteration(num_changes, sum(1 for n in batch if n.resolved_type is None))
+        return pending
+    def recompile(self, compiler: "Compiler", stats: Optional[PassStats] = None) -> bool:
+        self.compiling = True
+        try:
+            self.num_processed = 0
+            pending = self.collect_changes()
+            if pending is None:
+                return False
+            while len(pending) > 0:
+                pending = self.resolve_batch(self.get_batch(pending), stats)
+            if self.num_processed > 0:
+                self.root.resolve_generation += 1
+            self.write_results(compiler)
+            return True
+        finally:
+            self.compiling = False
+    def write_results(self, compiler: "Compiler"):
+        diags = compiler.diags
+        diags.reset()
+        # Same order as the last iteration of a full compile: names first in pre-order
+        # and then types in post-order
+        unresolved = list(self.unresolved.values())
+        names = [n for n in unresolved if n.node_type == NodeType.NAME and n.resolved_node is None]
+        names.sort(key=lambda n: self.get_order_key(n, False))
+        for n in names:
+            diags.error(f"Name {n.name} not found", n)
+        types = [n for n in unresolved if n.resolved_type is None]
+        types.sort(key=lambda n: self.get_order_key(n, True))
+        for n in types:
+            n.resolve_type(diags)
+        defs = SupportDefinitions()
+        for n, provided in sorted(self.provided.values(), key=lambda x: self.get_order_key(x[0], True)):
+            for group, group_defs in provided.items():
+                defs.add(group, group_defs)
+        compiler.support_definitions = defs.flatten()
+        compiler.stats.record_support_definitions(defs)
+        compiler.find_entry_points()
+
+class Pass:
+    """A step of compilation. Passes that change the tree set changes_tree and
+    run on a copy of it, which is resolved again after they make changes."""
+    name = ""
+    requires: tuple[str, ...] = () # passes that must run first
+    opt_level = 0 # the lowest optimization level the pass runs at
+    changes_tree = False
+    # Whether transform is also applied to the support definitions resolve makes
+    transforms_support_definitions = False
+    def run(self, compiler: "Compiler") -> bool:
+        """Returns whether the pass changed anything"""
+        raise NotImplementedError(f"run not implemented for pass {self.name}")
+    def transform(self, compiler: "Compiler", root: Node) -> bool:
+        """Transforms a subtree, returning whether it changed"""
+        raise NotImplementedError(f"transform not implemented for pass {self.name}")
+
+class ResolvePass(Pass):
+    """Resolves names and types and finds support definitions and entry points"""
+    name = "resolve"
+    def run(self, compiler: "Compiler") -> bool:
+        compiler.resolve()
+        return False
+
+class PassManager:
+    def __init__(self, passes: list[Pass] = []):
+        self.passes: list[Pass] = list(passes)
+    def copy(self) -> "PassManager":
+        return PassManager(self.passes)
+    def get(self, name: str) -> Optional[Pass]:
+        for p in self.passes:
+            if p.name == name:
+                return p
+        return None
+    def add(self, p: Pass, after: Optional[str] = None, before: Optional[str] = None) -> "PassManager":
+        """Adds the pass at the end, or right after or before the named pass"""
+        anchor = after if after is not None else before
+        if anchor is None:
+            self.passes.append(p)
+            return self
+        a = self.get(anchor)
+        if a is None:
+            raise ValueError(f"Pass {anchor} not found")
+        i = self.passes.index(a)
+        self.passes.insert(i + 1 if after is not None else i, p)
+        return self
+    def replace(self, p: Pass) -> "PassManager":
+        """Puts the pass in place of the one with its name, or adds it at the end"""
+        for i, q in enumerate(self.passes):
+            if q.name == p.name:
+                self.passes[i] = p
+                return self
+        self.passes.append(p)
+        return self
+    def remove(self, name: str):
+        self.passes = [p for p in self.passes if p.name != name]
+    def get_pipeline(self, opt_level: int) -> list[Pass]:
+        """The passes for the optimization level in the order they were added,
+        except that passes run after the ones they require"""
+        selected = {}
+        for p in self.passes:
+            if p.opt_level <= opt_level and p.name not in selected:
+                selected[p.name] = p
+        pipeline: list[Pass] = []
+        done: set[str] = set()
+        visiting: set[str] = set()
+        def visit(p: Pass):
+            if p.name in done:
+                return
+            if p.name in visiting:
+                raise ValueError(f"Pass {p.name} depends on itself")
+            visiting.add(p.name)
+            for r in p.requires:
+                d = selected.get(r)
+                if d is None:
+                    raise ValueError(f"Pass {p.name} requires {r} which is not in the O{opt_level} pipeline")
+                visit(d)
+            visiting.discard(p.name)
+            done.add(p.name)
+            pipeline.append(p)
+        for p in selected.values():
+            visit(p)
+        return pipeline
+
+default_passes = PassManager([ResolvePass()])
+
+def register_pass(p: Pass, after: Optional[str] = None, before: Optional[str] = None):
+    """Adds a pass to every compiler created after this"""
+    default_passes.add(p, after, before)
 
 class Compiler:
     def __init__(self, ast: Node, options: CodeOptions):
@@ -193,6 +755,11 @@ class Compiler:
         self.diags = Diagnostics()
         self.support_definitions = []
         self.entry_points = []
+        self.source = ast
+        self.stats = CompileStats()
+        self.pass_manager = default_passes.copy()
+        for p in options.passes:
+            self.pass_manager.replace(p)
 
     def resolve_names(self):
         res_pass = NameResolutionPass(self.diags)
@@ -247,22 +814,128 @@ class Compiler:
             self.entry_points.append((f, "compute", new_f))
     
     def compile(self):
+        pipeline = self.pass_manager.get_pipeline(self.options.opt_level)
+        self.stats = stats = CompileStats()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        self.ast = self.source
+        for p in pipeline:
+            if p.changes_tree and self.ast is self.source:
+                # Transforms get a copy so the caller's tree is left alone
+                self.ast = self.source.clone(keep_resolution=True)
+            with stats.time_pass(p.name):
+                changed = p.run(self)
+            if changed and p.changes_tree:
+                with stats.time_pass("resolve"):
+                    self.resolve()
+        # Support definitions are made again by each resolve so they're transformed last,
+        # as copies since compile states keep them
+        support_passes = [p for p in pipeline if p.transforms_support_definitions]
+        if len(support_passes) > 0:
+            defs = [d.clone(keep_resolution=True) for d in self.support_definitions]
+            for p in support_passes:
+                with stats.time_pass(p.name):
+                    for d in defs:
+                        p.transform(self, d)
+            self.support_definitions = defs
+        stats.wall_time = time.perf_counter() - wall
+        stats.cpu_time = time.process_time() - cpu
+
+    def resolve(self):
+        stats = self.stats
+        state = self.ast.compile_state
+        if state is not None:
+            with state.lock, stats.time_pass("resolve.incremental") as ps:
+                done = state.recompile(self, ps)
+                if not done:
+                    self.ast.compile_state = None
+            if done:
+                stats.incremental = True
+                return
+        stats.incremental = False
         self.support_definitions.clear()
-        should_iter = True
-        max_iterations = 100
-        iteration = 0
-        while should_iter and iteration < max_iterations:
-            self.diags.reset()
-            resolve_name_info = self.resolve_names()
-            resolve_types_info = self.resolve_types()
-            infer_return_types_info = self.infer_return_types()
-            infer_variable_types_info = self.infer_variable_types()
-            should_iter = (resolve_name_info.num_changes > 0 or
-                           resolve_types_info.num_changes > 0 or
-                           infer_return_types_info.num_changes > 0 or
-                           infer_variable_types_info.num_changes > 0)
-            iteration += 1
-        if iteration == max_iterations:
-            self.diags.error("Max iterations reached")
-        self.support_definitions = self.get_support_definitions()
+        self.diags.reset()
+        # Names don't depend on types so one pass resolves all that can be
+        with stats.time_pass("resolve.names") as ps:
+            names = self.resolve_names()
+            ps.num_nodes_visited += names.num_visited
+            ps.add_iteration(names.num_changes, names.num_errors)
+        with stats.time_pass("resolve.types") as ps:
+            inference = TypeInference(Diagnostics())
+            inference.run(list(iter_post_order(self.ast)))
+            # Report what's still unresolved
+            types = self.resolve_types()
+            ps.num_nodes_visited += inference.num_visits + types.num_visited
+            ps.add_iteration(inference.num_resolved, types.num_changes + types.num_need_info)
+            ps.add_iteration(types.num_changes, types.num_need_info)
+        if isinstance(self.ast, Block) and (names.num_changes > 0 or inference.num_resolved > 0 or types.num_changes > 0):
+            self.ast.resolve_generation += 1
+        inferred = inference.inferred
+        if isinstance(self.ast, Block):
+            # Keep what was resolved so later compiles only redo what changes
+            state = CompileState(self.ast)
+            state.compiling = True
+            try:
+                with stats.time_pass("resolve.track"):
+                    tracked = state.track_all(inferred)
+                if tracked:
+                    state.write_results(self)
+                    self.ast.compile_state = state
+                    return
+            finally:
+                state.compiling = False
+        with stats.time_pass("resolve.support_definitions") as ps:
+            c = CollectSupportDefinitions()
+            c.run(self.ast)
+            ps.num_nodes_visited += c.num_visited
+            self.support_definitions = c.support_definitions
+            stats.record_support_definitions(c.defs)
         self.find_entry_points()
+
+    def write_code(self, out: Union[str, TextIO], language: Optional[Any] = None):
+        session = get_entered_session()
+        if session is None:
+            session = CompileSession(self.options)
+        with session:
+            return self.write_code_in_session(out, language)
+
+    def write_code_in_session(self, out: Union[str, TextIO], language: Optional[Any]):
+        import alang.langs as langs
+        from alang.langs.writer import CodeWriter
+        if isinstance(out, CodeWriter):
+            writer = out
+            needs_close = False
+        else:
+            writer = langs.get_language(language).open_writer(out, self.options)
+            needs_close = True
+        writer.entry_points = self.entry_points
+        try:
+            with self.stats.time_pass("emit"):
+                for s in self.support_definitions:
+                    writer.write_support_node(s)
+                writer.write_node(self.ast)
+                writer.write_diags(self.diags.messages)
+        finally:
+            if needs_close:
+                writer.close()
+        return self.stats
+
+    def to_bytes(self) -> bytes:
+        from alang.serialize import dumps
+        diags = [(m.kind, m.message, m.node) for m in self.diags.messages]
+        return dumps((self.ast, self.support_definitions, self.entry_points, diags))
+
+    @staticmethod
+    def from_bytes(data: bytes, options: CodeOptions) -> "Compiler":
+        """Loads a compiled module that is ready to write without compiling again"""
+        from alang.serialize import loads
+        ast, support_definitions, entry_points, diags = loads(data)
+        c = Compiler(ast, options)
+        c.support_definitions = support_definitions
+        c.entry_points = entry_points
+        for kind, message, node in diags:
+            c.diags.message(kind, message, node)
+        return c
+
+# Registers the optimization passes
+import alang.opt
@@ -34,6 +34,9 @@ class Name(Expression):
     def resolve_type(self, diags: compiler.Diagnostics) -> typs.Type:
         if self.resolved_node is None:
             return None
+        if self.resolved_node.node_type == NodeType.LOOP:
+            # The loop's counter
+            return typs.int_type
         return self.resolved_node.resolved_type
 
 class BinopOp:
@@ -252,6 +255,7 @@ class Funcall(Expression):
 class Index(Expression):
     base = NodeLink()
     ranges = NodeLinks()
+    in_bounds = NodeAttr(False) # proven by range analysis so writers may skip checks
     def __init__(self, base: Expression, *ranges: list[Expression]):
         super().__init__(NodeType.INDEX)
         self.base = parse_expr(base)
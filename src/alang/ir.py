@@ -0,0 +1,822 @@
+"""A compact SSA form of function bodies.
+
+Instructions are stored column-wise in flat lists indexed by value id, so
+analyses and optimizations walk arrays of ints instead of linked nodes.
+Blocks list their instructions in order and end with a jump, branch or
+return. Scalar locals become SSA values joined by phis at loop headers, and
+aggregates (arrays, tensors, structs) and module variables are memory that
+is loaded and stored. Loops keep their structure so functions can be lowered
+back into nodes for the writers."""
+
+from typing import Optional
+
+from alang.compiler import Compiler, Pass
+from alang.nodes import AddressSpace, Node, NodeType, Variable
+from alang.opt import fold_values, get_fresh_name, get_functions, lookup_local
+import alang.exprs as exprs
+import alang.stmts as stmts
+import alang.typs as typs
+
+NOP = 0
+CONST = 1 # attr is the value
+PARAM = 2 # attr is the parameter's name
+GLOBAL = 3 # attr is the module variable's name
+ALLOC = 4 # attr is the local aggregate's Variable
+PHI = 5 # args are in the order of the block's preds
+BINOP = 6 # attr is the operator's name
+LOAD = 7 # args are the base and indices, attr is whether they're in bounds
+STORE = 8 # args are the base, indices and value
+CALL = 9 # attr is the function's name
+JUMP = 10 # attr is the target block
+BRANCH = 11 # attr is the (true, false) blocks
+RETURN = 12
+
+op_names = ["nop", "const", "param", "global", "alloc", "phi", "binop", "load", "store", "call", "jump", "br", "ret"]
+terminator_ops = (JUMP, BRANCH, RETURN)
+# Instructions that are kept whether or not their values are used
+effect_ops = (ALLOC, STORE, CALL, JUMP, BRANCH, RETURN)
+# Instructions that compute the same value from the same args anywhere
+pure_ops = (CONST, GLOBAL, BINOP)
+
+class BasicBlock:
+    __slots__ = ("id", "insts", "preds", "succs")
+    def __init__(self, id: int):
+        self.id = id
+        self.insts: list[int] = []
+        self.preds: list[int] = []
+        self.succs: list[int] = []
+
+class IRLoop:
+    """Where a Loop node's parts are so it can be rebuilt. The pre block jumps
+    to the header, which holds the phis and branches to the body or the exit.
+    The latch ends the body by stepping the counter and jumping back."""
+    __slots__ = ("var", "pre", "header", "body", "latch", "exit", "counter", "count", "cond", "step")
+    def __init__(self, var: str, pre: int, header: int, body: int, exit: int, count: int):
+        self.var = var
+        self.pre = pre
+        self.header = header
+        self.body = body
+        self.exit = exit
+        self.count = count
+        self.latch: Optional[int] = None
+        self.counter = -1
+        self.cond = -1
+        self.step = -1
+
+class IRFunction:
+    def __init__(self, name: str):
+        self.name = name
+        self.ops: list[int] = []
+        self.args: list[tuple[int, ...]] = []
+        self.attrs: list[object] = []
+        self.types: list[Optional[Node]] = []
+        self.hints: list[Optional[str]] = [] # names for the values when they're lowered
+        self.block_of: list[int] = []
+        self.blocks: list[BasicBlock] = []
+        self.loops: list[IRLoop] = []
+    @property
+    def num_values(self) -> int:
+        return len(self.ops)
+    @property
+    def num_instructions(self) -> int:
+        return sum(len(b.insts) for b in self.blocks)
+    def add_block(self) -> BasicBlock:
+        b = BasicBlock(len(self.blocks))
+        self.blocks.append(b)
+        return b
+    def add_edge(self, a: int, b: int):
+        self.blocks[a].succs.append(b)
+        self.blocks[b].preds.append(a)
+    def new_value(self, block: int, op: int, args: tuple[int, ...], attr: object, type: Optional[Node], hint: Optional[str]) -> int:
+        v = len(self.ops)
+        self.ops.append(op)
+        self.args.append(args)
+        self.attrs.append(attr)
+        self.types.append(type)
+        self.hints.append(hint)
+        self.block_of.append(block)
+        return v
+    def emit(self, block: int, op: int, args: tuple[int, ...] = (), attr: object = None, type: Optional[Node] = None, hint: Optional[str] = None) -> int:
+        v = self.new_value(block, op, args, attr, type, hint)
+        self.blocks[block].insts.append(v)
+        return v
+    def insert_phi(self, block: int, type: Optional[Node], hint: Optional[str]) -> int:
+        v = self.new_value(block, PHI, (), None, type, hint)
+        insts = self.blocks[block].insts
+        i = 0
+        while i < len(insts) and self.ops[insts[i]] == PHI:
+            i += 1
+        insts.insert(i, v)
+        return v
+    def remove(self, v: int):
+        self.blocks[self.block_of[v]].insts.remove(v)
+        self.ops[v] = NOP
+        self.args[v] = ()
+    def replace_uses(self, old: int, new: int, uses: list[list[int]]):
+        """Makes the users of old use new, keeping the def-use chains up to date"""
+        for u in uses[old]:
+            self.args[u] = tuple(new if a == old else a for a in self.args[u])
+            uses[new].append(u)
+        uses[old] = []
+    def get_phis(self, block: int) -> list[int]:
+        return [v for v in self.blocks[block].insts if self.ops[v] == PHI]
+    def format(self) -> str:
+        lines = [f"function {self.name}"]
+        for b in self.blocks:
+            lines.append(f"b{b.id}: ; preds " + ", ".join(f"b{p}" for p in b.preds))
+            for v in b.insts:
+                op = self.ops[v]
+                parts = [op_names[op]]
+                attr = self.attrs[v]
+                if op == JUMP:
+                    parts.append(f"b{attr}")
+                elif op == BRANCH:
+                    parts.append(f"v{self.args[v][0]} b{attr[0]} b{attr[1]}") # type: ignore
+                elif op == ALLOC:
+                    parts.append(attr.name) # type: ignore
+                elif op not in (PHI, LOAD, STORE, RETURN):
+                    parts.append(repr(attr) if op == CONST else str(attr))
+                if op != BRANCH:
+                    parts.extend(f"v{a}" for a in self.args[v])
+                text = " ".join(parts)
+                lines.append(f"    v{v} = {text}" if op not in effect_ops or op == CALL or op == ALLOC else f"    {text}")
+        return "\n".join(lines)
+
+def is_scalar(t: Optional[Node]) -> bool:
+    return t is not None and isinstance(t, typs.Scalar)
+
+def get_zero(t: Optional[Node]):
+    return 0.0 if t is not None and t.is_float else 0
+
+class IRBuilder:
+    """Lowers a resolved function into SSA, placing phis as names are read
+    (Braun et al., Simple and Efficient Construction of SSA Form)"""
+    def __init__(self, f: Node):
+        self.f = f
+        self.ir = IRFunction(f.name)
+        self.block: Optional[int] = None
+        self.defs: dict[int, dict[int, int]] = {} # var id -> block -> value
+        self.incomplete: dict[int, dict[int, int]] = {} # block -> var id -> phi
+        self.sealed: set[int] = set()
+        self.var_types: dict[int, Optional[Node]] = {}
+        self.var_names: dict[int, str] = {}
+        self.refs: dict[int, int] = {} # aggregate and module variables
+        self.lets: dict[int, int] = {}
+        self.uses: list[list[int]] = []
+    def emit(self, op: int, args: tuple[int, ...] = (), attr: object = None, type: Optional[Node] = None, hint: Optional[str] = None) -> int:
+        if self.block is None:
+            raise ValueError("Cannot lower code after a return")
+        v = self.ir.emit(self.block, op, args, attr, type, hint)
+        self.uses.append([])
+        for a in args:
+            self.uses[a].append(v)
+        return v
+    def jump(self, target: int):
+        self.emit(JUMP, attr=target)
+        self.ir.add_edge(self.block, target) # type: ignore
+    def constant(self, value: object, t: Optional[Node] = None) -> int:
+        if t is None:
+            t = typs.float_type if type(value) is float else typs.int_type
+        return self.emit(CONST, attr=value, type=t)
+    def write_var(self, var: int, block: int, v: int):
+        self.defs.setdefault(var, {})[block] = v
+    def read_var(self, var: int, block: int) -> int:
+        d = self.defs.get(var)
+        if d is not None and block in d:
+            return d[block]
+        ir = self.ir
+        preds = ir.blocks[block].preds
+        if block not in self.sealed:
+            v = self.new_phi(var, block)
+            self.incomplete.setdefault(block, {})[var] = v
+        elif len(preds) == 1:
+            v = self.read_var(var, preds[0])
+        elif len(preds) == 0:
+            raise ValueError(f"Cannot lower {self.var_names[var]} before it's assigned")
+        else:
+            v = self.new_phi(var, block)
+            self.write_var(var, block, v)
+            v = self.add_phi_operands(var, v)
+        self.write_var(var, block, v)
+        return v
+    def new_phi(self, var: int, block: int) -> int:
+        v = self.ir.insert_phi(block, self.var_types[var], self.var_names[var])
+        self.uses.append([])
+        return v
+    def add_phi_operands(self, var: int, phi: int) -> int:
+        ir = self.ir
+        args = tuple(self.read_var(var, p) for p in ir.blocks[ir.block_of[phi]].preds)
+        ir.args[phi] = args
+        for a in args:
+            self.uses[a].append(phi)
+        return self.remove_trivial_phi(phi)
+    def remove_trivial_phi(self, phi: int) -> int:
+        ir = self.ir
+        same = None
+        for a in ir.args[phi]:
+            if a == same or a == phi:
+                continue
+            if same is not None:
+                return phi
+            same = a
+        if same is None:
+            # Only reachable from itself
+            ir.ops[phi] = CONST
+            ir.attrs[phi] = get_zero(ir.types[phi])
+            ir.args[phi] = ()
+            return phi
+        users = [u for u in self.uses[phi] if u != phi]
+        self.uses[phi] = users
+        ir.replace_uses(phi, same, self.uses)
+        ir.remove(phi)
+        for d in self.defs.values():
+            for b, v in d.items():
+                if v == phi:
+                    d[b] = same
+        for u in users:
+            if ir.ops[u] == PHI:
+                self.remove_trivial_phi(u)
+        return same
+    def seal(self, block: int):
+        for var, phi in self.incomplete.pop(block, {}).items():
+            self.add_phi_operands(var, phi)
+        self.sealed.add(block)
+    def build(self) -> IRFunction:
+        f = self.f
+        entry = self.ir.add_block().id
+        self.sealed.add(entry)
+        self.block = entry
+        for p in f.parameters:
+            t = p.resolved_type
+            v = self.emit(PARAM, attr=p.name, type=t, hint=p.name)
+            if is_scalar(t):
+                self.declare(p, t)
+                self.write_var(p.id, entry, v)
+            else:
+                self.refs[p.id] = v
+        for var in f.variables:
+            t = var.resolved_type
+            if is_scalar(t):
+                if var.address_space not in (None, AddressSpace.FUNCTION) or var.bind_group is not None or var.binding is not None:
+                    # Its values become SSA values, which would lose where it lives
+                    raise ValueError(f"Cannot lower {var.name} in the {var.address_space} address space")
+                self.declare(var, t)
+                init = self.lower_expr(var.initial_value) if var.initial_value is not None else self.constant(get_zero(t), t)
+                self.write_var(var.id, self.block, init) # type: ignore
+            else:
+                a = self.emit(ALLOC, attr=var, type=t, hint=var.name)
+                self.refs[var.id] = a
+                if var.initial_value is not None:
+                    self.emit(STORE, (a, self.lower_expr(var.initial_value)))
+        self.lower_statements(f.statements)
+        return self.ir
+    def declare(self, var: Node, t: Optional[Node], name: Optional[str] = None):
+        self.var_types[var.id] = t
+        self.var_names[var.id] = name or var.name
+    def lower_statements(self, statements: list[Node]):
+        for s in statements:
+            if self.block is None:
+                # Unreachable after a return
+                break
+            self.lower_statement(s)
+    def lower_statement(self, s: Node):
+        nt = s.node_type
+        if nt == NodeType.LET:
+            self.lets[s.id] = v = self.lower_expr(s.value)
+            if self.ir.hints[v] is None:
+                self.ir.hints[v] = s.name
+        elif nt == NodeType.SET:
+            self.lower_set(s)
+        elif nt == NodeType.LOOP:
+            self.lower_loop(s)
+        elif nt == NodeType.RETURN:
+            args = () if s.value is None else (self.lower_expr(s.value),)
+            self.emit(RETURN, args)
+            self.block = None
+        elif nt == NodeType.EXPR_STMT:
+            self.lower_expr(s.expression)
+        else:
+            raise ValueError(f"Cannot lower {s.node_type} statements")
+    def resolve_name(self, n: Node) -> Node:
+        r = n.resolved_node
+        if r is None:
+            r = lookup_local(n)
+        if r is None:
+            raise ValueError(f"Cannot lower unresolved name {n.name}")
+        return r
+    def get_ref(self, r: Node) -> Optional[int]:
+        v = self.refs.get(r.id)
+        if v is None and r.node_type == NodeType.VARIABLE:
+            # Module variables are loaded and stored wherever they're used
+            v = self.emit(GLOBAL, attr=r.name, type=r.resolved_type, hint=r.name)
+        return v
+    def lower_set(self, s: Node):
+        target = s.target
+        if target.node_type == NodeType.NAME:
+            r = self.resolve_name(target)
+            if r.id in self.var_types:
+                self.write_var(r.id, self.block, self.lower_expr(s.value)) # type: ignore
+                return
+            ref = self.get_ref(r)
+            if ref is not None:
+                self.emit(STORE, (ref, self.lower_expr(s.value)))
+                return
+        elif target.node_type == NodeType.INDEX:
+            base = self.lower_base(target.base)
+            indices = tuple(self.lower_expr(i) for i in target.ranges)
+            self.emit(STORE, (base, *indices, self.lower_expr(s.value)), attr=target.in_bounds)
+            return
+        raise ValueError(f"Cannot lower assignment to {target.node_type}")
+    def lower_base(self, base: Node) -> int:
+        if base.node_type == NodeType.NAME:
+            r = self.resolve_name(base)
+            if r.id not in self.var_types and r.node_type != NodeType.LET:
+                ref = self.get_ref(r)
+                if ref is not None:
+                    return ref
+        return self.lower_expr(base)
+    def lower_loop(self, loop: Node):
+        ir = self.ir
+        count = self.lower_expr(loop.count)
+        pre: int = self.block # type: ignore
+        header = ir.add_block().id
+        body = ir.add_block().id
+        exit = ir.add_block().id
+        info = IRLoop(loop.var, pre, header, body, exit, count)
+        self.declare(loop, typs.int_type, loop.var)
+        self.write_var(loop.id, pre, self.constant(0))
+        self.jump(header)
+        self.block = header
+        info.counter = self.read_var(loop.id, header)
+        info.cond = self.emit(BINOP, (info.counter, count), attr="lt", type=typs.int_type)
+        self.emit(BRANCH, (info.cond,), attr=(body, exit))
+        ir.add_edge(header, body)
+        ir.add_edge(header, exit)
+        self.seal(body)
+        self.block = body
+        self.lower_statements(loop.statements)
+        if self.block is not None:
+            info.latch = self.block
+            i = self.read_var(loop.id, self.block)
+            info.step = self.emit(BINOP, (i, self.constant(1)), attr="add", type=typs.int_type)
+            self.write_var(loop.id, self.block, info.step)
+            self.jump(header)
+        self.seal(header)
+        self.seal(exit)
+        self.block = exit
+        ir.loops.append(info)
+    def lower_expr(self, e: Node) -> int:
+        nt = e.node_type
+        if nt == NodeType.CONSTANT:
+            return self.constant(e.value, e.resolved_type)
+        if nt == NodeType.NAME:
+            r = self.resolve_name(e)
+            if r.id in self.var_types:
+                return self.read_var(r.id, self.block) # type: ignore
+            if r.node_type == NodeType.LET:
+                v = self.lets.get(r.id)
+                if v is None:
+                    raise ValueError(f"Cannot lower {e.name} outside its scope")
+                return v
+            ref = self.get_ref(r)
+            if ref is None:
+                raise ValueError(f"Cannot lower name {e.name}")
+            if r.node_type == NodeType.VARIABLE or r.node_type == NodeType.PARAMETER:
+                return self.emit(LOAD, (ref,), attr=True, type=e.resolved_type)
+            return ref
+        if nt == NodeType.BINOP:
+            a = self.lower_expr(e.left)
+            b = self.lower_expr(e.right)
+            t = e.resolved_type or self.ir.types[a]
+            return self.emit(BINOP, (a, b), attr=e.operator.name, type=t)
+        if nt == NodeType.INDEX:
+            base = self.lower_base(e.base)
+            indices = tuple(self.lower_expr(i) for i in e.ranges)
+            return self.emit(LOAD, (base, *indices), attr=e.in_bounds, type=e.resolved_type)
+        if nt == NodeType.FUNCALL and e.func.node_type == NodeType.NAME:
+            args = tuple(self.lower_expr(a) for a in e.args)
+            return self.emit(CALL, args, attr=e.func.name, type=e.resolved_type)
+        raise ValueError(f"Cannot lower {e.node_type} expressions")
+
+def lower_function(f: Node) -> IRFunction:
+    """The SSA form of a resolved function. Raises ValueError for code it can't represent."""
+    return IRBuilder(f).build()
+
+def get_uses(ir: IRFunction) -> list[list[int]]:
+    """The def-use chains: the instructions that use each value"""
+    uses: list[list[int]] = [[] for _ in range(ir.num_values)]
+    for b in ir.blocks:
+        for v in b.insts:
+            for a in ir.args[v]:
+                uses[a].append(v)
+    return uses
+
+def get_reverse_postorder(ir: IRFunction) -> list[int]:
+    order = []
+    seen = {0}
+    stack = [(0, 0)]
+    while len(stack) > 0:
+        b, i = stack.pop()
+        succs = ir.blocks[b].succs
+        if i < len(succs):
+            stack.append((b, i + 1))
+            s = succs[i]
+            if s not in seen:
+                seen.add(s)
+                stack.append((s, 0))
+        else:
+            order.append(b)
+    order.reverse()
+    return order
+
+def get_dominators(ir: IRFunction) -> list[int]:
+    """The immediate dominator of each block, -1 for unreachable ones and the
+    entry's own id for the entry (Cooper, Harvey and Kennedy, A Simple, Fast
+    Dominance Algorithm)"""
+    order = get_reverse_postorder(ir)
+    rpo = [-1] * len(ir.blocks)
+    for i, b in enumerate(order):
+        rpo[b] = i
+    idom = [-1] * len(ir.blocks)
+    idom[0] = 0
+    def intersect(a: int, b: int) -> int:
+        while a != b:
+            while rpo[a] > rpo[b]:
+                a = idom[a]
+            while rpo[b] > rpo[a]:
+                b = idom[b]
+        return a
+    changed = True
+    while changed:
+        changed = False
+        for b in order[1:]:
+            new_idom = -1
+            for p in ir.blocks[b].preds:
+                if idom[p] == -1:
+                    continue
+                new_idom = p if new_idom == -1 else intersect(p, new_idom)
+            if idom[b] != new_idom:
+                idom[b] = new_idom
+                changed = True
+    return idom
+
+def dominates(idom: list[int], a: int, b: int) -> bool:
+    """Whether every path from the entry to b goes through a"""
+    if idom[b] == -1:
+        return False
+    while b != a:
+        if b == 0:
+            return False
+        b = idom[b]
+    return True
+
+def get_dominator_tree(idom: list[int]) -> list[list[int]]:
+    children: list[list[int]] = [[] for _ in idom]
+    for b, d in enumerate(idom):
+        if d != -1 and d != b:
+            children[d].append(b)
+    return children
+
+def fold_constants(ir: IRFunction, uses: list[list[int]]) -> int:
+    """Computes binops of constants and drops adding zero and multiplying by one"""
+    num_folded = 0
+    ops, args, attrs = ir.ops, ir.args, ir.attrs
+    for b in ir.blocks:
+        for v in b.insts:
+            if ops[v] != BINOP:
+                continue
+            a, c = args[v]
+            if ops[a] == CONST and ops[c] == CONST:
+                t = ir.types[v]
+                value = fold_values(attrs[v], attrs[a], attrs[c], t.bits if t is not None and t.is_float else 32) # type: ignore
+                if value is not None:
+                    ops[v] = CONST
+                    attrs[v] = value
+                    args[v] = ()
+                    uses[a].remove(v)
+                    uses[c].remove(v)
+                    num_folded += 1
+                continue
+            op = attrs[v]
+            same = None
+            if ops[c] == CONST and type(attrs[c]) is int:
+                k = attrs[c]
+                if (k == 0 and op in ("add", "sub", "shl", "shr", "bor", "xor")) or (k == 1 and op in ("mul", "div")):
+                    same = a
+            elif ops[a] == CONST and type(attrs[a]) is int:
+                k = attrs[a]
+                if (k == 0 and op in ("add", "bor", "xor")) or (k == 1 and op == "mul"):
+                    same = c
+            if same is not None and ir.types[same] is ir.types[v]:
+                ir.replace_uses(v, same, uses)
+                num_folded += 1
+    return num_folded
+
+def number_values(ir: IRFunction, uses: list[list[int]]) -> int:
+    """Global value numbering: pure instructions computing what one in a
+    dominating block already computed use its value instead"""
+    children = get_dominator_tree(get_dominators(ir))
+    table: dict[tuple, int] = {}
+    num_replaced = 0
+    ops, args, attrs = ir.ops, ir.args, ir.attrs
+    stack: list[tuple[int, Optional[list[tuple]]]] = [(0, None)]
+    while len(stack) > 0:
+        b, added = stack.pop()
+        if added is not None:
+            # Leaving the block's subtree
+            for key in added:
+                del table[key]
+            continue
+        added = []
+        stack.append((b, added))
+        for v in ir.blocks[b].insts:
+            if ops[v] not in pure_ops:
+                continue
+            key = (ops[v], attrs[v], args[v], type(attrs[v]))
+            w = table.get(key)
+            if w is None:
+                table[key] = v
+                added.append(key)
+            elif ir.types[w] is ir.types[v]:
+                ir.replace_uses(v, w, uses)
+                num_replaced += 1
+        for c in children[b]:
+            stack.append((c, None))
+    return num_replaced
+
+def remove_trivial_phis(ir: IRFunction, uses: list[list[int]]) -> int:
+    """Removes phis that only join one value with themselves"""
+    num_removed = 0
+    work = [v for b in ir.blocks for v in b.insts if ir.ops[v] == PHI]
+    while len(work) > 0:
+        phi = work.pop()
+        if ir.ops[phi] != PHI:
+            continue
+        same = {a for a in ir.args[phi] if a != phi}
+        if len(same) != 1:
+            continue
+        users = [u for u in uses[phi] if u != phi]
+        uses[phi] = users
+        ir.replace_uses(phi, same.pop(), uses)
+        ir.remove(phi)
+        num_removed += 1
+        work.extend(u for u in users if ir.ops[u] == PHI)
+    return num_removed
+
+def eliminate_dead_code(ir: IRFunction) -> int:
+    """Removes the instructions whose values no effect depends on"""
+    ops, args = ir.ops, ir.args
+    live = [False] * ir.num_values
+    work = [v for b in ir.blocks for v in b.insts if ops[v] in effect_ops]
+    # Loops are rebuilt with their counts
+    work.extend(l.count for l in ir.loops)
+    for v in work:
+        live[v] = True
+    while len(work) > 0:
+        v = work.pop()
+        for a in args[v]:
+            if not live[a]:
+                live[a] = True
+                work.append(a)
+    num_removed = 0
+    for b in ir.blocks:
+        keep = [v for v in b.insts if live[v]]
+        num_removed += len(b.insts) - len(keep)
+        for v in b.insts:
+            if not live[v]:
+                ops[v] = NOP
+                args[v] = ()
+        b.insts = keep
+    return num_removed
+
+def optimize(ir: IRFunction) -> dict[str, int]:
+    uses = get_uses(ir)
+    folded = fold_constants(ir, uses)
+    numbered = number_values(ir, uses)
+    phis = remove_trivial_phis(ir, uses)
+    removed = eliminate_dead_code(ir)
+    return {"folded": folded, "numbered": numbered, "phis": phis, "removed": removed}
+
+def copy_variable(var: Node) -> Node:
+    """A declaration like var's without its initial value, which is lowered to a store"""
+    v = Variable(var.name, var.resolved_type, address_space=var.address_space)
+    v.access_mode = var.access_mode
+    v.bind_group = var.bind_group
+    v.binding = var.binding
+    return v
+
+class NodeLowering:
+    """Rebuilds a function's body from its SSA form. Phis become variables
+    that are set before their loop and at the end of each iteration. Values
+    used once in the block that computes them are written in place, others
+    are bound with lets."""
+    def __init__(self, ir: IRFunction, f: Node):
+        self.ir = ir
+        self.f = f
+        self.uses = get_uses(ir)
+        # Locals are all made again so only these names are kept
+        self.used = {p.name for p in f.parameters}
+        self.used.update(l.var for l in ir.loops)
+        m = f.last_backlink
+        if m is not None and m.symbols is not None:
+            for names in m.symbols.values():
+                self.used.update(names.keys())
+        for b in ir.blocks:
+            for v in b.insts:
+                if ir.ops[v] in (GLOBAL, CALL):
+                    self.used.add(ir.attrs[v]) # type: ignore
+                elif ir.ops[v] == ALLOC:
+                    self.used.add(ir.attrs[v].name) # type: ignore
+        self.names: dict[int, str] = {}
+        self.pending: dict[int, Node] = {}
+        self.variables: list[Node] = []
+        self.loops = {l.header: l for l in ir.loops}
+        self.skipped: set[int] = set()
+        self.counts: set[int] = set()
+        for l in ir.loops:
+            self.skipped.add(l.cond)
+            self.skipped.add(l.step)
+            self.names[l.counter] = l.var
+            if self.uses[l.count] == [l.cond]:
+                self.counts.add(l.count)
+        for b in ir.blocks:
+            for v in b.insts:
+                op = ir.ops[v]
+                if op == PARAM or op == GLOBAL:
+                    self.names[v] = ir.attrs[v] # type: ignore
+                elif op == ALLOC:
+                    var = ir.attrs[v]
+                    self.names[v] = var.name # type: ignore
+                    self.variables.append(copy_variable(var)) # type: ignore
+                elif op == PHI and v not in self.names:
+                    self.names[v] = name = self.get_name(ir.hints[v] or "ssa")
+                    self.variables.append(Variable(name, ir.types[v]))
+    def get_name(self, hint: str) -> str:
+        if hint == "ssa":
+            return get_fresh_name(hint, self.used)
+        if hint not in self.used:
+            self.used.add(hint)
+            return hint
+        return get_fresh_name(f"{hint}_", self.used)
+    def get_expr(self, v: int) -> Node:
+        e = self.pending.pop(v, None)
+        if e is not None:
+            return e
+        name = self.names.get(v)
+        if name is not None:
+            return exprs.Name(name)
+        if self.ir.ops[v] == CONST:
+            return exprs.Constant(self.ir.attrs[v])
+        raise ValueError(f"Value v{v} is used before it's computed")
+    def is_used_once_in(self, v: int, block: int) -> bool:
+        uses = self.uses[v]
+        if len(uses) != 1:
+            return False
+        u = uses[0]
+        ir = self.ir
+        if ir.ops[u] == PHI:
+            preds = ir.blocks[ir.block_of[u]].preds
+            return preds[ir.args[u].index(v)] == block
+        return ir.block_of[u] == block and u not in self.skipped
+    def build_expr(self, v: int) -> Node:
+        ir = self.ir
+        op = ir.ops[v]
+        args = ir.args[v]
+        if op == BINOP:
+            return exprs.Binop(self.get_expr(args[0]), ir.attrs[v], self.get_expr(args[1])) # type: ignore
+        if op == LOAD:
+            base = self.get_expr(args[0])
+            if len(args) == 1:
+                return base
+            e = exprs.Index(base, *[self.get_expr(a) for a in args[1:]])
+            e.in_bounds = ir.attrs[v]
+            return e
+        return exprs.Funcall(exprs.Name(ir.attrs[v]), [self.get_expr(a) for a in args]) # type: ignore
+    def flush(self, out: list[Node]):
+        """Binds the values waiting to be used so they're computed before an effect"""
+        for v, e in self.pending.items():
+            self.bind(v, e, out)
+        self.pending.clear()
+    def bind(self, v: int, e: Node, out: list[Node]):
+        ir = self.ir
+        name = self.get_name(ir.hints[v] or "ssa")
+        self.names[v] = name
+        out.append(stmts.Let(name, e, ir.types[v]))
+    def lower_insts(self, block: int, out: list[Node]):
+        ir = self.ir
+        for v in ir.blocks[block].insts:
+            op = ir.ops[v]
+            if v in self.skipped or op in (CONST, PARAM, GLOBAL, ALLOC, PHI) or op in terminator_ops:
+                continue
+            if op == BINOP or op == LOAD:
+                e = self.build_expr(v)
+                if self.is_used_once_in(v, block) or v in self.counts:
+                    self.pending[v] = e
+                else:
+                    self.bind(v, e, out)
+            elif op == STORE:
+                args = ir.args[v]
+                target = self.get_expr(args[0])
+                if len(args) > 2:
+                    target = exprs.Index(target, *[self.get_expr(a) for a in args[1:-1]])
+                    target.in_bounds = ir.attrs[v]
+                s = stmts.Set(target, self.get_expr(args[-1]))
+                self.flush(out)
+                out.append(s)
+            elif op == CALL:
+                e = self.build_expr(v)
+                self.flush(out)
+                if len(self.uses[v]) == 0:
+                    out.append(stmts.ExprStmt(e))
+                else:
+                    self.bind(v, e, out)
+    def set_phis(self, header: int, pred: int, out: list[Node]):
+        """Sets the header's phi variables to their values coming from pred, all at once"""
+        ir = self.ir
+        i = ir.blocks[header].preds.index(pred)
+        phis = [p for p in ir.get_phis(header) if p != self.loops[header].counter]
+        values = [self.get_expr(ir.args[p][i]) for p in phis]
+        sets = []
+        for k, (p, e) in enumerate(zip(phis, values)):
+            name = self.names[p]
+            if e.node_type == NodeType.NAME:
+                if e.name == name:
+                    continue
+                reads = {e.name}
+            else:
+                reads = {n.name for n in e.find_reachable_with_type(NodeType.NAME)}
+            if any(self.names[q] in reads for q in phis[:k]):
+                # It reads a phi that's set before it
+                t = self.get_name(ir.hints[p] or "ssa")
+                out.append(stmts.Let(t, e, ir.types[p]))
+                e = exprs.Name(t)
+            sets.append(stmts.Set(exprs.Name(name), e))
+        out.extend(sets)
+    def lower_blocks(self, block: Optional[int], stop: int, out: list[Node]):
+        ir = self.ir
+        while block is not None and block != stop:
+            self.lower_insts(block, out)
+            insts = ir.blocks[block].insts
+            last = insts[-1] if len(insts) > 0 else -1
+            op = ir.ops[last] if last >= 0 else NOP
+            if op == RETURN:
+                args = ir.args[last]
+                out.append(stmts.Return(self.get_expr(args[0]) if len(args) > 0 else None))
+                return
+            if op != JUMP:
+                return
+            target: int = ir.attrs[last] # type: ignore
+            loop = self.loops.get(target)
+            if loop is None:
+                block = target
+            elif loop.pre == block:
+                count = self.get_expr(loop.count)
+                self.set_phis(target, block, out)
+                body: list[Node] = []
+                self.lower_blocks(loop.body, target, body)
+                out.append(stmts.Loop(loop.var, count, *body))
+                block = loop.exit
+            else:
+                # The end of an iteration
+                self.set_phis(target, block, out)
+                return
+    def lower(self):
+        """Replaces the function's variables and statements"""
+        body: list[Node] = []
+        self.lower_blocks(0, -1, body)
+        f = self.f
+        f.unlink_rel("variables")
+        f.unlink_rel("statements")
+        for v in self.variables:
+            f.link(v, "variables")
+        for s in body:
+            f.link(s, "statements")
+
+def lower_to_nodes(ir: IRFunction, f: Node):
+    """Rewrites f, the function ir was lowered from, with the code in ir"""
+    NodeLowering(ir, f).lower()
+
+class SSAPass(Pass):
+    """Lowers functions into SSA form, optimizes them there and lowers them back.
+    It isn't in the default pipelines since rebuilt functions name their values
+    differently: add it with CodeOptions(passes=(SSAPass(),))."""
+    name = "ssa"
+    requires = ("resolve",)
+    opt_level = 2
+    changes_tree = True
+    def run(self, compiler: Compiler) -> bool:
+        ps = compiler.stats.get_pass(self.name)
+        changed = False
+        for f in get_functions(compiler.ast):
+            try:
+                ir = lower_function(f)
+            except ValueError:
+                # Left as it is
+                continue
+            ps.add_count("functions")
+            ps.add_count("instructions", ir.num_instructions)
+            for name, n in optimize(ir).items():
+                ps.add_count(name, n)
+            lower_to_nodes(ir, f)
+            changed = True
+        return changed
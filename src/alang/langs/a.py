@@ -49,6 +49,11 @@ class AWriter(CodeWriter):
         self.write(comment)
         self.write("\n")
 
+    def write_let(self, l: stmts.Let):
+        self.write(f"{l.name} = ")
+        self.write_expr(l.value)
+        self.write("\n")
+
     def write_loop(self, f: stmts.Loop):
         self.write(f"for (var {f.var}: ")
         self.write_type_ref(typs.int_type)
@@ -111,6 +111,12 @@ class CWriter(CodeWriter):
         self.write(comment)
         self.write("\n")
 
+    def write_let(self, l: stmts.Let):
+        self.write_type_ref(l.resolved_type or l.let_type)
+        self.write(f" {l.name} = ")
+        self.write_expr(l.value)
+        self.write(";\n")
+
     def write_loop(self, f: stmts.Loop):
         self.write("for (")
         self.write_type_ref(typs.int_type)
@@ -103,6 +103,10 @@ class HTMLWriter(CodeWriter):
         else:
             pass
 
+    def write_let(self, l: stmts.Let):
+        self.write(f"{l.name} = ")
+        self.write_expr(l.value)
+
     def write_set(self, s: stmts.Set):
         self.write_expr(s.target)
         self.write(" = ")
@@ -5,6 +5,7 @@ from alang.langs.writer import CodeWriter
 import alang.exprs as exprs
 import alang.typs as typs
 import alang.funcs as funcs
+import alang.nodes as nodes
 import alang.stmts as stmts
 
 class JSWriter(CodeWriter):
@@ -142,8 +143,16 @@ class JSWriter(CodeWriter):
                 self.write(":")
             else:
                 self.write_expr(r)
+        if i.in_bounds and i.ranges[0].node_type != nodes.NodeType.CONSTANT:
+            # Tells the JIT the index is a small integer
+            self.write("|0")
         self.write("]")
 
+    def write_let(self, l: stmts.Let):
+        self.write(f"const {l.name} = ")
+        self.write_expr(l.value)
+        self.write(";\n")
+
     def write_loop(self, f: stmts.Loop):
         self.write("for (let")
         self.write(f" {f.var} = 0; {f.var} < ")
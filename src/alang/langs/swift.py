@@ -112,6 +112,13 @@ class SwiftWriter(CodeWriter):
         self.write(comment)
         self.write("\n")
 
+    def write_let(self, l: stmts.Let):
+        self.write(f"let {l.name}: ")
+        self.write_type_ref(l.resolved_type or l.let_type)
+        self.write(" = ")
+        self.write_expr(l.value)
+        self.writeln()
+
     def write_loop(self, f: stmts.Loop):
         self.write("for (")
         self.write_type_ref(typs.int_type)
@@ -67,6 +67,11 @@ class WGSLWriter(CodeWriter):
                 self.write_expr(r)
         self.write("]")
 
+    def write_let(self, l: stmts.Let):
+        self.write(f"let {l.name} = ")
+        self.write_expr(l.value)
+        self.write(";\n")
+
     def write_loop(self, f: stmts.Loop):
         self.write(f"for (var {f.var}: ")
         self.write_type_ref(typs.int_type)
@@ -114,7 +119,7 @@ class WGSLWriter(CodeWriter):
             self.write_type_ref(f.return_type)
             self.write(" ")
         self.write_block(f)
-        if stage_and_auto is not None:
+        if stage_and_auto is not None and stage_and_auto[1] is not None:
             self.write_auto_entry_point_function(f, *stage_and_auto)
 
     def write_auto_entry_point_function(self, original_f: funcs.Function, stage: str, f: funcs.Function):
@@ -277,10 +282,6 @@ register_language(wgsl_lang)
 
 
 
-wrote_vec_def = set()
-wrote_mat_def = set()
-wrote_mm = set()
-
 def get_mat_type(shape) -> str:
     r, c = shape
     if c == 1 or r == 1:
@@ -298,7 +299,7 @@ def get_mat_type(shape) -> str:
             return f"mat{r}x{c}f"
 
 def get_mm_name(a_shape, b_shape, out):
-    global wrote_mm
+    wrote_mm = nodes.get_current_session().get_emitted_helpers("wgsl.mm")
     a_r, a_c = a_shape
     b_r, b_c = b_shape
     if a_c != b_r:
@@ -311,7 +312,7 @@ def get_mm_name(a_shape, b_shape, out):
     return name
 
 def write_vec_defs(r, out):
-    global wrote_vec_def
+    wrote_vec_def = nodes.get_current_session().get_emitted_helpers("wgsl.vec_def")
     if r <= 4 or r in wrote_vec_def:
         return
     wrote_vec_def.add(r)
@@ -342,7 +343,7 @@ def write_vec_defs(r, out):
     out.write("}\n")
 
 def write_mat_defs(r, c, out):
-    global wrote_mat_def
+    wrote_mat_def = nodes.get_current_session().get_emitted_helpers("wgsl.mat_def")
     if r <= 4 and c <= 4 or (r, c) in wrote_mat_def:
         return
     wrote_mat_def.add((r, c))
@@ -383,8 +384,7 @@ def write_mat_col(name, shape, col, out):
     out.write(f"{name}[{col}]")
 
 def write_mm_func(name, a_shape, b_shape, out):
-    global wrote_mm
-    wrote_mm.add(name)
+    nodes.get_current_session().get_emitted_helpers("wgsl.mm").add(name)
     a_r, a_c = a_shape
     b_r, b_c = b_shape
     if a_c != b_r:
@@ -1,16 +1,87 @@
+import io
+import itertools
+import multiprocessing
+import threading
 from typing import Optional, TextIO, Union
 
 import alang.nodes as nodes
 
+node_writer_names = {
+    nodes.NodeType.ALIAS: "write_alias",
+    nodes.NodeType.ARRAY: "write_array",
+    nodes.NodeType.ATTRIBUTE: "write_attribute",
+    nodes.NodeType.BINOP: "write_binop",
+    nodes.NodeType.CONSTANT: "write_constant",
+    nodes.NodeType.EXPR_STMT: "write_expr_stmt",
+    nodes.NodeType.FUNCALL: "write_funcall",
+    nodes.NodeType.FUNCTION: "write_function",
+    nodes.NodeType.INDEX: "write_index",
+    nodes.NodeType.LET: "write_let",
+    nodes.NodeType.LOOP: "write_loop",
+    nodes.NodeType.MODULE: "write_module",
+    nodes.NodeType.NAME: "write_name",
+    nodes.NodeType.POINTER: "write_pointer",
+    nodes.NodeType.RETURN: "write_return",
+    nodes.NodeType.SET: "write_set",
+    nodes.NodeType.STRUCT: "write_struct",
+    nodes.NodeType.VARIABLE: "write_variable",
+}
+
+# Modules with fewer top-level items than this are always written serially
+parallel_emission_min_items = 64
+module_item_rels = ("types", "variables", "functions")
+
+# Modules being written by worker processes, by job. Forked workers inherit
+# them, other workers load them from bytes.
+emit_jobs: dict[int, tuple["Node", list[tuple]]] = {} # type: ignore
+emit_job_ids = itertools.count(1)
+
+def get_emit_start_method() -> Optional[str]:
+    """How to start emission workers, or None to write serially. Forking while
+    other threads run can leave the child with locks that are never released."""
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return "spawn"
+    return "fork" if threading.active_count() == 1 else None
+
+def init_emit_worker(job: int, data: bytes):
+    from alang.serialize import loads
+    emit_jobs[job] = loads(data)
+
+def emit_module_items(job: int, language_name: str, options: "CodeOptions", rel: str, start: int, end: int, indent_level: int) -> list[tuple[str, dict[str, set], bool, int]]: # type: ignore
+    """Writes items of the job's module. Each item gets a session of its own
+    so the helpers it emits are known."""
+    from alang.langs import get_language
+    writer = get_language(language_name).open_writer(io.StringIO(), options)
+    module, writer.entry_points = emit_jobs[job]
+    results = []
+    for item in module.get_rels(rel)[start:end]:
+        writer.out = io.StringIO()
+        writer.indent_level = indent_level
+        writer.needs_indent = True
+        with nodes.CompileSession(options) as session:
+            writer.write_module_item(rel, item)
+            helpers = {kind: h for kind, h in session.emitted_helpers.items() if len(h) > 0}
+        results.append((writer.out.getvalue(), helpers, writer.needs_indent, writer.indent_level))
+    return results
+
 class CodeWriter:
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.build_node_writers()
+
+    @classmethod
+    def build_node_writers(cls):
+        cls.node_writers = {t: getattr(cls, name) for t, name in node_writer_names.items()}
+
     def __init__(self, path_or_io: Union[str, TextIO], options: Optional["CodeOptions"], language: "Language"): # type: ignore
         self.options = options
         self.language = language
+        self.entry_points: list[tuple] = []
         self.indent_level = 0
         self.needs_indent = True
         if self.options is None:
-            from alang.nodes import CodeOptions
-            self.options = CodeOptions()
+            from alang.nodes import get_current_session
+            self.options = get_current_session().options
         if type(path_or_io) is str:
             self.out = open(path_or_io, "w")
             self.owner = True
@@ -57,7 +128,7 @@ class CodeWriter:
         self.write_inline_comment(f"ERROR! {message}")
 
     def get_func_stage(self, f: "funcs.Function") -> Optional[tuple]: # type: ignore
-        for e, e_stage, out_e in self.options.entry_points:
+        for e, e_stage, out_e in self.entry_points:
             if e.name == f.name:
                 return e_stage, out_e
         return None
@@ -109,10 +180,17 @@ class CodeWriter:
     def write_index(self, i: "Index"): # type: ignore
         raise NotImplementedError
 
+    def write_let(self, l: "Let"): # type: ignore
+        raise NotImplementedError
+
     def write_loop(self, f: "Loop"): # type: ignore
         raise NotImplementedError
 
     def write_module(self, m: "modules.Module"): # type: ignore
+        num_items = len(m.types) + len(m.variables) + len(m.functions)
+        if self.options.emit_workers > 1 and num_items >= parallel_emission_min_items and get_emit_start_method() is not None:
+            self.write_module_in_parallel(m)
+            return
         for type in m.types:
             self.write_type(type)
         for var in m.variables:
@@ -120,6 +198,62 @@ class CodeWriter:
         for func in m.functions:
             self.write_function(func)
 
+    def write_module_item(self, rel: str, item: "Node"): # type: ignore
+        if rel == "types":
+            self.write_type(item)
+        elif rel == "variables":
+            self.write_variable(item)
+        else:
+            self.write_function(item)
+
+    def write_module_in_parallel(self, m: "modules.Module"): # type: ignore
+        """Writes the module's items in worker processes and joins them in order.
+        Workers are only forked while no other threads run.
+        Items are written again here when the serial output would differ:
+        when they emit helpers that were already emitted or the writer isn't
+        at the start of a line."""
+        from concurrent.futures import ProcessPoolExecutor
+        from alang.serialize import dumps
+        num_workers = self.options.emit_workers
+        job = next(emit_job_ids)
+        method = get_emit_start_method()
+        if method == "fork":
+            emit_jobs[job] = (m, self.entry_points)
+            pool_args = {"mp_context": multiprocessing.get_context(method)}
+        else:
+            pool_args = {"mp_context": multiprocessing.get_context(method), "initializer": init_emit_worker, "initargs": (job, dumps((m, self.entry_points)))}
+        chunks = []
+        for rel in module_item_rels:
+            n = len(m.get_rels(rel))
+            chunk_size = max(1, -(-n // (num_workers * 4)))
+            for start in range(0, n, chunk_size):
+                chunks.append((rel, start, min(n, start + chunk_size)))
+        indent_level = self.indent_level
+        try:
+            with ProcessPoolExecutor(num_workers, **pool_args) as pool:
+                futures = [pool.submit(emit_module_items, job, self.language.name, self.options, rel, start, end, indent_level) for rel, start, end in chunks]
+                self.join_module_items(m, chunks, futures, indent_level)
+        finally:
+            emit_jobs.pop(job, None)
+
+    def join_module_items(self, m: "modules.Module", chunks: list[tuple[str, int, int]], futures: list, indent_level: int): # type: ignore
+        session = nodes.get_current_session()
+        for (rel, start, end), future in zip(chunks, futures):
+            items = m.get_rels(rel)[start:end]
+            for item, (code, helpers, needs_indent, end_indent_level) in zip(items, future.result()):
+                reusable = self.needs_indent and self.indent_level == indent_level
+                for kind, h in helpers.items():
+                    if not session.get_emitted_helpers(kind).isdisjoint(h):
+                        reusable = False
+                if not reusable:
+                    self.write_module_item(rel, item)
+                    continue
+                self.out.write(code)
+                self.needs_indent = needs_indent
+                self.indent_level = end_indent_level
+                for kind, h in helpers.items():
+                    session.get_emitted_helpers(kind).update(h)
+
     def write_multiline_comment(self, comment: str):
         lines = comment.split("\n")
         for line in lines:
@@ -129,42 +263,10 @@ class CodeWriter:
         raise NotImplementedError
     
     def write_node(self, n: "Node"): # type: ignore
-        if n.node_type == nodes.NodeType.ALIAS:
-            self.write_alias(n)
-        elif n.node_type == nodes.NodeType.ARRAY:
-            self.write_array(n)
-        elif n.node_type == nodes.NodeType.ATTRIBUTE:
-            self.write_attribute(n)
-        elif n.node_type == nodes.NodeType.BINOP:
-            self.write_binop(n)
-        elif n.node_type == nodes.NodeType.EXPR_STMT:
-            self.write_expr_stmt(n)
-        elif n.node_type == nodes.NodeType.CONSTANT:
-            self.write_constant(n)
-        elif n.node_type == nodes.NodeType.FUNCALL:
-            self.write_funcall(n)
-        elif n.node_type == nodes.NodeType.FUNCTION:
-            self.write_function(n)
-        elif n.node_type == nodes.NodeType.INDEX:
-            self.write_index(n)
-        elif n.node_type == nodes.NodeType.LOOP:
-            self.write_loop(n)
-        elif n.node_type == nodes.NodeType.MODULE:
-            self.write_module(n)
-        elif n.node_type == nodes.NodeType.NAME:
-            self.write_name(n)
-        elif n.node_type == nodes.NodeType.POINTER:
-            self.write_pointer(n)
-        elif n.node_type == nodes.NodeType.RETURN:
-            self.write_return(n)
-        elif n.node_type == nodes.NodeType.SET:
-            self.write_set(n)
-        elif n.node_type == nodes.NodeType.STRUCT:
-            self.write_struct(n)
-        elif n.node_type == nodes.NodeType.VARIABLE:
-            self.write_variable(n)
-        else:
+        w = self.node_writers.get(n.node_type)
+        if w is None:
             raise ValueError(f"Cannot write node of type \"{n.node_type}\"")
+        w(self, n)
 
     def write_pointer(self, r: "Pointer"): # type: ignore
         raise NotImplementedError
@@ -192,3 +294,5 @@ class CodeWriter:
 
     def write_zero_value_for_type(self, type: Optional["typs.Type"] = None): # type: ignore
         raise NotImplementedError
+
+CodeWriter.build_node_writers()
@@ -1,4 +1,8 @@
+import hashlib
 import io
+import itertools
+import threading
+from collections import OrderedDict
 from typing import Any, Callable, Optional, TextIO, TypeVar, Union
 
 from numpy import isin
@@ -9,11 +13,121 @@ TypeRef = str
 
 Code = str
 class CodeOptions:
-    def __init__(self, standalone: bool = False, struct_annotations: bool = False, auto_entry_points: bool = False) -> None:
+    def __init__(self, standalone: bool = False, struct_annotations: bool = False, auto_entry_points: bool = False, emit_workers: int = 0, opt_level: int = 0, passes: tuple = ()) -> None:
+        if opt_level not in (0, 1, 2, 3):
+            raise ValueError(f"Invalid optimization level {opt_level}, expected 0 to 3")
         self.standalone = standalone
         self.struct_annotations = struct_annotations
         self.auto_entry_points = auto_entry_points
-        self.entry_points = []
+        self.emit_workers = emit_workers # processes that write large modules, or 0 to write serially
+        self.opt_level = opt_level
+        self.passes = tuple(passes) # extra compiler.Pass objects to run
+
+node_id_block_size = 1 << 16
+node_id_blocks = itertools.count(0)
+
+class CompileSession:
+    """Owns the state that building and compiling nodes mutate outside the
+    nodes themselves: node id allocation, the helpers writers have already
+    emitted, and the options. Each thread has its own stack of sessions."""
+    def __init__(self, options: Optional[CodeOptions] = None):
+        self.options = options if options is not None else CodeOptions()
+        self.lock = threading.Lock()
+        self.node_ids = iter(())
+        self.node_ids_end = 0
+        self.emitted_helpers: dict[str, set] = {}
+    def new_node_id(self) -> int:
+        # Ids come from blocks reserved for this session so they stay unique across sessions
+        id = next(self.node_ids, None)
+        if id is None or id >= self.node_ids_end:
+            with self.lock:
+                start = next(node_id_blocks) * node_id_block_size + 1
+                self.node_ids = itertools.count(start + 1)
+                self.node_ids_end = start + node_id_block_size
+            id = start
+        return id
+    def get_emitted_helpers(self, kind: str) -> set:
+        with self.lock:
+            return self.emitted_helpers.setdefault(kind, set())
+    def __enter__(self) -> "CompileSession":
+        stack = getattr(session_stacks, "stack", None)
+        if stack is None:
+            stack = session_stacks.stack = []
+        stack.append(self)
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        session_stacks.stack.pop()
+
+session_stacks = threading.local()
+default_session = CompileSession()
+
+def get_entered_session() -> Optional[CompileSession]:
+    stack = getattr(session_stacks, "stack", None)
+    return stack[-1] if stack else None
+
+def get_current_session() -> CompileSession:
+    stack = getattr(session_stacks, "stack", None)
+    return stack[-1] if stack else default_session
+
+class CodeCache:
+    """Generated code by the tree's fingerprint, the language and the options.
+    The least recently used entries are dropped after max_size."""
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self.entries: OrderedDict[tuple, tuple[str, dict[str, set]]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    def get_key(self, node: "Node", language: Optional[Any], options: CodeOptions, session: CompileSession) -> tuple:
+        lang_key = language if language is None or isinstance(language, str) else language.name
+        options_key = tuple(sorted(vars(options).items()))
+        # Writers skip helpers the session has already emitted
+        helpers_key = tuple(sorted((kind, frozenset(h)) for kind, h in session.emitted_helpers.items() if len(h) > 0))
+        # Resolution is kept on the nodes, so the same tree can write differently after it's resolved again
+        return (node.fingerprint(), lang_key, options_key, helpers_key, node.resolve_generation)
+    def get_code(self, node: "Node", language: Optional[Any], options: CodeOptions, session: CompileSession, write: Optional[Callable[[TextIO], None]] = None) -> str:
+        # Only trees whose edits are tracked by their compile state are cached
+        key = self.get_key(node, language, options, session) if node.compile_state is not None else None
+        if key is not None:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+            if entry is not None:
+                code, emitted = entry
+                for kind, h in emitted.items():
+                    session.get_emitted_helpers(kind).update(h)
+                return code
+        before = {kind: set(h) for kind, h in session.emitted_helpers.items()}
+        out = io.StringIO()
+        if write is not None:
+            write(out)
+        else:
+            node.write_code_in_session(out, language, options)
+        code = out.getvalue()
+        with self.lock:
+            self.misses += 1
+        if node.compile_state is not None:
+            emitted = {}
+            for kind, h in session.emitted_helpers.items():
+                new_h = h - before.get(kind, set())
+                if len(new_h) > 0:
+                    emitted[kind] = new_h
+            key = self.get_key(node, language, options, session)
+            with self.lock:
+                self.entries[key] = (code, emitted)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        return code
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+code_cache = CodeCache()
 
 class NodeType:
     ADDRESS = 'address'
@@ -30,6 +144,7 @@ class NodeType:
     FUNCTION_TYPE = 'function_type'
     INDEX = 'index'
     INTEGER = 'integer'
+    LET = 'let'
     LOOP = 'loop'
     MEMBER = 'member'
     MODULE = 'module'
@@ -47,47 +162,522 @@ class NodeType:
     VOID = 'void'
     VECTOR = 'vector'
 
-next_node_id = 1
+node_types = [v for k, v in vars(NodeType).items() if k.isupper()]
+
+visit_epochs = itertools.count(1)
+visit_stamps_lock = threading.Lock()
+
+class VisitMarks:
+    """Remembers which nodes a traversal has visited by stamping the traversal's
+    epoch on the nodes. Only one traversal can own the stamps at a time, so
+    nested and concurrent traversals fall back to a set of node ids."""
+    __slots__ = ("epoch", "ids")
+    def __init__(self):
+        if visit_stamps_lock.acquire(blocking=False):
+            self.epoch = next(visit_epochs)
+            self.ids = None
+        else:
+            self.epoch = 0
+            self.ids = set()
+    def mark(self, node: "Node") -> bool:
+        """Marks the node visited and returns whether it already was"""
+        if self.ids is None:
+            if node._visit_epoch == self.epoch:
+                return True
+            node._visit_epoch = self.epoch
+            return False
+        if node.id in self.ids:
+            return True
+        self.ids.add(node.id)
+        return False
+    def release(self):
+        if self.ids is None and self.epoch != 0:
+            self.epoch = 0
+            visit_stamps_lock.release()
+
+class ReachabilityIndex:
+    """The nodes reachable from a root grouped by node type. Each node counts
+    the links that reach it from other reachable nodes so that unlinking only
+    drops the nodes that are no longer reachable any other way."""
+    __slots__ = ("counts", "by_type")
+    def __init__(self, root: "Node"):
+        counts = {root.id: 1}
+        by_type: dict[str, dict[int, "Node"]] = {}
+        stack = [root]
+        while len(stack) > 0:
+            node = stack.pop()
+            nodes = by_type.get(node.node_type)
+            if nodes is None:
+                nodes = by_type[node.node_type] = {}
+            elif node.id in nodes:
+                continue
+            nodes[node.id] = node
+            links = node.links
+            for i in range(len(links) - 1, -1, -1):
+                child = links[i][1]
+                counts[child.id] = counts.get(child.id, 0) + 1
+                stack.append(child)
+        self.counts = counts
+        self.by_type = by_type
+    def add_link(self, child: "Node"):
+        counts = self.counts
+        stack = [child]
+        while len(stack) > 0:
+            node = stack.pop()
+            n = counts.get(node.id, 0)
+            counts[node.id] = n + 1
+            if n == 0:
+                nodes = self.by_type.get(node.node_type)
+                if nodes is None:
+                    nodes = self.by_type[node.node_type] = {}
+                nodes[node.id] = node
+                links = node.links
+                for i in range(len(links) - 1, -1, -1):
+                    stack.append(links[i][1])
+    def remove_link(self, child: "Node"):
+        counts = self.counts
+        stack = [child]
+        while len(stack) > 0:
+            node = stack.pop()
+            n = counts.get(node.id, 0) - 1
+            if n > 0:
+                counts[node.id] = n
+            elif n == 0:
+                del counts[node.id]
+                del self.by_type[node.node_type][node.id]
+                for rel, c in node.links:
+                    stack.append(c)
+    def find(self, node_type: NodeType) -> list["Node"]:
+        nodes = self.by_type.get(node_type)
+        if nodes is None:
+            return []
+        return list(nodes.values())
+
+def fingerprint_value(value) -> str:
+    if isinstance(value, (list, tuple)):
+        return "[" + ",".join(fingerprint_value(x) for x in value) + "]"
+    if isinstance(value, Node):
+        return value.fingerprint().hex()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return f"{type(value).__name__}:{value!r}"
+    return f"{type(value).__name__}:{value}"
+
+slot_names: dict[type, tuple[str, ...]] = {}
 
-class Node:
+def get_slot_names(cls: type) -> tuple[str, ...]:
+    names = slot_names.get(cls)
+    if names is None:
+        ns = []
+        for c in cls.__mro__:
+            s = c.__dict__.get("__slots__", ())
+            for name in ((s,) if isinstance(s, str) else s):
+                if name not in ns and name != "__weakref__":
+                    ns.append(name)
+        names = slot_names[cls] = tuple(ns)
+    return names
+
+class NodeAttr:
+    def __init__(self, default_value=None):
+        self.default_value = default_value
+    def __set_name__(self, owner: "Node", name: str):
+        self.name = name
+        self.private_name = f"_{name}"
+    def __get__(self, obj: "Node", objtype=None):
+        if obj is None:
+            return self
+        return getattr(obj, self.private_name, self.default_value)
+    def __set__(self, obj: "Node", value):
+        if obj.frozen:
+            raise ValueError(f"Cannot change {self.name} of shared {repr(obj.node_type)} node")
+        old_value = getattr(obj, self.private_name, self.default_value)
+        setattr(obj, self.private_name, value)
+        if obj._fingerprint is not None:
+            obj.invalidate_fingerprint()
+        if self.name == "name" and isinstance(obj.last_backlink, Block):
+            obj.last_backlink.rename_symbol(obj, old_value)
+        if obj._tracked:
+            obj.record_change()
+
+class NodeLinks:
+    is_multi = True
+    def __init__(self):
+        self.rel = None
+    def __set_name__(self, owner: "Node", name: str):
+        self.rel = name
+        self.private_name = f"_{name}"
+    def __get__(self, obj: "Node", objtype=None) -> tuple["Node", ...]:
+        if obj is None:
+            return self
+        return obj.get_rels(self.rel)
+    def __set__(self, obj: "Node", value: list["Node"]):
+        obj.unlink_rel(self.rel)
+        for child in value:
+            obj.link(child, self.rel)
+
+class NodeLink:
+    is_multi = False
+    def __init__(self):
+        self.rel = None
+    def __set_name__(self, owner: "Node", name: str):
+        self.rel = name
+        self.private_name = f"_{name}"
+    def __get__(self, obj: "Node", objtype=None) -> "Node":
+        if obj is None:
+            return self
+        return getattr(obj, self.private_name, None)
+    def __set__(self, obj: "Node", value: Optional["Node"]):
+        if getattr(obj, self.private_name, None) is not None:
+            obj.unlink_rel(self.rel)
+        if value is not None:
+            obj.link(value, self.rel)
+
+class NodeMeta(type):
+    """Gives every node class __slots__ for its attributes and relations and
+    records them in the class-level `node_attrs` and `node_rels` registries."""
+    def __new__(mcls, name, bases, ns):
+        slots = list(ns.get("__slots__", ()))
+        for k, v in ns.items():
+            if isinstance(v, (NodeAttr, NodeLink, NodeLinks)):
+                private_name = f"_{k}"
+                if not any(hasattr(b, private_name) for b in bases):
+                    slots.append(private_name)
+        ns["__slots__"] = tuple(slots)
+        cls = super().__new__(mcls, name, bases, ns)
+        attrs = {}
+        rels = {}
+        for b in reversed(cls.__mro__):
+            for k, v in vars(b).items():
+                if isinstance(v, NodeAttr):
+                    attrs[k] = v
+                elif isinstance(v, (NodeLink, NodeLinks)):
+                    rels[k] = v
+        cls.node_attrs = tuple(attrs.values())
+        cls.node_rels = rels
+        return cls
+
+class Node(metaclass=NodeMeta):
+    __slots__ = ("id", "node_type", "last_backlink", "resolved_type", "resolved_node", "_rel_order", "_other_rels", "_visit_epoch", "_fingerprint", "frozen", "_tracked")
+    fingerprint_slots: tuple[str, ...] = () # plain slots that are part of the node's content
+    reachability_index: Optional[ReachabilityIndex] = None # only blocks keep one
+    compile_state: Optional["compiler.CompileState"] = None # only blocks keep one # type: ignore
+    resolve_generation = 0 # counts the compiles of a block that resolved something
     def __init__(self, type: str):
-        global next_node_id
-        self.id = next_node_id
-        next_node_id += 1
+        self.id = get_current_session().new_node_id()
         self.node_type = type
-        self.attributes: dict[str, "NodeAttr"] = {}
-        self.links: list[tuple[str, "Node"]] = []
         self.last_backlink: Optional["Node"] = None
         self.resolved_type = None # all nodes get typed
         self.resolved_node = None # some nodes (name, type_name) get resolved to a node
+        self._rel_order: Optional[list] = None # runs of links to a relation as [rel, count, rel, count, ...] in link order
+        self._other_rels: Optional[dict[str, list["Node"]]] = None # relations without a NodeLink(s) descriptor
+        self._visit_epoch = 0
+        self._fingerprint: Optional[bytes] = None
+        self.frozen = False # shared leaves like builtin types are immutable and keep no backlinks
+        self._tracked = False # a block above keeps a reachability index or compile state
+    @property
+    def attributes(self) -> dict[str, "NodeAttr"]:
+        return {a.name: a for a in self.node_attrs if hasattr(self, a.private_name)}
+    @property
+    def links(self) -> list[tuple[str, "Node"]]:
+        links = []
+        if self._rel_order is None:
+            return links
+        rels = self.node_rels
+        positions: dict[str, int] = {}
+        it = iter(self._rel_order)
+        for rel in it:
+            n = next(it)
+            d = rels.get(rel)
+            if d is not None and not d.is_multi:
+                links.append((rel, getattr(self, d.private_name)))
+                continue
+            children = self._get_rels(rel)
+            if n == len(children):
+                # The relation's only run
+                for child in children:
+                    links.append((rel, child))
+                continue
+            i = positions.get(rel, 0)
+            positions[rel] = i + n
+            for child in children[i:i + n]:
+                links.append((rel, child))
+        return links
     def append_backlink(self, backlink: "Node", rel: str):
-        if backlink == self:
+        if backlink is self or self.frozen:
             return
-        self.last_backlink = backlink
-    def get_rels(self, rel: str) -> list["Node"]:
-        return [child for (crel, child) in self.links if crel == rel]
+        # The first parent owns the node until it unlinks it, so linking a node into
+        # scratch trees (like support definitions) doesn't pull it out of its own tree
+        if self.last_backlink is None:
+            self.last_backlink = backlink
+    def get_rels(self, rel: str) -> tuple["Node", ...]:
+        """The relation's children. Change them with link, unlink_rel or the relation's setter."""
+        return tuple(self._get_rels(rel))
+    def _get_rels(self, rel: str) -> list["Node"]:
+        """The node's own list of the relation's children, which mustn't be changed"""
+        d = self.node_rels.get(rel)
+        if d is None:
+            if self._other_rels is None:
+                return []
+            return self._other_rels.get(rel, [])
+        v = getattr(self, d.private_name, None)
+        if v is None:
+            return []
+        if d.is_multi:
+            return v
+        return [v]
     def get_rel(self, rel: str) -> Optional["Node"]:
-        cs = self.get_rels(rel)
-        return cs[0] if len(cs) > 0 else None
+        d = self.node_rels.get(rel)
+        if d is None or d.is_multi:
+            cs = self._get_rels(rel)
+            return cs[0] if len(cs) > 0 else None
+        return getattr(self, d.private_name, None)
     def link(self, child: "Node", rel: str) -> "Node":
-        if child is None:
-            raise ValueError(f"Cannot link {repr(self.node_type)} node to None (rel={rel})")
         if not isinstance(child, Node):
+            if child is None:
+                raise ValueError(f"Cannot link {repr(self.node_type)} node to None (rel={rel})")
             raise ValueError(f"Cannot link {repr(self.node_type)} node to {repr(child)} (rel={rel})")
-        self.links.append((rel, child))
+        if self.frozen:
+            raise ValueError(f"Cannot link to shared {repr(self.node_type)} node (rel={rel})")
+        d = self.node_rels.get(rel)
+        if d is None:
+            if self._other_rels is None:
+                self._other_rels = {}
+            self._other_rels.setdefault(rel, []).append(child)
+        else:
+            cur = getattr(self, d.private_name, None)
+            if d.is_multi:
+                if cur is None:
+                    setattr(self, d.private_name, [child])
+                else:
+                    cur.append(child)
+            elif cur is None:
+                setattr(self, d.private_name, child)
+            else:
+                raise ValueError(f"Cannot link a second child to {repr(self.node_type)} node (rel={rel})")
+        order = self._rel_order
+        if order is None:
+            self._rel_order = [rel, 1]
+        elif order[-2] == rel:
+            order[-1] += 1
+        else:
+            order.extend((rel, 1))
         child.append_backlink(self, rel)
+        if self._fingerprint is not None:
+            self.invalidate_fingerprint()
+        if self._tracked:
+            child.track_changes()
+            self.update_reachability_indexes(child, True)
+            self.record_change(added=child)
         return self
-    def find_reachable_with_type(self, node_type: NodeType, visited=None) -> list["Node"]:
-        if visited is None:
-            visited = set()
-        if self.id in visited:
-            return []
-        visited.add(self.id)
+    def unlink_rel(self, rel: str) -> list["Node"]:
+        if self.frozen:
+            raise ValueError(f"Cannot unlink from shared {repr(self.node_type)} node (rel={rel})")
+        d = self.node_rels.get(rel)
+        if d is None:
+            if self._other_rels is None or rel not in self._other_rels:
+                return []
+            children = self._other_rels.pop(rel)
+        else:
+            v = getattr(self, d.private_name, None)
+            if v is None:
+                return []
+            children = v if d.is_multi else [v]
+            setattr(self, d.private_name, None)
+        old_order = self._rel_order
+        order = []
+        for j in range(0, len(old_order), 2):
+            if old_order[j] != rel:
+                order.extend(old_order[j:j + 2])
+        self._rel_order = order if len(order) > 0 else None
+        if self._fingerprint is not None:
+            self.invalidate_fingerprint()
+        if self._tracked:
+            self.record_change(removed=children)
+        for ch in children:
+            if ch.last_backlink is self:
+                ch.last_backlink = None
+            if self._tracked:
+                self.update_reachability_indexes(ch, False)
+        return children
+    def track_changes(self):
+        """Makes edits of the subtree update the indexes and compile states above it.
+        Descendants of tracked nodes are tracked, so marking stops at them."""
+        stack = [self]
+        while len(stack) > 0:
+            n = stack.pop()
+            if n._tracked:
+                continue
+            n._tracked = True
+            for _, c in n.links:
+                stack.append(c)
+    def record_change(self, added: Optional["Node"] = None, removed: Optional[list["Node"]] = None):
+        """Tells the compile states of the roots above this node what changed"""
+        seen = set()
+        p = self
+        while p is not None and p.id not in seen:
+            seen.add(p.id)
+            state = p.compile_state
+            if state is not None and not state.compiling:
+                state.changed[self.id] = self
+                if added is not None:
+                    state.added[added.id] = added
+                if removed is not None:
+                    state.removed.extend(removed)
+            p = p.last_backlink
+    def update_reachability_indexes(self, child: "Node", linked: bool):
+        # Shared nodes only update the indexes along their last_backlink chain
+        seen = set()
+        p = self
+        while p is not None and p.id not in seen:
+            seen.add(p.id)
+            index = p.reachability_index
+            if index is not None and self.id in index.counts:
+                if linked:
+                    index.add_link(child)
+                else:
+                    index.remove_link(child)
+            p = p.last_backlink
+    def shallow_copy(self) -> "Node":
+        """Copies the node with its own relation lists but the same children.
+        The children keep their backlinks."""
+        c = object.__new__(type(self))
+        for name in get_slot_names(type(self)):
+            if hasattr(self, name):
+                setattr(c, name, getattr(self, name))
+        c.id = get_current_session().new_node_id()
+        c.frozen = False
+        c.last_backlink = None
+        c._visit_epoch = 0
+        c._tracked = False
+        if self.resolved_type is self:
+            c.resolved_type = c
+        if self._rel_order is not None:
+            c._rel_order = list(self._rel_order)
+        if self._other_rels is not None:
+            c._other_rels = {rel: list(children) for rel, children in self._other_rels.items()}
+        for d in self.node_rels.values():
+            if d.is_multi and getattr(self, d.private_name, None) is not None:
+                setattr(c, d.private_name, list(getattr(self, d.private_name)))
+        return c
+    def remap_children(self, copies: dict[int, "Node"]):
+        """Replaces the children that have copies, keyed by the original's id"""
+        for rel in dict.fromkeys(self._rel_order[::2] if self._rel_order is not None else ()):
+            d = self.node_rels.get(rel)
+            if d is not None and not d.is_multi:
+                child = getattr(self, d.private_name)
+                c = copies.get(child.id)
+                if c is not None:
+                    setattr(self, d.private_name, c)
+                    c.last_backlink = self
+                continue
+            children = getattr(self, d.private_name) if d is not None else self._other_rels[rel]
+            for i, child in enumerate(children):
+                c = copies.get(child.id)
+                if c is not None:
+                    children[i] = c
+                    c.last_backlink = self
+    def replace_child(self, old: "Node", new: "Node"):
+        self.remap_children({old.id: new})
+    def clone(self, keep_resolution: bool = False) -> "Node":
+        """Copies the subtree with fresh resolution state, or with resolution
+        pointing at the copies if keep_resolution. Frozen nodes are shared."""
+        copies: dict[int, Node] = {}
+        originals = []
+        stack = [self]
+        while len(stack) > 0:
+            n = stack.pop()
+            if n.id in copies or n.frozen:
+                continue
+            c = n.shallow_copy()
+            if not keep_resolution:
+                if c.resolved_type is not c:
+                    c.resolved_type = None
+                c.resolved_node = None
+            copies[n.id] = c
+            originals.append(n)
+            for rel, child in n.links:
+                stack.append(child)
+        for n in originals:
+            c = copies[n.id]
+            c.remap_children(copies)
+            if keep_resolution:
+                if c.resolved_type is not None:
+                    c.resolved_type = copies.get(c.resolved_type.id, c.resolved_type)
+                if c.resolved_node is not None:
+                    c.resolved_node = copies.get(c.resolved_node.id, c.resolved_node)
+        return copies[self.id]
+    def fingerprint(self) -> bytes:
+        """A digest of the subtree's node types, attributes and links that
+        ignores node ids and resolution state. Cached until the subtree changes."""
+        if self._fingerprint is not None:
+            return self._fingerprint
+        active = set()
+        stack = [(self, False)]
+        while len(stack) > 0:
+            node, children_done = stack.pop()
+            if node._fingerprint is not None:
+                continue
+            if children_done:
+                node._fingerprint = node.compute_fingerprint()
+                active.discard(node.id)
+                continue
+            if node.id in active:
+                continue
+            active.add(node.id)
+            stack.append((node, True))
+            for rel, child in node.links:
+                if child._fingerprint is None and child.id not in active:
+                    stack.append((child, False))
+        return self._fingerprint
+    def compute_fingerprint(self) -> bytes:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f"{type(self).__name__}:{self.node_type}(".encode())
+        for a in self.node_attrs:
+            if hasattr(self, a.private_name):
+                h.update(f"{a.name}={fingerprint_value(getattr(self, a.private_name))};".encode())
+        for name in self.fingerprint_slots:
+            h.update(f"{name}={fingerprint_value(getattr(self, name, None))};".encode())
+        for rel, child in self.links:
+            h.update(f"{rel}:".encode())
+            # Links back into a cycle have no fingerprint yet
+            h.update(child._fingerprint or b"cycle")
+        h.update(b")")
+        return h.digest()
+    def invalidate_fingerprint(self):
+        n = self
+        while n is not None and n._fingerprint is not None:
+            n._fingerprint = None
+            n = n.last_backlink
+    def freeze(self):
+        """Makes the subtree immutable so it can be shared by any number of trees"""
+        stack = [self]
+        while len(stack) > 0:
+            n = stack.pop()
+            if n.frozen:
+                continue
+            n.frozen = True
+            n.last_backlink = None
+            for rel, child in n.links:
+                stack.append(child)
+    def structurally_equals(self, other: "Node") -> bool:
+        return self is other or (isinstance(other, Node) and self.fingerprint() == other.fingerprint())
+    def find_reachable_with_type(self, node_type: NodeType) -> list["Node"]:
+        if self.reachability_index is not None:
+            return self.reachability_index.find(node_type)
         reachable = []
-        if self.node_type == node_type:
-            reachable.append(self)
-        for rel, link in self.links:
-            reachable.extend(link.find_reachable_with_type(node_type, visited=visited))
+        marks = VisitMarks()
+        try:
+            stack = [self]
+            while len(stack) > 0:
+                node = stack.pop()
+                if marks.mark(node):
+                    continue
+                if node.node_type == node_type:
+                    reachable.append(node)
+                links = node.links
+                for i in range(len(links) - 1, -1, -1):
+                    stack.append(links[i][1])
+        finally:
+            marks.release()
         return reachable
     def write_node(self, out, depth, rel):
         if depth > 5:
@@ -96,12 +686,14 @@ class Node:
         indent = "    " * depth
         out.write(f"{indent}({self.node_type} (")
         head = ""
-        for k, a in self.attributes.items():
-            out.write(f"{head}{a.name}={repr(getattr(self, a.private_name))}")
-            head = " "
-        if len(self.links) > 0:
+        for a in self.node_attrs:
+            if hasattr(self, a.private_name):
+                out.write(f"{head}{a.name}={repr(getattr(self, a.private_name))}")
+                head = " "
+        links = self.links
+        if len(links) > 0:
             out.write(")\n")
-            for crel, child in self.links:
+            for crel, child in links:
                 child.write_node(out, depth + 1, crel)
             out.write(f"{indent})\n")
         else:
@@ -112,21 +704,19 @@ class Node:
         return out.getvalue()
     def __repr__(self):
         return str(self)
-    def lookup_variable(self, name: str, visited=None) -> Optional["Variable"]:
-        if visited is None:
-            visited = set()
-        if self.id in visited:
-            return None
-        visited.add(self.id)
-        v = self.do_lookup_variable(name)
-        if v is not None:
-            return v
-        p = self.last_backlink
-        while p is not None:
-            if isinstance(p, Node):
-                return p.lookup_variable(name, visited)
-            else:
-                return None
+    def lookup_variable(self, name: str) -> Optional["Variable"]:
+        marks = VisitMarks()
+        try:
+            p = self
+            while p is not None:
+                if marks.mark(p):
+                    return None
+                v = p.do_lookup_variable(name)
+                if v is not None:
+                    return v
+                p = p.last_backlink
+        finally:
+            marks.release()
         return None
     def do_lookup_variable(self, name: str) -> Optional["Variable"]:
         return None
@@ -134,35 +724,59 @@ class Node:
         raise NotImplementedError(f"resolve_type not implemented for {self.node_type}")
     def get_support_definitions(self, defs: "compiler.SupportDefinitions"): # type: ignore
         pass
-    def write_code(self, out: Union[str, TextIO], language: Optional[Any] = None, options: Optional[CodeOptions] = None):
+    def write_code(self, out: Union[str, TextIO], language: Optional[Any] = None, options: Optional[CodeOptions] = None, session: Optional[CompileSession] = None):
+        if session is None:
+            session = get_entered_session()
+        if session is None:
+            # Every top-level write gets its own session so helpers are emitted the same way each time
+            session = CompileSession(options)
+        with session:
+            return self.write_code_in_session(out, language, options if options is not None else session.options)
+    def write_code_in_session(self, out: Union[str, TextIO], language: Optional[Any], options: CodeOptions):
         from alang.compiler import Compiler
         from alang.langs.writer import CodeWriter
         if isinstance(out, CodeWriter):
-            writer = out
-            needs_close = False
-            options = writer.options
-            language = writer.language
-        else:
-            language = langs.get_language(language)
-            writer = language.open_writer(out, options)
-            needs_close = True
-            options = writer.options
+            options = out.options
         compiler = Compiler(self, options)
         compiler.compile()
-        options.entry_points = compiler.entry_points
-        try:
-            for s in compiler.support_definitions:
-                writer.write_support_node(s)
-            writer.write_node(self)
-            writer.write_diags(compiler.diags.messages)
-        finally:
-            if needs_close:
-                writer.close()
-    def get_code(self, language: Optional[Any] = None, options: Optional[CodeOptions] = None) -> str:
-        out = io.StringIO()
-        self.write_code(out, language, options)
-        code = out.getvalue()
-        return code
+        return compiler.write_code(out, language)
+    def get_code(self, language: Optional[Any] = None, options: Optional[CodeOptions] = None, session: Optional[CompileSession] = None) -> str:
+        if session is None:
+            session = get_entered_session()
+        if session is None:
+            session = CompileSession(options)
+        with session:
+            return code_cache.get_code(self, language, options if options is not None else session.options, session)
+    def get_codes(self, languages: list[Any], options: Optional[CodeOptions] = None, session: Optional[CompileSession] = None) -> list[str]:
+        """Gets the code for each language, compiling at most once"""
+        from alang.compiler import Compiler
+        if session is None:
+            session = get_entered_session()
+        compiler = None
+        def write(out: TextIO, language: Any, options: CodeOptions):
+            nonlocal compiler
+            if compiler is None:
+                compiler = Compiler(self, options)
+                compiler.compile()
+            compiler.write_code_in_session(out, language)
+        codes = []
+        for language in languages:
+            # Like get_code, each language gets its own session unless one is entered
+            s = session if session is not None else CompileSession(options)
+            with s:
+                o = options if options is not None else s.options
+                codes.append(code_cache.get_code(self, language, o, s, lambda out: write(out, language, o)))
+        return codes
+    def to_bytes(self) -> bytes:
+        from alang.serialize import dumps
+        return dumps(self)
+    @staticmethod
+    def from_bytes(data: bytes) -> "Node":
+        from alang.serialize import loads
+        node = loads(data)
+        if not isinstance(node, Node):
+            raise ValueError("Data does not hold a node")
+        return node
     @property
     def code(self) -> str:
         return self.get_code("a")
@@ -179,122 +793,44 @@ class Node:
     def wgsl_code(self) -> str:
         return self.get_code("wgsl")
     
-class NodeAttr:
-    def __init__(self, default_value=None):
-        self.default_value = default_value
-    def __set_name__(self, owner: Node, name: str):
-        self.name = name
-        self.private_name = f"_{name}"
-    def __get__(self, obj: Node, objtype=None):
-        if hasattr(obj, self.private_name):
-            return getattr(obj, self.private_name)
-        return self.default_value
-    def __set__(self, obj: Node, value):
-        obj.attributes[self.name] = self
-        setattr(obj, self.private_name, value)
-
-class NodeLinks:
-    def __init__(self):
-        self.rel = None
-    def __set_name__(self, owner: Node, name: str):
-        self.rel = name
-    def __get__(self, obj: Node, objtype=None) -> list[Node]:
-        return obj.get_rels(self.rel)
-    def __set__(self, obj: Node, value: list[Node]):
-        i = 0
-        while i < len(obj.links):
-            if obj.links[i][0] == self.rel:
-                ch = obj.links.pop(i)[1]
-                ch.last_backlink = None
-            else:
-                i += 1
-        for child in value:
-            obj.link(child, self.rel)
-
-class NodeLink:
-    def __init__(self):
-        self.rel = None
-    def __set_name__(self, owner: Node, name: str):
-        self.rel = name
-    def __get__(self, obj: Node, objtype=None) -> list[Node]:
-        return obj.get_rel(self.rel)
-    def __set__(self, obj: Node, value: Optional[Node]):
-        i = 0
-        while i < len(obj.links):
-            if obj.links[i][0] == self.rel:
-                ch = obj.links.pop(i)[1]
-                ch.last_backlink = None
-            else:
-                i += 1
-        if value is not None:
-            obj.link(value, self.rel)
-
 class Visitor:
     def __init__(self):
-        self.visited = set()
+        self.marks: Optional[VisitMarks] = None
+        self.num_visited = 0
+    def begin_visit(self) -> bool:
+        """Starts tracking visited nodes unless a visit is already in progress.
+        Returns whether this call started it and so must call end_visit."""
+        if self.marks is not None:
+            return False
+        self.marks = VisitMarks()
+        return True
+    def end_visit(self):
+        self.marks.release()
+        self.marks = None
     def mark_visited(self, node: Node):
-        already_visited = node.id in self.visited
-        self.visited.add(node.id)
-        return already_visited
+        if self.marks.mark(node):
+            return True
+        self.num_visited += 1
+        return False
     def visit(self, node: Node, parent: Node, rel: str, acc):
         raise NotImplementedError()
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.build_visit_table()
+    @classmethod
+    def build_visit_table(cls):
+        cls.visit_table = {}
+        for node_type in node_types:
+            cls.visit_table[node_type] = getattr(cls, f"visit_{node_type}", cls.visit_missing)
     def visit_node(self, node: Node, parent: Node, rel: str, acc):
-        if node.node_type == NodeType.ALIAS:
-            return self.visit_alias(node, parent, rel, acc)
-        elif node.node_type == NodeType.ARRAY:
-            return self.visit_array(node, parent, rel, acc)
-        elif node.node_type == NodeType.ATTRIBUTE:
-            return self.visit_attribute(node, parent, rel, acc)
-        elif node.node_type == NodeType.BINOP:
-            return self.visit_binop(node, parent, rel, acc)
-        elif node.node_type == NodeType.CONSTANT:
-            return self.visit_constant(node, parent, rel, acc)
-        elif node.node_type == NodeType.EXPR_STMT:
-            return self.visit_expr_stmt(node, parent, rel, acc)
-        elif node.node_type == NodeType.FIELD:
-            return self.visit_field(node, parent, rel, acc)
-        elif node.node_type == NodeType.FLOAT:
-            return self.visit_float(node, parent, rel, acc)
-        elif node.node_type == NodeType.FUNCALL:
-            return self.visit_funcall(node, parent, rel, acc)
-        elif node.node_type == NodeType.FUNCTION:
-            return self.visit_function(node, parent, rel, acc)
-        elif node.node_type == NodeType.INDEX:
-            return self.visit_index(node, parent, rel, acc)
-        elif node.node_type == NodeType.INTEGER:
-            return self.visit_integer(node, parent, rel, acc)
-        elif node.node_type == NodeType.LOOP:
-            return self.visit_loop(node, parent, rel, acc)
-        elif node.node_type == NodeType.MEMBER:
-            return self.visit_member(node, parent, rel, acc)
-        elif node.node_type == NodeType.MODULE:
-            return self.visit_module(node, parent, rel, acc)
-        elif node.node_type == NodeType.NAME:
-            return self.visit_name(node, parent, rel, acc)
-        elif node.node_type == NodeType.PARAMETER:
-            return self.visit_parameter(node, parent, rel, acc)
-        elif node.node_type == NodeType.POINTER:
-            return self.visit_pointer(node, parent, rel, acc)
-        elif node.node_type == NodeType.RETURN:
-            return self.visit_return(node, parent, rel, acc)
-        elif node.node_type == NodeType.SET:
-            return self.visit_set(node, parent, rel, acc)
-        elif node.node_type == NodeType.STRUCT:
-            return self.visit_struct(node, parent, rel, acc)
-        elif node.node_type == NodeType.SWIZZLE:
-            return self.visit_swizzle(node, parent, rel, acc)
-        elif node.node_type == NodeType.TENSOR:
-            return self.visit_tensor(node, parent, rel, acc)
-        elif node.node_type == NodeType.VARIABLE:
-            return self.visit_variable(node, parent, rel, acc)
-        elif node.node_type == NodeType.VECTOR:
-            return self.visit_vector(node, parent, rel, acc)
-        elif node.node_type == NodeType.VOID:
-            return self.visit_void(node, parent, rel, acc)
-        else:
-            missing_code = f"elif node.node_type == NodeType.{node.node_type.upper()}:\n    return self.visit_{node.node_type.lower()}(node, parent, rel, acc)"
-            print(missing_code)
-            return acc
+        f = self.visit_table.get(node.node_type)
+        if f is None:
+            return self.visit_missing(node, parent, rel, acc)
+        return f(self, node, parent, rel, acc)
+    def visit_missing(self, node: Node, parent: Node, rel: str, acc):
+        missing_code = f"def visit_{node.node_type.lower()}(self, node: Node, parent: Node, rel: str, acc):\n    return acc"
+        print(missing_code)
+        return acc
     def visit_address(self, node: "Address", parent: Node, rel: str, acc): # type: ignore
         return acc
     def visit_alias(self, node: "Alias", parent: Node, rel: str, acc): # type: ignore
@@ -313,12 +849,16 @@ class Visitor:
         return acc
     def visit_float(self, node: "Float", parent: Node, rel: str, acc): # type: ignore
         return acc
+    def visit_let(self, node: "Let", parent: Node, rel: str, acc): # type: ignore
+        return acc
     def visit_loop(self, node: "Loop", parent: Node, rel: str, acc): # type: ignore
         return acc
     def visit_funcall(self, node: "Funcall", parent: Node, rel: str, acc): # type: ignore
         return acc
     def visit_function(self, node: "Function", parent: Node, rel: str, acc): # type: ignore
         return acc
+    def visit_function_type(self, node: "FunctionType", parent: Node, rel: str, acc): # type: ignore
+        return acc
     def visit_index(self, node: "Index", parent: Node, rel: str, acc): # type: ignore
         return acc
     def visit_integer(self, node: "Integer", parent: Node, rel: str, acc): # type: ignore
@@ -327,6 +867,8 @@ class Visitor:
         return acc
     def visit_module(self, node: "Module", parent: Node, rel: str, acc):
         return acc
+    def visit_module_type(self, node: "ModuleType", parent: Node, rel: str, acc): # type: ignore
+        return acc
     def visit_name(self, node: "Name", parent: Node, rel: str, acc): # type: ignore
         return acc
     def visit_parameter(self, node: "Parameter", parent: Node, rel: str, acc): # type: ignore
@@ -343,6 +885,8 @@ class Visitor:
         return acc
     def visit_tensor(self, node: "Tensor", parent: Node, rel: str, acc): # type: ignore
         return acc
+    def visit_type_name(self, node: "TypeName", parent: Node, rel: str, acc): # type: ignore
+        return acc
     def visit_variable(self, node: "Variable", parent: Node, rel: str, acc):
         return acc
     def visit_vector(self, node: "Vector", parent: Node, rel: str, acc): # type: ignore
@@ -350,26 +894,87 @@ class Visitor:
     def visit_void(self, node: "Void", parent: Node, rel: str, acc): # type: ignore
         return acc
     
+Visitor.build_visit_table()
+
 class DepthFirstVisitor(Visitor):
     def __init__(self):
         super().__init__()
     def visit(self, node: Node, parent: Node, rel: str, acc):
-        if self.mark_visited(node):
-            return acc
-        sacc = []
-        for crel, child in node.links:
-            sacc.append((crel, self.visit(child, node, crel, acc)))
-        return self.visit_node(node, parent, rel, sacc)
+        started = self.begin_visit()
+        try:
+            if self.mark_visited(node):
+                return acc
+            # Each frame is [node, parent, rel, links, next link index, child results]
+            stack = [[node, parent, rel, node.links, 0, []]]
+            result = acc
+            while len(stack) > 0:
+                frame = stack[-1]
+                links = frame[3]
+                i = frame[4]
+                if i < len(links):
+                    frame[4] = i + 1
+                    crel, child = links[i]
+                    if child.frozen or self.mark_visited(child):
+                        frame[5].append((crel, acc))
+                    else:
+                        stack.append([child, frame[0], crel, child.links, 0, []])
+                else:
+                    stack.pop()
+                    result = self.visit_node(frame[0], frame[1], frame[2], frame[5])
+                    if len(stack) > 0:
+                        stack[-1][5].append((frame[2], result))
+            return result
+        finally:
+            if started:
+                self.end_visit()
+
+class DepthFirstWalker(Visitor):
+    """A post-order visitor for passes that don't use child results.
+    Handlers get `None` for `acc` and nothing is accumulated."""
+    def __init__(self):
+        super().__init__()
+    def visit(self, node: Node, parent: Node, rel: str, acc=None):
+        started = self.begin_visit()
+        try:
+            # Entries are (node, parent, rel, children_done)
+            stack = [(node, parent, rel, False)]
+            while len(stack) > 0:
+                n, p, r, children_done = stack.pop()
+                if children_done:
+                    self.visit_node(n, p, r, None)
+                    continue
+                if self.mark_visited(n):
+                    continue
+                stack.append((n, p, r, True))
+                links = n.links
+                for i in range(len(links) - 1, -1, -1):
+                    crel, child = links[i]
+                    if not child.frozen:
+                        stack.append((child, n, crel, False))
+        finally:
+            if started:
+                self.end_visit()
 
 class BreadthFirstVisitor(Visitor):
     def __init__(self):
         super().__init__()
     def visit(self, node: Node, parent: Node, rel: str, acc):
-        if self.mark_visited(node):
-            return acc
-        cacc = self.visit_node(node, parent, rel, acc)
-        for crel, child in node.links:
-            self.visit(child, node, crel, cacc)
+        started = self.begin_visit()
+        try:
+            stack = [(node, parent, rel, acc)]
+            while len(stack) > 0:
+                n, p, r, a = stack.pop()
+                if self.mark_visited(n):
+                    continue
+                cacc = self.visit_node(n, p, r, a)
+                links = n.links
+                for i in range(len(links) - 1, -1, -1):
+                    crel, child = links[i]
+                    if not child.frozen:
+                        stack.append((child, n, crel, cacc))
+        finally:
+            if started:
+                self.end_visit()
 
 class Expression(Node):
     def __init__(self, node_type: NodeType):
@@ -404,7 +1009,25 @@ class Statement(Node):
     def __init__(self, node_type: NodeType):
         super().__init__(node_type)
 
+class Scope:
+    """One link of a scope chain: a block's names, then the scopes around it"""
+    __slots__ = ("block", "parent")
+    def __init__(self, block: "Block", parent: Optional["Scope"]):
+        self.block = block
+        self.parent = parent
+    def lookup(self, name: str) -> Optional[Node]:
+        s = self
+        while s is not None:
+            n = s.block.lookup_name(name)
+            if n is not None:
+                return n
+            s = s.parent
+        return None
+
 class Block(Node):
+    __slots__ = ("can_define_types", "can_define_functions", "can_define_variables", "can_define_statements", "reachability_index", "symbols", "compile_state", "resolve_generation")
+    symbol_rels = ("types", "variables", "functions", "parameters")
+    scope_rels: tuple[str, ...] = () # relations whose names are in scope in the block, innermost first
     types = NodeLinks()
     variables = NodeLinks()
     functions: list["funcs.Functions"] = NodeLinks() # type: ignore
@@ -415,10 +1038,103 @@ class Block(Node):
         self.can_define_functions = can_define_functions
         self.can_define_variables = can_define_variables
         self.can_define_statements = can_define_statements
+        self.reachability_index = None
+        self.compile_state = None
+        self.resolve_generation = 0
+        self.symbols: Optional[dict[str, dict[str, list[Node]]]] = None # relation -> name -> nodes, in link order
+    def link(self, child: Node, rel: str) -> "Block":
+        super().link(child, rel)
+        if rel in self.symbol_rels:
+            self.add_symbol(rel, child)
+        elif rel == "statements" and child.node_type == NodeType.LET:
+            self.add_symbol("lets", child)
+        return self
+    def add_symbol(self, rel: str, child: Node):
+        name = getattr(child, "name", None)
+        if isinstance(name, str):
+            if self.symbols is None:
+                self.symbols = {}
+            self.symbols.setdefault(rel, {}).setdefault(name, []).append(child)
+    def rename_symbol(self, child: Node, old_name: Any):
+        if self.symbols is None:
+            return
+        for rel, names in self.symbols.items():
+            nodes = names.get(old_name)
+            if nodes is not None and child in nodes:
+                nodes.remove(child)
+                if len(nodes) == 0:
+                    del names[old_name]
+                self.add_symbol(rel, child)
+    def rebuild_symbols(self):
+        self.symbols = None
+        for rel in self.symbol_rels:
+            for child in self._get_rels(rel):
+                self.add_symbol(rel, child)
+        for child in self._get_rels("statements"):
+            if child.node_type == NodeType.LET:
+                self.add_symbol("lets", child)
+    def unlink_rel(self, rel: str) -> list[Node]:
+        children = super().unlink_rel(rel)
+        if rel == "statements":
+            rel = "lets"
+        if self.symbols is not None and rel in self.symbols:
+            names = self.symbols[rel]
+            for child in children:
+                nodes = names.get(getattr(child, "name", None))
+                if nodes is not None and child in nodes:
+                    nodes.remove(child)
+                    if len(nodes) == 0:
+                        del names[child.name]
+        return children
+    def shallow_copy(self) -> "Block":
+        c = super().shallow_copy()
+        c.reachability_index = None
+        c.compile_state = None
+        if self.symbols is not None:
+            c.symbols = {rel: {name: list(nodes) for name, nodes in names.items()} for rel, names in self.symbols.items()}
+        return c
+    def remap_children(self, copies: dict[int, Node]):
+        super().remap_children(copies)
+        if self.symbols is not None:
+            for names in self.symbols.values():
+                for nodes in names.values():
+                    for i, n in enumerate(nodes):
+                        c = copies.get(n.id)
+                        if c is not None:
+                            nodes[i] = c
+    def get_symbols(self, rel: str, name: str) -> list[Node]:
+        if self.symbols is None:
+            return []
+        names = self.symbols.get(rel)
+        if names is None:
+            return []
+        return names.get(name, [])
+    def lookup_name(self, name: str) -> Optional[Node]:
+        if self.symbols is None:
+            return None
+        for rel in self.scope_rels:
+            names = self.symbols.get(rel)
+            if names is not None and name in names:
+                return names[name][-1]
+        return None
+    def lookup_type(self, name: str) -> Optional["Type"]: # type: ignore
+        p = self
+        while p is not None:
+            if isinstance(p, Block):
+                ts = p.get_symbols("types", name)
+                if len(ts) > 0:
+                    return ts[0]
+            p = p.last_backlink
+        return None
+    def find_reachable_with_type(self, node_type: NodeType) -> list["Node"]:
+        if self.reachability_index is None:
+            self.reachability_index = ReachabilityIndex(self)
+            self.track_changes()
+        return self.reachability_index.find(node_type)
     def do_lookup_variable(self, name: str) -> Optional["Variable"]:
-        for v in self.variables:
-            if v.name == name:
-                return v
+        vs = self.get_symbols("variables", name)
+        if len(vs) > 0:
+            return vs[0]
         return None
     def parse_type(self, expr: Optional[Code]) -> Optional["Type"]: # type: ignore
         from alang.typs import parse_type
@@ -545,6 +1261,7 @@ class AccessMode:
 
 class Module(Block):
     name = NodeAttr()
+    scope_rels = ("variables", "functions")
 
     def __init__(self, name: str, can_define_statements: bool = False):
         super().__init__(NodeType.MODULE, can_define_types=True, can_define_functions=True, can_define_variables=True, can_define_statements=can_define_statements)
@@ -554,6 +1271,16 @@ class Module(Block):
     def get_default_address_space(self) -> Optional[str]:
         return AddressSpace.PRIVATE
 
+    def __enter__(self) -> "Module":
+        stack = getattr(module_stacks, "stack", None)
+        if stack is None:
+            stack = module_stacks.stack = []
+        stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        module_stacks.stack.pop()
+
     def resolve_type(self, diags: "compiler.Diagnostics") -> "typs.Type": # type: ignore
         from alang.typs import ModuleType
         return ModuleType(self.name)
@@ -574,6 +1301,8 @@ def get_default_access_mode_for_address_space(address_space: str) -> str:
 
 class Variable(Node):
     # https://www.w3.org/TR/WGSL/#var-decls
+    __slots__ = ("bind_group", "binding")
+    fingerprint_slots = ("bind_group", "binding")
     name = NodeAttr()
     variable_type = NodeLink()
     initial_value = NodeLink()
@@ -609,11 +1338,86 @@ class Variable(Node):
             return None
         return self.variable_type.resolved_type
 
+class CopyLayer:
+    __slots__ = ("copies", "parent")
+    def __init__(self, parent: Optional["CopyLayer"]):
+        self.copies: dict[int, Node] = {} # original id -> copy
+        self.parent = parent
+
+class Snapshot:
+    """A copy-on-write view of a node tree. Cloning a snapshot is O(1) and
+    editing a node copies just it and its ancestors, so other snapshots that
+    share the tree never see the change. Nodes returned by edit stay private
+    to the snapshot until it is cloned again."""
+    def __init__(self, root: Node, copies: Optional[CopyLayer] = None):
+        self.root = root
+        self.copies = CopyLayer(copies)
+        self.owned: set[int] = set()
+        self.materialized: Optional[tuple[bytes, Node]] = None # the root's fingerprint and its copy
+    def clone(self) -> "Snapshot":
+        frozen = self.copies
+        self.copies = CopyLayer(frozen)
+        self.owned = set()
+        return Snapshot(self.root, frozen)
+    def current(self, node: Node) -> Node:
+        """The snapshot's version of a node from any tree it was derived from"""
+        while True:
+            layer = self.copies
+            c = None
+            while layer is not None and c is None:
+                c = layer.copies.get(node.id)
+                layer = layer.parent
+            if c is None:
+                return node
+            node = c
+    def edit(self, node: Node) -> Node:
+        """Returns the snapshot's private, editable copy of the node"""
+        self.materialized = None
+        node = self.current(node)
+        path = []
+        n = node
+        while n.id not in self.owned:
+            path.append(n)
+            if n is self.root:
+                break
+            if n.last_backlink is None:
+                raise ValueError(f"Cannot edit {repr(node.node_type)} node that is not in the snapshot")
+            n = self.current(n.last_backlink)
+        parent = n if n.id in self.owned else None
+        for original in reversed(path):
+            c = original.shallow_copy()
+            self.copies.copies[original.id] = c
+            self.owned.add(c.id)
+            if parent is None:
+                self.root = c
+            else:
+                parent.replace_child(original, c)
+            parent = c
+        return parent
+    def materialize(self) -> Node:
+        """A private copy of the tree with its own resolution state for compiling.
+        It's reused until the snapshot's tree changes."""
+        key = self.root.fingerprint()
+        m = self.materialized
+        if m is None or m[0] != key:
+            m = self.materialized = (key, self.root.clone())
+        return m[1]
+    def write_code(self, out: Union[str, TextIO], language: Optional[Any] = None, options: Optional[CodeOptions] = None, session: Optional[CompileSession] = None):
+        return self.materialize().write_code(out, language, options, session)
+    def get_code(self, language: Optional[Any] = None, options: Optional[CodeOptions] = None, session: Optional[CompileSession] = None) -> str:
+        return self.materialize().get_code(language, options, session)
+
 global_module = Module("global", can_define_statements=True)
+module_stacks = threading.local()
+
+def get_current_module() -> Module:
+    """The module entered most recently on this thread, or the global module"""
+    stack = getattr(module_stacks, "stack", None)
+    return stack[-1] if stack else global_module
 
 def define(name: str, *parameters: list) -> Node:
-    return global_module.define(name, *parameters)
+    return get_current_module().define(name, *parameters)
 
 def loop(var: str, count, body = None) -> Node:
-    return global_module.loop(var, count, body)
+    return get_current_module().loop(var, count, body)
 
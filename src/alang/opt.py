@@ -0,0 +1,1351 @@
+import math
+import struct
+from typing import Optional
+
+from alang.compiler import Compiler, Pass, iter_post_order, iter_subtree, register_pass
+from alang.funcs import Function
+from alang.nodes import Block, Node, NodeType, Variable
+import alang.exprs as exprs
+from alang.typs import Integer, byte_type, int_type, sbyte_type, short_type, ushort_type
+import alang.stmts as stmts
+
+int_min = -(1 << 31)
+int_max = (1 << 31) - 1
+# struct formats of the float sizes narrower than a Python float
+float_formats = {16: "e", 32: "f"}
+
+def get_rel_of(parent: Node, child: Node) -> Optional[str]:
+    for rel, c in parent.links:
+        if c is child:
+            return rel
+    return None
+
+def detach(node: Node):
+    """Unlinks the node from its owner so it can be linked somewhere else"""
+    parent = node.last_backlink
+    if parent is None:
+        return
+    rel = get_rel_of(parent, node)
+    if rel is None:
+        return
+    children = parent.unlink_rel(rel)
+    d = parent.node_rels.get(rel)
+    if d is None or d.is_multi:
+        for c in children:
+            if c is not node:
+                parent.link(c, rel)
+
+def replace_node(old: Node, new: Node):
+    """Puts new where old is linked in its owner"""
+    parent = old.last_backlink
+    rel = get_rel_of(parent, old)
+    d = parent.node_rels.get(rel)
+    if d is not None and not d.is_multi:
+        setattr(parent, rel, new)
+        return
+    children = parent.unlink_rel(rel)
+    for c in children:
+        parent.link(new if c is old else c, rel)
+
+def get_written_name(target: Node) -> Optional[Node]:
+    """The name a Set target writes through, like x in x[i].y"""
+    while target is not None:
+        if target.node_type == NodeType.NAME:
+            return target
+        if target.node_type == NodeType.INDEX:
+            target = target.base
+        elif target.node_type == NodeType.ATTRIBUTE:
+            target = target.target
+        else:
+            return None
+    return None
+
+def has_calls(node: Optional[Node]) -> bool:
+    if node is None:
+        return False
+    return any(n.node_type == NodeType.FUNCALL for n in iter_subtree(node))
+
+class DeadCodeEliminationPass(Pass):
+    """Removes the module's functions, types and variables that the roots don't
+    reach, and assignments to local variables that are never read. The roots are
+    the named functions or else the entry points. Without either the module is
+    a library and only dead assignments are removed."""
+    name = "dce"
+    requires = ("resolve",)
+    opt_level = 1
+    changes_tree = True
+    def __init__(self, roots: tuple[str, ...] = ()):
+        self.roots = tuple(roots)
+    def get_roots(self, compiler: Compiler) -> list[Node]:
+        ast = compiler.ast
+        if len(self.roots) > 0:
+            roots = []
+            for name in self.roots:
+                fs = ast.get_symbols("functions", name)
+                if len(fs) == 0:
+                    raise ValueError(f"Root function {name} not found")
+                roots.extend(fs)
+            return roots
+        # The entry points found by resolve are in the caller's tree
+        compiler.find_entry_points()
+        return [f for f, stage, auto_f in compiler.entry_points]
+    def find_reachable(self, roots: list[Node]) -> set[int]:
+        reached: set[int] = set()
+        stack = list(roots)
+        while len(stack) > 0:
+            n = stack.pop()
+            if n.frozen or n.id in reached:
+                continue
+            reached.add(n.id)
+            for rel, child in n.links:
+                stack.append(child)
+            if n.resolved_type is not None:
+                stack.append(n.resolved_type)
+            if n.node_type == NodeType.NAME and n.resolved_node is not None:
+                stack.append(n.resolved_node)
+        return reached
+    def prune_module(self, m: Block, reached: set[int]) -> int:
+        num_removed = 0
+        for rel in ("types", "variables", "functions"):
+            items = m.get_rels(rel)
+            live = [x for x in items if x.id in reached]
+            if len(live) < len(items):
+                m.unlink_rel(rel)
+                for x in live:
+                    m.link(x, rel)
+                num_removed += len(items) - len(live)
+        return num_removed
+    def remove_dead_sets(self, f: Function) -> int:
+        """Removes local variables that are never read and the assignments
+        to them. Reads that only compute dead values don't count."""
+        nodes = list(iter_subtree(f))
+        for n in nodes:
+            if n.node_type == NodeType.NAME and n.resolved_node is None:
+                # It could be a read of any of them
+                return 0
+        local_ids = set(v.id for v in f.variables)
+        # The subtrees that compute each local's values
+        defs: dict[int, list[Node]] = {v.id: [] for v in f.variables}
+        for v in f.variables:
+            if v.initial_value is not None:
+                defs[v.id].append(v.initial_value)
+        sets = []
+        for n in nodes:
+            if n.node_type == NodeType.SET:
+                w = get_written_name(n.target)
+                if w is not None and w.resolved_node.id in local_ids:
+                    defs[w.resolved_node.id].append(n)
+                    sets.append((n, w))
+        write_ids = set(w.id for s, w in sets)
+        in_defs = set()
+        stack = []
+        for vid, trees in defs.items():
+            for t in trees:
+                if has_calls(t):
+                    # The call has to stay and so does its variable
+                    stack.append(vid)
+                else:
+                    in_defs.update(x.id for x in iter_subtree(t))
+        for n in nodes:
+            if n.node_type == NodeType.NAME and n.id not in in_defs and n.id not in write_ids:
+                stack.append(n.resolved_node.id)
+        live = set()
+        while len(stack) > 0:
+            vid = stack.pop()
+            if vid in live or vid not in local_ids:
+                continue
+            live.add(vid)
+            for t in defs[vid]:
+                for n in iter_subtree(t):
+                    if n.node_type == NodeType.NAME and n.id not in write_ids:
+                        stack.append(n.resolved_node.id)
+        dead = local_ids - live
+        if len(dead) == 0:
+            return 0
+        dead_sets = [s for s, w in sets if w.resolved_node.id in dead]
+        dead_set_ids = set(s.id for s in dead_sets)
+        blocks = {}
+        for s in dead_sets:
+            blocks[s.last_backlink.id] = s.last_backlink
+        for b in blocks.values():
+            b.statements = [s for s in b.statements if s.id not in dead_set_ids]
+        f.variables = [v for v in f.variables if v.id not in dead]
+        return len(dead) + len(dead_sets)
+    def run(self, compiler: Compiler) -> bool:
+        ast = compiler.ast
+        num_removed = 0
+        if ast.node_type == NodeType.MODULE:
+            roots = self.get_roots(compiler)
+            if len(roots) > 0:
+                num_removed += self.prune_module(ast, self.find_reachable(roots))
+        for f in ast.find_reachable_with_type(NodeType.FUNCTION):
+            num_removed += self.remove_dead_sets(f)
+        compiler.stats.get_pass(self.name).add_iteration(num_removed, 0)
+        return num_removed > 0
+
+def trunc_div(a: int, b: int) -> int:
+    """Integer division that rounds toward zero like the target languages"""
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+def round_float(v: float, bits: int) -> Optional[float]:
+    """v rounded to the nearest float of the given size, or None if it's out of range"""
+    if not math.isfinite(v):
+        return None
+    fmt = float_formats.get(bits)
+    if fmt is None:
+        return v
+    try:
+        v = struct.unpack(fmt, struct.pack(fmt, v))[0]
+    except OverflowError:
+        return None
+    return v if math.isfinite(v) else None
+
+def fold_values(op: str, a, b, float_bits: int = 32):
+    """The value of a op b as the target would compute it, or None if it can't be
+    computed here exactly. Floats are computed in double precision and rounded to
+    float_bits, which gives the same result as the target's single operation."""
+    if type(a) is not type(b) or type(a) not in (int, float):
+        return None
+    if type(a) is float:
+        a = round_float(a, float_bits)
+        b = round_float(b, float_bits)
+        if a is None or b is None:
+            return None
+        if op == "add":
+            v = a + b
+        elif op == "sub":
+            v = a - b
+        elif op == "mul":
+            v = a * b
+        elif op == "div" and b != 0.0:
+            v = a / b
+        else:
+            return None
+        return round_float(v, float_bits)
+    if op == "add":
+        v = a + b
+    elif op == "sub":
+        v = a - b
+    elif op == "mul":
+        v = a * b
+    elif op == "div" or op == "mod":
+        if b == 0:
+            return None
+        v = trunc_div(a, b) if op == "div" else a - b * trunc_div(a, b)
+    elif op == "shl" or op == "shr":
+        if b < 0 or b >= 32 or (op == "shl" and a < 0):
+            return None
+        v = a << b if op == "shl" else a >> b
+    elif op == "band":
+        v = a & b
+    elif op == "bor":
+        v = a | b
+    elif op == "xor":
+        v = a ^ b
+    elif op == "and":
+        v = int(a != 0 and b != 0)
+    elif op == "or":
+        v = int(a != 0 or b != 0)
+    elif op == "lt":
+        v = int(a < b)
+    elif op == "le":
+        v = int(a <= b)
+    elif op == "gt":
+        v = int(a > b)
+    elif op == "ge":
+        v = int(a >= b)
+    elif op == "eq":
+        v = int(a == b)
+    elif op == "ne":
+        v = int(a != b)
+    else:
+        # matmul is of tensors
+        return None
+    if v < int_min or v > int_max:
+        return None
+    return v
+
+def get_constant(node: Node):
+    if node.node_type != NodeType.CONSTANT:
+        return None
+    v = node.value
+    return v if type(v) in (int, float) else None
+
+def is_integer(node: Node) -> bool:
+    if node.node_type == NodeType.CONSTANT:
+        return type(node.value) is int
+    t = node.resolved_type
+    if t is not None:
+        return isinstance(t, Integer)
+    if node.node_type == NodeType.NAME:
+        r = node.resolved_node
+        if r is not None and r.node_type == NodeType.LET:
+            return r.let_type is not None and isinstance(r.let_type, Integer)
+        # Loop counters are integers even in unresolved support definitions
+        p = node.last_backlink
+        while p is not None:
+            if p.node_type == NodeType.LOOP and p.var == node.name:
+                return True
+            p = p.last_backlink
+        return False
+    if node.node_type == NodeType.BINOP:
+        return node.operator.name not in ("matmul", "div") and is_integer(node.left) and is_integer(node.right)
+    return False
+
+def is_float(node: Node) -> bool:
+    if node.node_type == NodeType.CONSTANT:
+        return type(node.value) is float
+    t = node.resolved_type
+    return t is not None and t.is_float
+
+# Chains whose constant terms are gathered into one
+chain_ops = {"add": "sub", "sub": "add", "mul": None, "band": None, "bor": None, "xor": None}
+
+class ConstantFoldingPass(Pass):
+    """Folds operations on constants, removes identities like x * 1, and gathers
+    the constant terms of integer chains like (x + 1) + (y + 2) into x + y + 3.
+    Float expressions are only simplified where the result is exactly the same."""
+    name = "fold"
+    requires = ("resolve",)
+    opt_level = 1
+    changes_tree = True
+    transforms_support_definitions = True
+    def get_terms(self, node: Node, op: str, sign: int, terms: list[tuple[int, Node]], constants: list):
+        """Flattens a chain of op into signed terms and constant values"""
+        if node.node_type == NodeType.BINOP and is_integer(node):
+            nop = node.operator.name
+            if nop == op or (op == "add" and nop == "sub"):
+                self.get_terms(node.left, op, sign, terms, constants)
+                self.get_terms(node.right, op, -sign if nop == "sub" else sign, terms, constants)
+                return
+        v = get_constant(node)
+        if v is not None:
+            constants.append((sign, v, len(terms)))
+        else:
+            terms.append((sign, node))
+    def simplify_chain(self, b: "exprs.Binop") -> Optional[Node]:
+        op = b.operator.name
+        if op == "sub":
+            op = "add"
+        terms: list[tuple[int, Node]] = []
+        constants: list = []
+        self.get_terms(b, op, 1, terms, constants)
+        if len(constants) == 0:
+            return None
+        if op == "add":
+            c = sum(sign * v for sign, v, i in constants)
+            identity = 0
+        else:
+            c = constants[0][1]
+            for sign, v, i in constants[1:]:
+                c = fold_values(op, c, v)
+                if c is None:
+                    return None
+            identity = {"mul": 1, "band": -1, "bor": 0, "xor": 0}[op]
+        if c < int_min or c > int_max:
+            return None
+        absorbs = (op == "mul" and c == 0) or (op == "band" and c == 0)
+        if absorbs and any(has_calls(t) for sign, t in terms):
+            return None
+        last = constants[-1][2] == len(terms)
+        if len(constants) == 1 and last and c != identity and not absorbs and (op != "add" or len(terms) == 0 or terms[0][0] > 0):
+            # Already canonical
+            return None
+        for sign, t in terms:
+            detach(t)
+        if absorbs or len(terms) == 0:
+            return exprs.Constant(c)
+        # Start with a positive term so that no negation is needed
+        first = 0
+        for i, (sign, t) in enumerate(terms):
+            if sign > 0:
+                first = i
+                break
+        sign, result = terms[first]
+        if sign < 0:
+            result = exprs.Binop(exprs.Constant(c), "sub", result)
+            c = identity
+        for i, (sign, t) in enumerate(terms):
+            if i != first:
+                result = exprs.Binop(result, "sub" if sign < 0 else op, t)
+        if c != identity:
+            if op == "add" and c < 0:
+                result = exprs.Binop(result, "sub", exprs.Constant(-c))
+            else:
+                result = exprs.Binop(result, op, exprs.Constant(c))
+        return result
+    def simplify(self, b: "exprs.Binop") -> Optional[Node]:
+        """A simpler node for b or None"""
+        op = b.operator.name
+        left, right = b.left, b.right
+        lv = get_constant(left)
+        rv = get_constant(right)
+        if lv is not None and rv is not None:
+            t = b.resolved_type
+            v = fold_values(op, lv, rv, t.bits if t is not None and t.is_float else 32)
+            if v is not None:
+                return exprs.Constant(v)
+        if op in chain_ops and is_integer(b):
+            return self.simplify_chain(b)
+        if rv is None:
+            return None
+        # Identities with a constant on the right that are exact for floats too
+        same_kind = is_integer(left) if type(rv) is int else is_float(left)
+        if not same_kind:
+            return None
+        if (op == "mul" or op == "div") and rv == 1:
+            detach(left)
+            return left
+        if op == "sub" and rv == 0:
+            detach(left)
+            return left
+        if type(rv) is int:
+            if op in ("shl", "shr") and rv == 0:
+                detach(left)
+                return left
+            if op == "mod" and (rv == 1 or rv == -1) and not has_calls(left):
+                return exprs.Constant(0)
+        return None
+    def transform(self, compiler: Compiler, root: Node) -> bool:
+        changed = False
+        for n in list(iter_post_order(root)):
+            if n.node_type != NodeType.BINOP or n.last_backlink is None:
+                continue
+            r = self.simplify(n)
+            if r is not None:
+                replace_node(n, r)
+                changed = True
+        return changed
+    def run(self, compiler: Compiler) -> bool:
+        return self.transform(compiler, compiler.ast)
+
+def count_instructions(root: Node) -> int:
+    """The binops, indexing and calls that running root performs. Bodies of loops
+    with constant counts are counted once per iteration."""
+    count = 0
+    stack = [(root, 1)]
+    while len(stack) > 0:
+        n, times = stack.pop()
+        if n.frozen:
+            continue
+        if n.node_type == NodeType.BINOP or n.node_type == NodeType.INDEX or n.node_type == NodeType.FUNCALL:
+            count += times
+        body_times = times
+        if n.node_type == NodeType.LOOP and n.count is not None:
+            c = get_constant(n.count)
+            if type(c) is int:
+                body_times = times * c
+        for rel, child in n.links:
+            stack.append((child, times if rel == "count" else body_times))
+    return count
+
+# Node types that a pure expression can be made of
+pure_node_types = (NodeType.BINOP, NodeType.CONSTANT, NodeType.NAME, NodeType.INDEX, NodeType.ATTRIBUTE)
+
+def is_pure(node: Node, written: set[str]) -> bool:
+    """Whether node computes the same value wherever it is in a function that
+    assigns the written names"""
+    for n in iter_subtree(node):
+        if n.node_type not in pure_node_types:
+            return False
+        if n.node_type == NodeType.NAME and n.name in written:
+            return False
+        if n.node_type == NodeType.BINOP and n.operator.name == "matmul":
+            return False
+    return True
+
+def get_let_type(node: Node) -> Optional[Node]:
+    if node.resolved_type is not None:
+        return node.resolved_type
+    if is_integer(node):
+        return int_type
+    return None
+
+def get_functions(root: Node) -> list[Node]:
+    if root.node_type == NodeType.FUNCTION:
+        return [root]
+    return root.find_reachable_with_type(NodeType.FUNCTION)
+
+def get_names(f: Node) -> tuple[set[str], set[str]]:
+    """The names the function assigns and all the names it uses"""
+    written = set()
+    used = set()
+    for n in iter_subtree(f):
+        if n.node_type == NodeType.SET:
+            w = get_written_name(n.target)
+            if w is not None:
+                written.add(w.name)
+        name = getattr(n, "name", None)
+        if isinstance(name, str):
+            used.add(name)
+        if n.node_type == NodeType.LOOP:
+            used.add(n.var)
+    return written, used
+
+def is_global(name: Node) -> bool:
+    """Whether the name refers to a variable declared outside any function"""
+    r = name.resolved_node
+    if r is None or r.node_type != NodeType.VARIABLE:
+        return False
+    owner = r.last_backlink
+    return owner is None or owner.node_type != NodeType.FUNCTION
+
+def get_call_written(node: Node, span: Node) -> set[str]:
+    """The module variables node reads that calls in span may assign"""
+    if not has_calls(span):
+        return set()
+    return set(n.name for n in iter_subtree(node) if n.node_type == NodeType.NAME and is_global(n))
+
+def get_fresh_name(prefix: str, used: set[str]) -> str:
+    i = 0
+    while f"{prefix}{i}" in used:
+        i += 1
+    name = f"{prefix}{i}"
+    used.add(name)
+    return name
+
+def bind_let(name: str, value: Node, let_type: Node, refs: list[Node]) -> Node:
+    let = stmts.Let(name, value, let_type)
+    # Support definitions aren't resolved again
+    for ref in refs:
+        ref.resolved_node = let
+    return let
+
+class CommonSubexpressionPass(Pass):
+    """Computes pure expressions that a block repeats once, in a let before their
+    first use. Expressions that read variables the function assigns, or module
+    variables when it makes calls, are left alone, as are loop bodies, which
+    are blocks of their own."""
+    name = "cse"
+    requires = ("resolve",)
+    opt_level = 2
+    changes_tree = True
+    transforms_support_definitions = True
+    def find_repeats(self, block: Block, written: set[str]) -> Optional[list[tuple[int, Node]]]:
+        """The occurrences of the largest expression the block repeats"""
+        occurrences: dict[bytes, list[tuple[int, Node]]] = {}
+        sizes: dict[bytes, int] = {}
+        for i, s in enumerate(block.statements):
+            if s.node_type == NodeType.LOOP:
+                roots = [s.count] if s.count is not None else []
+            else:
+                roots = [s]
+            for root in roots:
+                for n in iter_subtree(root):
+                    if n.node_type != NodeType.BINOP and n.node_type != NodeType.INDEX:
+                        continue
+                    if n.node_type == NodeType.INDEX and n.last_backlink.node_type == NodeType.SET and n.last_backlink.target is n:
+                        continue
+                    key = n.fingerprint()
+                    occurrences.setdefault(key, []).append((i, n))
+                    if key not in sizes:
+                        sizes[key] = sum(1 for x in iter_subtree(n))
+        best = None
+        for key, occs in occurrences.items():
+            if len(occs) < 2 or (best is not None and sizes[key] <= sizes[best]):
+                continue
+            n = occs[0][1]
+            if is_pure(n, written) and get_let_type(n) is not None:
+                best = key
+        return occurrences[best] if best is not None else None
+    def transform(self, compiler: Compiler, root: Node) -> bool:
+        num_lets = 0
+        for f in get_functions(root):
+            written, used = get_names(f)
+            written |= get_call_written(f, f)
+            blocks = [f] + [n for n in iter_subtree(f) if n.node_type == NodeType.LOOP]
+            for b in blocks:
+                while True:
+                    occs = self.find_repeats(b, written)
+                    if occs is None:
+                        break
+                    name = get_fresh_name("cse", used)
+                    first = occs[0][1]
+                    let_type = get_let_type(first)
+                    refs = []
+                    for i, n in occs:
+                        ref = exprs.Name(name)
+                        replace_node(n, ref)
+                        refs.append(ref)
+                    statements = list(b.statements)
+                    i = occs[0][0]
+                    b.statements = statements[:i] + [bind_let(name, first, let_type, refs)] + statements[i:]
+                    num_lets += 1
+        compiler.stats.get_pass(self.name).add_count("lets", num_lets)
+        return num_lets > 0
+    def run(self, compiler: Compiler) -> bool:
+        return self.transform(compiler, compiler.ast)
+
+def get_trip_count(loop: Node) -> Optional[int]:
+    c = get_constant(loop.count) if loop.count is not None else None
+    return c if type(c) is int else None
+
+def count_nodes(nodes: list[Node]) -> int:
+    return sum(sum(1 for n in iter_subtree(root)) for root in nodes)
+
+def insert_statements(block: Block, i: int, statements: list[Node], num_replaced: int = 0):
+    """Puts statements at index i of the block in place of num_replaced statements"""
+    old = list(block.statements)
+    block.statements = old[:i] + statements + old[i + num_replaced:]
+
+class LoopInvariantCodeMotionPass(Pass):
+    """Moves lets and pure expressions that don't change between iterations of a
+    loop to before it, innermost loops first so they can move out of several.
+    Indexing and division are only moved out of loops known to run, and reads
+    of module variables out of loops without calls."""
+    name = "licm"
+    requires = ("resolve",)
+    opt_level = 2
+    changes_tree = True
+    transforms_support_definitions = True
+    def is_invariant(self, node: Node, variant: set[str], written: set[str], runs: bool) -> bool:
+        if not is_pure(node, written):
+            return False
+        for n in iter_subtree(node):
+            if n.node_type == NodeType.NAME and n.name in variant:
+                return False
+            if not runs and (n.node_type == NodeType.INDEX or (n.node_type == NodeType.BINOP and n.operator.name in ("div", "mod"))):
+                return False
+        return True
+    def find_invariants(self, root: Node, variant: set[str], written: set[str], runs: bool) -> list[Node]:
+        """The largest invariant expressions in root"""
+        found = []
+        stack = [root]
+        while len(stack) > 0:
+            n = stack.pop()
+            if n.frozen:
+                continue
+            is_target = n.last_backlink is not None and n.last_backlink.node_type == NodeType.SET and n.last_backlink.target is n
+            if (n.node_type == NodeType.BINOP or n.node_type == NodeType.INDEX) and not is_target and self.is_invariant(n, variant, written, runs) and get_let_type(n) is not None:
+                found.append(n)
+                continue
+            links = n.links
+            for i in range(len(links) - 1, -1, -1):
+                stack.append(links[i][1])
+        return found
+    def hoist(self, loop: Node, written: set[str], used: set[str]) -> int:
+        runs = (get_trip_count(loop) or 0) > 0
+        # Calls in the loop may assign the module variables it reads
+        written = written | get_call_written(loop, loop)
+        variant = {loop.var}
+        hoisted = []
+        lets: dict[bytes, Node] = {}
+        kept = []
+        for s in loop.statements:
+            if s.node_type == NodeType.LET:
+                if self.is_invariant(s.value, variant, written, runs):
+                    hoisted.append(s)
+                else:
+                    variant.add(s.name)
+                    kept.append(s)
+                continue
+            roots = [s.count] if s.node_type == NodeType.LOOP else [s]
+            for root in roots:
+                for e in self.find_invariants(root, variant, written, runs):
+                    key = e.fingerprint()
+                    let = lets.get(key)
+                    let_type = get_let_type(e)
+                    ref = exprs.Name(let.name if let is not None else get_fresh_name("licm", used))
+                    replace_node(e, ref)
+                    if let is None:
+                        let = bind_let(ref.name, e, let_type, [ref])
+                        lets[key] = let
+                        hoisted.append(let)
+                    else:
+                        ref.resolved_node = let
+            kept.append(s)
+        if len(hoisted) == 0:
+            return 0
+        loop.statements = kept
+        parent = loop.last_backlink
+        insert_statements(parent, parent.statements.index(loop), hoisted)
+        return len(hoisted)
+    def transform(self, compiler: Compiler, root: Node) -> bool:
+        num_hoisted = 0
+        for f in get_functions(root):
+            written, used = get_names(f)
+            for loop in [n for n in iter_post_order(f) if n.node_type == NodeType.LOOP]:
+                num_hoisted += self.hoist(loop, written, used)
+        compiler.stats.get_pass(self.name).add_count("hoisted", num_hoisted)
+        return num_hoisted > 0
+    def run(self, compiler: Compiler) -> bool:
+        return self.transform(compiler, compiler.ast)
+
+class LoopUnrollingPass(Pass):
+    """Unrolls loops with constant counts, innermost first. A loop is unrolled
+    fully when all its iterations fit in max_nodes nodes. Otherwise its body is
+    repeated factor times and the leftover iterations follow the loop."""
+    name = "unroll"
+    requires = ("resolve",)
+    opt_level = 3
+    changes_tree = True
+    transforms_support_definitions = True
+    def __init__(self, factor: int = 4, max_nodes: int = 512):
+        if factor < 1:
+            raise ValueError(f"Invalid unroll factor {factor}")
+        self.factor = factor
+        self.max_nodes = max_nodes
+    def copy_body(self, loop: Node, make_index, used: set[str]) -> list[Node]:
+        """The loop's statements with the counter replaced by make_index() and
+        their lets renamed"""
+        copy = loop.clone(keep_resolution=True)
+        nodes = list(iter_subtree(copy))
+        lets = {}
+        for s in copy.statements:
+            if s.node_type == NodeType.LET:
+                lets[s.id] = s
+                s.name = get_fresh_name(f"{s.name}_", used)
+        for n in nodes:
+            if n.node_type != NodeType.NAME:
+                continue
+            r = n.resolved_node
+            if r is copy or (r is None and n.name == loop.var):
+                replace_node(n, make_index())
+            elif r is not None and r.id in lets:
+                n.name = r.name
+        statements = list(copy.statements)
+        copy.statements = []
+        return statements
+    def unroll(self, loop: Node, used: set[str], stats) -> bool:
+        n = get_trip_count(loop)
+        if n is None or n < 0:
+            return False
+        body_size = count_nodes(loop.statements)
+        parent = loop.last_backlink
+        i = parent.statements.index(loop)
+        if n * body_size <= self.max_nodes:
+            statements = []
+            for k in range(n):
+                statements.extend(self.copy_body(loop, lambda: exprs.Constant(k), used))
+            insert_statements(parent, i, statements, 1)
+            stats.add_count("unrolled")
+            return True
+        if self.factor < 2 or n < self.factor or self.factor * body_size > self.max_nodes:
+            return False
+        def make_index(k):
+            counter = exprs.Name(loop.var)
+            counter.resolved_node = loop
+            return exprs.Binop(exprs.Binop(counter, "*", self.factor), "+", k)
+        statements = []
+        for k in range(self.factor):
+            statements.extend(self.copy_body(loop, lambda: make_index(k), used))
+        num_full = n // self.factor
+        leftover = []
+        for k in range(num_full * self.factor, n):
+            leftover.extend(self.copy_body(loop, lambda: exprs.Constant(k), used))
+        loop.statements = statements
+        loop.count = exprs.Constant(num_full)
+        insert_statements(parent, i + 1, leftover)
+        stats.add_count("partially_unrolled")
+        return True
+    def remove_self_sets(self, f: Node):
+        """Removes sets like `s = s` that folding leaves of `s = s + i * x` at i = 0"""
+        sets = [n for n in iter_subtree(f) if n.node_type == NodeType.SET
+                and n.target.node_type == NodeType.NAME and n.value.node_type == NodeType.NAME
+                and n.target.name == n.value.name and n.target.resolved_node is n.value.resolved_node]
+        ids = set(s.id for s in sets)
+        blocks = {s.last_backlink.id: s.last_backlink for s in sets}
+        for b in blocks.values():
+            b.statements = [s for s in b.statements if s.id not in ids]
+    def transform(self, compiler: Compiler, root: Node) -> bool:
+        stats = compiler.stats.get_pass(self.name)
+        changed = False
+        for f in get_functions(root):
+            written, used = get_names(f)
+            unrolled = False
+            for loop in [n for n in iter_post_order(f) if n.node_type == NodeType.LOOP]:
+                if self.unroll(loop, used, stats):
+                    unrolled = True
+            if unrolled:
+                # The copies index with constants
+                ConstantFoldingPass().transform(compiler, f)
+                self.remove_self_sets(f)
+                changed = True
+        return changed
+    def run(self, compiler: Compiler) -> bool:
+        return self.transform(compiler, compiler.ast)
+
+def lookup_local(name: Node) -> Optional[Node]:
+    """What the name refers to in the blocks around it, for trees that aren't resolved"""
+    p = name.last_backlink
+    while p is not None:
+        if isinstance(p, Block):
+            r = p.lookup_name(name.name)
+            if r is not None:
+                return r
+        p = p.last_backlink
+    return None
+
+# The rels of statements whose whole value can be computed by statements before them
+value_rels = {NodeType.RETURN: "value", NodeType.SET: "value", NodeType.LET: "value", NodeType.EXPR_STMT: "expression"}
+
+class InliningPass(Pass):
+    """Replaces calls to small functions, and matmuls, with the bodies of the
+    functions. A callee is inlined when it has at most max_nodes nodes and its
+    caller has grown by less than budget nodes. Arguments that aren't simple
+    are bound to lets, unused ones are dropped unless they make calls, and the
+    callee's locals are renamed when their names are taken. Lets aren't moved
+    ahead of other calls in the statement that could change what they read.
+    Callees with more than a return are only inlined into the values of
+    statements. Functions that are no longer called are removed when the
+    module has entry points."""
+    name = "inline"
+    requires = ("resolve",)
+    opt_level = 2
+    changes_tree = True
+    def __init__(self, max_nodes: int = 128, budget: int = 512):
+        self.max_nodes = max_nodes
+        self.budget = budget
+    def get_callee(self, n: Node, support_functions: dict[str, Node]) -> Optional[tuple[Node, list[Node]]]:
+        if n.node_type == NodeType.FUNCALL:
+            if n.func.node_type != NodeType.NAME:
+                return None
+            f = n.func.resolved_node
+            if f is None or f.node_type != NodeType.FUNCTION:
+                return None
+            return f, list(n.args)
+        if n.node_type == NodeType.BINOP and n.operator.name == "matmul":
+            f = support_functions.get(n.get_support_lib_function_name())
+            if f is None:
+                return None
+            return f, [n.left, n.right]
+        return None
+    def get_statement(self, n: Node) -> Optional[tuple[Block, Node]]:
+        """The statement the node is in and the block the statement is in"""
+        while n.last_backlink is not None:
+            p = n.last_backlink
+            if isinstance(p, Block) and get_rel_of(p, n) == "statements":
+                return p, n
+            n = p
+        return None
+    def can_inline(self, callee: Node) -> bool:
+        if callee.stage is not None or len(callee.statements) == 0:
+            return False
+        returns = [n for n in iter_subtree(callee) if n.node_type == NodeType.RETURN]
+        if len(returns) != 1 or returns[0] is not callee.statements[-1] or returns[0].value is None:
+            return False
+        written = get_names(callee)[0]
+        return all(p.name not in written for p in callee.parameters)
+    def inline(self, call: Node, caller: Node, callee: Node, args: list[Node], used: set[str]) -> bool:
+        context = self.get_statement(call)
+        if context is None:
+            return False
+        block, stmt = context
+        only_return = len(callee.statements) == 1 and len(callee.variables) == 0
+        if not only_return:
+            # The body runs before the statement, which must use the result as is
+            if stmt.node_type not in value_rels or getattr(stmt, value_rels[stmt.node_type]) is not call:
+                return False
+            # Variables are declared once in the caller
+            if len(callee.variables) > 0 and block is not caller:
+                return False
+        body = callee.clone(keep_resolution=True)
+        params = list(body.parameters)
+        if len(params) != len(args):
+            return False
+        nodes = list(iter_subtree(body))
+        refs: list[tuple[Node, Node]] = []
+        locals_ = [n for n in nodes if n.node_type in (NodeType.VARIABLE, NodeType.LET, NodeType.LOOP)]
+        caller_written = get_names(caller)[0]
+        caller_locals = set(p.name for p in caller.parameters)
+        for n in iter_subtree(caller):
+            if n.node_type == NodeType.VARIABLE or n.node_type == NodeType.LET:
+                caller_locals.add(n.name)
+            elif n.node_type == NodeType.LOOP:
+                caller_locals.add(n.var)
+        for n in nodes:
+            if n.node_type != NodeType.NAME:
+                continue
+            r = n.resolved_node if n.resolved_node is not None else lookup_local(n)
+            if r is None or not any(r is x for x in params + locals_):
+                # Names from outside the callee mustn't be hidden by the caller's
+                if n.name in caller_locals:
+                    return False
+                continue
+            refs.append((n, r))
+        for v in body.variables:
+            if v.variable_type is None and v.resolved_type is None:
+                return False
+        # Lets and the body run before the statement, so before its other calls
+        in_call = set(n.id for n in iter_subtree(call))
+        other_calls = any(n.node_type == NodeType.FUNCALL and n.id not in in_call for n in iter_subtree(stmt))
+        if other_calls and not only_return:
+            return False
+        # Arguments are substituted or bound to lets, with their types
+        bindings = []
+        callee_written = get_names(callee)[0]
+        for p, arg in zip(params, args):
+            num_uses = sum(1 for n, r in refs if r is p)
+            if num_uses == 0 and not has_calls(arg):
+                # Nothing reads it and computing it has no effects
+                continue
+            # Calls in the body may assign the module variables the argument reads
+            call_written = get_call_written(arg, body)
+            simple = arg.node_type == NodeType.CONSTANT or (arg.node_type == NodeType.NAME and arg.name not in callee_written and arg.name not in call_written)
+            if simple or (num_uses == 1 and only_return and is_pure(arg, caller_written | call_written)):
+                bindings.append((p, arg, None))
+                continue
+            if other_calls and (has_calls(arg) or len(get_call_written(arg, stmt)) > 0):
+                # The other calls may assign what it reads, or must run before its calls
+                return False
+            let_type = p.resolved_type if p.resolved_type is not None else get_let_type(arg)
+            if let_type is None:
+                return False
+            bindings.append((p, arg, let_type))
+        pre = []
+        substitutes: dict[int, Node] = {}
+        for p, arg, let_type in bindings:
+            if let_type is None:
+                substitutes[p.id] = arg
+                continue
+            name = get_fresh_name(f"{p.name}_", used)
+            ref = exprs.Name(name)
+            replace_node(arg, ref)
+            let = bind_let(name, arg, let_type, [ref])
+            pre.append(let)
+            substitutes[p.id] = let
+        for n in locals_:
+            attr = "var" if n.node_type == NodeType.LOOP else "name"
+            name = getattr(n, attr)
+            if name in used:
+                name = get_fresh_name(f"{name}_", used)
+                setattr(n, attr, name)
+            used.add(name)
+        for n, r in refs:
+            if r.id in substitutes:
+                s = substitutes[r.id]
+                if s.node_type == NodeType.LET:
+                    ref = exprs.Name(s.name)
+                    ref.resolved_node = s
+                else:
+                    ref = s.clone(keep_resolution=True)
+                replace_node(n, ref)
+            else:
+                n.name = r.var if r.node_type == NodeType.LOOP else r.name
+                n.resolved_node = r
+        statements = list(body.statements)
+        variables = list(body.variables)
+        body.statements = []
+        body.variables = []
+        for v in variables:
+            if v.initial_value is not None:
+                init = v.initial_value
+                detach(init)
+                target = exprs.Name(v.name)
+                target.resolved_node = v
+                pre.append(stmts.Set(target, init))
+            if v.variable_type is None:
+                v.variable_type = v.resolved_type
+            caller.link(v, "variables")
+        result = statements[-1].value
+        detach(result)
+        pre.extend(statements[:-1])
+        replace_node(call, result)
+        if len(pre) > 0:
+            insert_statements(block, block.statements.index(stmt), pre)
+        return True
+    def remove_uncalled(self, compiler: Compiler, callees: list[Node]) -> int:
+        m = compiler.ast
+        if m.node_type != NodeType.MODULE:
+            return 0
+        compiler.find_entry_points()
+        if len(compiler.entry_points) == 0:
+            return 0
+        called = set()
+        for n in iter_subtree(m):
+            if n.node_type == NodeType.NAME and n.resolved_node is not None:
+                called.add(n.resolved_node.id)
+        functions = m.functions
+        dead = [f for f in callees if f.id not in called and any(f is g for g in functions)]
+        if len(dead) == 0:
+            return 0
+        m.functions = [f for f in functions if all(f is not d for d in dead)]
+        return len(dead)
+    def run(self, compiler: Compiler) -> bool:
+        ps = compiler.stats.get_pass(self.name)
+        support_functions = {f.name: f for f in compiler.support_definitions if f.node_type == NodeType.FUNCTION}
+        callees = []
+        num_inlined = 0
+        for caller in get_functions(compiler.ast):
+            written, used = get_names(caller)
+            growth = 0
+            for n in list(iter_post_order(caller)):
+                c = self.get_callee(n, support_functions)
+                if c is None:
+                    continue
+                callee, args = c
+                if callee is caller or not self.can_inline(callee):
+                    continue
+                size = count_nodes(list(callee.variables) + list(callee.statements))
+                if size > self.max_nodes or growth + size > self.budget:
+                    continue
+                if self.inline(n, caller, callee, args, used):
+                    growth += size
+                    num_inlined += 1
+                    if all(callee is not x for x in callees):
+                        callees.append(callee)
+        ps.add_count("inlined", num_inlined)
+        if num_inlined > 0:
+            ps.add_count("removed", self.remove_uncalled(compiler, callees))
+        return num_inlined > 0
+
+def get_shift(c) -> Optional[int]:
+    """The shift that multiplies by c when c is a power of two above 1"""
+    if type(c) is int and c > 1 and c & (c - 1) == 0:
+        return c.bit_length() - 1
+    return None
+
+def scale_term(node: Node, c: int) -> Node:
+    if c == 1:
+        return node
+    k = get_shift(c)
+    if k is not None:
+        return exprs.Binop(node, "<<", k)
+    return exprs.Binop(node, "*", c)
+
+def sum_terms(terms: list[tuple[int, Node]], const: int = 0) -> Node:
+    """The sum of the scaled terms and the constant"""
+    e = None
+    for c, t in terms:
+        if c == 0:
+            continue
+        if e is None:
+            e = exprs.Binop(0, "-", scale_term(t, -c)) if c < 0 else scale_term(t, c)
+        elif c < 0:
+            e = exprs.Binop(e, "-", scale_term(t, -c))
+        else:
+            e = exprs.Binop(e, "+", scale_term(t, c))
+    if e is None:
+        return exprs.Constant(const)
+    if const > 0:
+        return exprs.Binop(e, "+", const)
+    if const < 0:
+        return exprs.Binop(e, "-", -const)
+    return e
+
+# What operations cost compared to an add
+op_costs = {"mul": 4, "div": 8, "mod": 8}
+
+def get_cost(node: Node) -> int:
+    return sum(op_costs.get(n.operator.name, 1) for n in iter_subtree(node) if n.node_type == NodeType.BINOP)
+
+class StrengthReductionPass(Pass):
+    """Rewrites integer indices that grow by a constant stride each iteration
+    of a loop into induction variables. They are set before the loop and the
+    stride is added at the end of each iteration. Loops are done innermost
+    first, so the starting value of an inner loop's offset becomes an index
+    of the loop around it. Index multiplications by powers of two become shifts."""
+    name = "sr"
+    requires = ("resolve",)
+    opt_level = 2
+    changes_tree = True
+    transforms_support_definitions = True
+    def get_linear(self, node: Node, loop: Node, variant: set[str], written: set[str]) -> Optional[tuple[int, list[tuple[int, Node]], int]]:
+        """node as the loop counter times a stride plus invariant terms and a constant"""
+        t = node.node_type
+        if t == NodeType.CONSTANT:
+            return (0, [], node.value) if type(node.value) is int else None
+        if t == NodeType.NAME and node.name == loop.var and (node.resolved_node is None or node.resolved_node is loop):
+            return 1, [], 0
+        if t == NodeType.BINOP:
+            op = node.operator.name
+            if op == "add" or op == "sub":
+                l = self.get_linear(node.left, loop, variant, written)
+                r = self.get_linear(node.right, loop, variant, written)
+                if l is None or r is None:
+                    return None
+                sign = 1 if op == "add" else -1
+                return l[0] + sign * r[0], l[1] + [(sign * c, x) for c, x in r[1]], l[2] + sign * r[2]
+            scale = None
+            if op == "mul":
+                for a, b in ((node.left, node.right), (node.right, node.left)):
+                    c = get_constant(b)
+                    if type(c) is int:
+                        scale = c, a
+                        break
+            elif op == "shl":
+                c = get_constant(node.right)
+                if type(c) is int and 0 <= c < 31:
+                    scale = 1 << c, node.left
+            if scale is not None:
+                x = self.get_linear(scale[1], loop, variant, written)
+                if x is None:
+                    return None
+                c = scale[0]
+                return x[0] * c, [(c * tc, tx) for tc, tx in x[1]], x[2] * c
+        # Anything else is a term if it's the same in every iteration
+        if not is_pure(node, written):
+            return None
+        for n in iter_subtree(node):
+            if n.node_type == NodeType.NAME and (n.name in variant or n.name == loop.var):
+                return None
+        return 0, [(1, node)], 0
+    def get_candidates(self, loop: Node, ivs: set[str]) -> list[Node]:
+        found = []
+        for s in loop.statements:
+            if s.node_type == NodeType.LOOP:
+                roots = [s.count]
+            else:
+                roots = [s]
+            for root in roots:
+                for n in iter_subtree(root):
+                    if n.node_type == NodeType.INDEX:
+                        found.extend(r for r in n.ranges if r is not None)
+            if s.node_type == NodeType.LET and is_integer(s.value):
+                found.append(s.value)
+            elif s.node_type == NodeType.SET and s.target.node_type == NodeType.NAME and s.target.name in ivs:
+                found.append(s.value)
+        return found
+    def reduce(self, f: Node, loop: Node, written: set[str], used: set[str], ivs: set[str]) -> int:
+        variant = set(s.name for s in loop.statements if s.node_type == NodeType.LET)
+        # Calls in the loop may assign the module variables it reads
+        loop_written = written | get_call_written(loop, loop)
+        groups: dict[tuple, list[tuple[Node, int]]] = {}
+        forms = {}
+        for e in self.get_candidates(loop, ivs):
+            linear = self.get_linear(e, loop, variant, loop_written)
+            if linear is None or linear[0] == 0:
+                continue
+            stride, terms, const = linear
+            if get_cost(e) - (1 if const != 0 else 0) <= 1:
+                # An add per iteration is no better
+                continue
+            key = (stride, tuple((c, x.fingerprint()) for c, x in terms))
+            groups.setdefault(key, []).append((e, const))
+            forms[key] = (stride, terms)
+        num_ivs = 0
+        parent = loop.last_backlink
+        for key, uses in groups.items():
+            stride, terms = forms[key]
+            name = get_fresh_name("iv", used)
+            ivs.add(name)
+            written.add(name)
+            v = Variable(name, int_type)
+            f.link(v, "variables")
+            def ref() -> Node:
+                r = exprs.Name(name)
+                r.resolved_node = v
+                return r
+            init = sum_terms([(c, x.clone(keep_resolution=True)) for c, x in terms])
+            insert_statements(parent, parent.statements.index(loop), [stmts.Set(ref(), init)])
+            for e, const in uses:
+                if const > 0:
+                    replace_node(e, exprs.Binop(ref(), "+", const))
+                elif const < 0:
+                    replace_node(e, exprs.Binop(ref(), "-", -const))
+                else:
+                    replace_node(e, ref())
+            step = exprs.Binop(ref(), "+" if stride > 0 else "-", abs(stride))
+            loop.statements = list(loop.statements) + [stmts.Set(ref(), step)]
+            num_ivs += 1
+        if num_ivs > 0:
+            self.remove_copies(loop, ivs)
+        return num_ivs
+    def remove_copies(self, loop: Node, ivs: set[str]):
+        """Reads induction variables in place of the lets that became copies of them.
+        They only change at the end of the loop body, after every read."""
+        copies = {s.id: s.value for s in loop.statements if s.node_type == NodeType.LET and s.value.node_type == NodeType.NAME and s.value.name in ivs}
+        if len(copies) == 0:
+            return
+        for n in iter_subtree(loop):
+            if n.node_type == NodeType.NAME and n.resolved_node is not None and n.resolved_node.id in copies:
+                iv = copies[n.resolved_node.id]
+                n.name = iv.name
+                n.resolved_node = iv.resolved_node
+        loop.statements = [s for s in loop.statements if s.id not in copies]
+    def shift_indices(self, f: Node, ivs: set[str]) -> int:
+        roots = []
+        for n in iter_subtree(f):
+            if n.node_type == NodeType.INDEX:
+                roots.extend(r for r in n.ranges if r is not None)
+            elif n.node_type == NodeType.SET and n.target.node_type == NodeType.NAME and n.target.name in ivs:
+                roots.append(n.value)
+        num_shifts = 0
+        for root in roots:
+            for n in list(iter_post_order(root)):
+                if n.node_type != NodeType.BINOP or n.operator.name != "mul" or n.last_backlink is None:
+                    continue
+                for a, b in ((n.left, n.right), (n.right, n.left)):
+                    k = get_shift(get_constant(b))
+                    if k is not None and (is_integer(a) or root.last_backlink.node_type == NodeType.INDEX):
+                        detach(a)
+                        replace_node(n, exprs.Binop(a, "<<", k))
+                        num_shifts += 1
+                        break
+        return num_shifts
+    def transform(self, compiler: Compiler, root: Node) -> bool:
+        ps = compiler.stats.get_pass(self.name)
+        changed = False
+        for f in get_functions(root):
+            written, used = get_names(f)
+            ivs: set[str] = set()
+            num_ivs = 0
+            for loop in [n for n in iter_post_order(f) if n.node_type == NodeType.LOOP]:
+                num_ivs += self.reduce(f, loop, written, used, ivs)
+            if num_ivs > 0:
+                ConstantFoldingPass().transform(compiler, f)
+            num_shifts = self.shift_indices(f, ivs)
+            ps.add_count("induction_variables", num_ivs)
+            ps.add_count("shifts", num_shifts)
+            changed = changed or num_ivs > 0 or num_shifts > 0
+        return changed
+    def run(self, compiler: Compiler) -> bool:
+        return self.transform(compiler, compiler.ast)
+
+class ValueRange:
+    """The integers from lo to hi, inclusive"""
+    __slots__ = ("lo", "hi")
+    def __init__(self, lo: int, hi: int):
+        self.lo = lo
+        self.hi = hi
+    def __eq__(self, other):
+        return isinstance(other, ValueRange) and self.lo == other.lo and self.hi == other.hi
+    def __repr__(self):
+        return f"ValueRange({self.lo}, {self.hi})"
+    def contains(self, other: "ValueRange") -> bool:
+        return self.lo <= other.lo and other.hi <= self.hi
+
+def get_range_op(op: str, a: ValueRange, b: ValueRange) -> Optional[ValueRange]:
+    if op == "add":
+        return ValueRange(a.lo + b.lo, a.hi + b.hi)
+    if op == "sub":
+        return ValueRange(a.lo - b.hi, a.hi - b.lo)
+    if op == "mul":
+        ps = [a.lo * b.lo, a.lo * b.hi, a.hi * b.lo, a.hi * b.hi]
+        return ValueRange(min(ps), max(ps))
+    if b.lo != b.hi:
+        return None
+    c = b.lo
+    if op == "shl" and 0 <= c < 31:
+        return ValueRange(a.lo << c, a.hi << c)
+    if op == "shr" and 0 <= c < 31:
+        return ValueRange(a.lo >> c, a.hi >> c)
+    if a.lo < 0:
+        return None
+    if op == "div" and c > 0:
+        return ValueRange(a.lo // c, a.hi // c)
+    if op == "mod" and c > 0:
+        return ValueRange(0, min(a.hi, c - 1)) if a.hi >= c else a
+    if op == "band" and c >= 0:
+        return ValueRange(0, min(a.hi, c))
+    return None
+
+int_range = ValueRange(int_min, int_max)
+
+class RangeAnalysis:
+    """The ranges of integer expressions. Loop counters run from 0 to their
+    count less one, lets have the range of their values, and operations that
+    could overflow have no range. Ranges are cached until clear is called."""
+    def __init__(self):
+        self.ranges: dict[int, Optional[ValueRange]] = {}
+    def clear(self):
+        self.ranges.clear()
+    def get_range(self, node: Node) -> Optional[ValueRange]:
+        if node.id in self.ranges:
+            return self.ranges[node.id]
+        # Guards against cycles
+        self.ranges[node.id] = None
+        r = self.compute_range(node)
+        if r is not None and not int_range.contains(r):
+            r = None
+        self.ranges[node.id] = r
+        return r
+    def compute_range(self, node: Node) -> Optional[ValueRange]:
+        t = node.node_type
+        if t == NodeType.CONSTANT:
+            v = node.value
+            return ValueRange(v, v) if type(v) is int else None
+        if t == NodeType.NAME:
+            r = node.resolved_node if node.resolved_node is not None else lookup_local(node)
+            if r is None:
+                return None
+            if r.node_type == NodeType.LOOP and r.var == node.name:
+                if r.count is None:
+                    return None
+                count = self.get_range(r.count)
+                if count is None or count.hi < 1:
+                    return None
+                return ValueRange(0, count.hi - 1)
+            if r.node_type == NodeType.LET:
+                return self.get_range(r.value)
+            return None
+        if t == NodeType.BINOP:
+            a = self.get_range(node.left)
+            b = self.get_range(node.right) if a is not None else None
+            if a is None or b is None:
+                return None
+            return get_range_op(node.operator.name, a, b)
+        return None
+    def get_length(self, base: Node) -> Optional[int]:
+        """The number of elements of what is indexed when it's known"""
+        t = base.resolved_type
+        if t is None and base.node_type == NodeType.NAME:
+            # Support definitions aren't resolved
+            r = base.resolved_node if base.resolved_node is not None else lookup_local(base)
+            if r is not None and r.node_type == NodeType.PARAMETER:
+                t = r.parameter_type
+            elif r is not None and r.node_type == NodeType.VARIABLE:
+                t = r.variable_type
+        while t is not None and t.node_type == NodeType.ALIAS:
+            t = t.aliased_type
+        n = getattr(t, "num_elements", None) if t is not None else None
+        return n if type(n) is int else None
+    def is_in_bounds(self, index: Node) -> bool:
+        if len(index.ranges) != 1 or index.ranges[0] is None:
+            return False
+        n = self.get_length(index.base)
+        r = self.get_range(index.ranges[0])
+        return n is not None and r is not None and ValueRange(0, n - 1).contains(r)
+
+# The narrowest types for indices, narrowest first
+index_types = (byte_type, sbyte_type, ushort_type, short_type, int_type)
+
+def get_index_type(r: Optional[ValueRange]) -> Integer:
+    """The narrowest integer type that holds every value in the range"""
+    if r is not None:
+        for t in index_types:
+            lo = -(1 << (t.bits - 1)) if t.signed else 0
+            hi = (1 << (t.bits - 1)) - 1 if t.signed else (1 << t.bits) - 1
+            if ValueRange(lo, hi).contains(r):
+                return t
+    return int_type
+
+class BoundsCheckEliminationPass(Pass):
+    """Marks the indices that range analysis proves are in bounds so writers
+    can use unchecked indexing where the language has it. It runs before the
+    passes that turn indices into induction variables, whose ranges aren't
+    known. The marks stay valid as the index expressions are rewritten."""
+    name = "bounds"
+    requires = ("resolve",)
+    opt_level = 2
+    changes_tree = True
+    transforms_support_definitions = True
+    def transform(self, compiler: Compiler, root: Node) -> bool:
+        ps = compiler.stats.get_pass(self.name)
+        ranges = RangeAnalysis()
+        num_in_bounds = 0
+        num_unproven = 0
+        for n in list(iter_subtree(root)):
+            if n.node_type != NodeType.INDEX:
+                continue
+            if ranges.is_in_bounds(n):
+                if not n.in_bounds:
+                    n.in_bounds = True
+                    num_in_bounds += 1
+            else:
+                num_unproven += 1
+        ps.add_count("in_bounds", num_in_bounds)
+        ps.add_count("unproven", num_unproven)
+        return num_in_bounds > 0
+    def run(self, compiler: Compiler) -> bool:
+        return self.transform(compiler, compiler.ast)
+
+register_pass(DeadCodeEliminationPass())
+register_pass(InliningPass())
+register_pass(ConstantFoldingPass())
+register_pass(CommonSubexpressionPass())
+register_pass(LoopInvariantCodeMotionPass())
+register_pass(BoundsCheckEliminationPass())
+register_pass(LoopUnrollingPass())
+register_pass(StrengthReductionPass())
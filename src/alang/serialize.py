@@ -0,0 +1,278 @@
+"""Compact binary serialization of node trees and compiled modules.
+
+Strings are interned in a table, builtin types are written by name and shared
+again when loaded, and every other node is written once no matter how many
+nodes link to it. Resolved types and names are kept so loaded trees don't need
+to be compiled again.
+"""
+
+import importlib
+import struct
+from typing import Any
+
+from alang.nodes import Block, Node, get_current_session, get_slot_names
+
+MAGIC = b"ALNG"
+VERSION = 2
+
+T_NONE = 0
+T_FALSE = 1
+T_TRUE = 2
+T_INT = 3
+T_FLOAT = 4
+T_STR = 5
+T_NODE = 6
+T_BUILTIN = 7
+T_LIST = 8
+T_TUPLE = 9
+T_DICT = 10
+T_BINOP = 11
+T_OBJECT = 12
+
+# Slots that are rebuilt or reset when loading
+transient_slots = {"id", "last_backlink", "_visit_epoch", "_fingerprint", "frozen", "_tracked", "reachability_index", "symbols", "compile_state", "resolve_generation"}
+
+def get_builtin_names() -> dict[int, str]:
+    from alang.typs import builtin_types
+    names = {}
+    for name, t in builtin_types.items():
+        if t.id not in names:
+            names[t.id] = name
+    return names
+
+def get_class_path(cls: type) -> str:
+    return f"{cls.__module__}:{cls.__qualname__}"
+
+def load_class(path: str) -> type:
+    module_name, _, qualname = path.partition(":")
+    if module_name != "alang" and not module_name.startswith("alang."):
+        raise ValueError(f"Cannot load class from outside alang: {path}")
+    cls = importlib.import_module(module_name)
+    for part in qualname.split("."):
+        cls = getattr(cls, part)
+    if not isinstance(cls, type):
+        raise ValueError(f"Not a class: {path}")
+    return cls
+
+class BinaryWriter:
+    def __init__(self):
+        self.strings: dict[str, int] = {}
+        self.node_indexes: dict[int, int] = {}
+        self.nodes: list[Node] = []
+        self.builtin_names = get_builtin_names()
+    def write_varint(self, out: bytearray, n: int):
+        while n >= 0x80:
+            out.append((n & 0x7F) | 0x80)
+            n >>= 7
+        out.append(n)
+    def write_string(self, out: bytearray, s: str):
+        i = self.strings.get(s)
+        if i is None:
+            i = self.strings[s] = len(self.strings)
+        self.write_varint(out, i)
+    def write_node_ref(self, out: bytearray, node: Node):
+        i = self.node_indexes.get(node.id)
+        if i is None:
+            i = self.node_indexes[node.id] = len(self.nodes)
+            self.nodes.append(node)
+        self.write_varint(out, i)
+    def write_value(self, out: bytearray, value: Any):
+        from alang.exprs import BinopOp
+        if value is None:
+            out.append(T_NONE)
+        elif value is False:
+            out.append(T_FALSE)
+        elif value is True:
+            out.append(T_TRUE)
+        elif isinstance(value, int):
+            out.append(T_INT)
+            self.write_varint(out, (value << 1) if value >= 0 else ((-value << 1) - 1))
+        elif isinstance(value, float):
+            out.append(T_FLOAT)
+            out.extend(struct.pack("<d", value))
+        elif isinstance(value, str):
+            out.append(T_STR)
+            self.write_string(out, value)
+        elif isinstance(value, Node):
+            name = self.builtin_names.get(value.id)
+            if name is not None:
+                out.append(T_BUILTIN)
+                self.write_string(out, name)
+            else:
+                out.append(T_NODE)
+                self.write_node_ref(out, value)
+        elif isinstance(value, (list, tuple)):
+            out.append(T_LIST if isinstance(value, list) else T_TUPLE)
+            self.write_varint(out, len(value))
+            for x in value:
+                self.write_value(out, x)
+        elif isinstance(value, dict):
+            out.append(T_DICT)
+            self.write_varint(out, len(value))
+            for k, v in value.items():
+                self.write_value(out, k)
+                self.write_value(out, v)
+        elif isinstance(value, BinopOp):
+            out.append(T_BINOP)
+            self.write_string(out, value.name)
+        elif type(value).__module__.startswith("alang.") and hasattr(value, "__dict__"):
+            out.append(T_OBJECT)
+            self.write_string(out, get_class_path(type(value)))
+            self.write_value(out, value.__dict__)
+        else:
+            raise ValueError(f"Cannot serialize value of type {type(value).__name__}")
+    def write_node(self, out: bytearray, node: Node):
+        values = []
+        for name in get_slot_names(type(node)):
+            if name not in transient_slots and hasattr(node, name):
+                values.append((name, getattr(node, name)))
+        self.write_varint(out, len(values))
+        for name, value in values:
+            self.write_string(out, name)
+            self.write_value(out, value)
+    def dumps(self, value: Any) -> bytes:
+        root = bytearray()
+        self.write_value(root, value)
+        # Writing nodes can discover more nodes so the table grows as we go
+        bodies = bytearray()
+        i = 0
+        while i < len(self.nodes):
+            self.write_node(bodies, self.nodes[i])
+            i += 1
+        backlinks = []
+        for i, node in enumerate(self.nodes):
+            p = node.last_backlink
+            if p is not None and p.id in self.node_indexes:
+                backlinks.append((i, self.node_indexes[p.id]))
+        classes = bytearray()
+        for node in self.nodes:
+            self.write_string(classes, get_class_path(type(node)))
+        out = bytearray(MAGIC)
+        out.append(VERSION)
+        strings = sorted(self.strings.items(), key=lambda x: x[1])
+        self.write_varint(out, len(strings))
+        for s, _ in strings:
+            b = s.encode("utf-8")
+            self.write_varint(out, len(b))
+            out.extend(b)
+        self.write_varint(out, len(self.nodes))
+        out.extend(classes)
+        out.extend(bodies)
+        self.write_varint(out, len(backlinks))
+        for i, p in backlinks:
+            self.write_varint(out, i)
+            self.write_varint(out, p)
+        out.extend(root)
+        return bytes(out)
+
+class BinaryReader:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+        self.strings: list[str] = []
+        self.nodes: list[Node] = []
+    def read_varint(self) -> int:
+        n = 0
+        shift = 0
+        data = self.data
+        while True:
+            b = data[self.pos]
+            self.pos += 1
+            n |= (b & 0x7F) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+    def read_string(self) -> str:
+        return self.strings[self.read_varint()]
+    def read_value(self) -> Any:
+        tag = self.data[self.pos]
+        self.pos += 1
+        if tag == T_NONE:
+            return None
+        elif tag == T_FALSE:
+            return False
+        elif tag == T_TRUE:
+            return True
+        elif tag == T_INT:
+            n = self.read_varint()
+            return (n >> 1) if (n & 1) == 0 else -((n + 1) >> 1)
+        elif tag == T_FLOAT:
+            value = struct.unpack_from("<d", self.data, self.pos)[0]
+            self.pos += 8
+            return value
+        elif tag == T_STR:
+            return self.read_string()
+        elif tag == T_NODE:
+            return self.nodes[self.read_varint()]
+        elif tag == T_BUILTIN:
+            from alang.typs import resolve_builtin_type
+            return resolve_builtin_type(self.read_string())
+        elif tag == T_LIST or tag == T_TUPLE:
+            values = [self.read_value() for _ in range(self.read_varint())]
+            return values if tag == T_LIST else tuple(values)
+        elif tag == T_DICT:
+            d = {}
+            for _ in range(self.read_varint()):
+                k = self.read_value()
+                d[k] = self.read_value()
+            return d
+        elif tag == T_BINOP:
+            from alang.exprs import bop_from_name
+            return bop_from_name[self.read_string()]
+        elif tag == T_OBJECT:
+            cls = load_class(self.read_string())
+            if issubclass(cls, Node):
+                raise ValueError(f"Nodes must be written as node references: {cls.__name__}")
+            obj = object.__new__(cls)
+            obj.__dict__.update(self.read_value())
+            return obj
+        raise ValueError(f"Invalid value tag {tag} at offset {self.pos - 1}")
+    def loads(self) -> Any:
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not alang binary data")
+        self.pos = len(MAGIC)
+        version = self.data[self.pos]
+        self.pos += 1
+        if version != VERSION:
+            raise ValueError(f"Unsupported alang binary version {version}")
+        for _ in range(self.read_varint()):
+            n = self.read_varint()
+            self.strings.append(self.data[self.pos:self.pos + n].decode("utf-8"))
+            self.pos += n
+        session = get_current_session()
+        num_nodes = self.read_varint()
+        for _ in range(num_nodes):
+            cls = load_class(self.read_string())
+            if not issubclass(cls, Node):
+                raise ValueError(f"Not a node class: {cls.__name__}")
+            node = object.__new__(cls)
+            node.id = session.new_node_id()
+            node.last_backlink = None
+            node._visit_epoch = 0
+            node._fingerprint = None
+            node.frozen = False
+            node._tracked = False
+            if isinstance(node, Block):
+                node.reachability_index = None
+                node.compile_state = None
+                node.resolve_generation = 0
+                node.symbols = None
+            self.nodes.append(node)
+        for node in self.nodes:
+            for _ in range(self.read_varint()):
+                name = self.read_string()
+                setattr(node, name, self.read_value())
+        for _ in range(self.read_varint()):
+            i = self.read_varint()
+            self.nodes[i].last_backlink = self.nodes[self.read_varint()]
+        for node in self.nodes:
+            if isinstance(node, Block):
+                node.rebuild_symbols()
+        return self.read_value()
+
+def dumps(value: Any) -> bytes:
+    """Serializes nodes, or lists, tuples and dicts of them and plain values"""
+    return BinaryWriter().dumps(value)
+
+def loads(data: bytes) -> Any:
+    return BinaryReader(data).loads()
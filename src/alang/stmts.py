@@ -1,6 +1,6 @@
 from typing import Optional
 
-from alang.nodes import Block, Expression, NodeAttr, NodeLink, NodeType, Statement
+from alang.nodes import Block, Expression, Node, NodeAttr, NodeLink, NodeType, Statement
 import alang.typs as typs
 
 class ExprStmt(Statement):
@@ -11,9 +11,25 @@ class ExprStmt(Statement):
     def resolve_type(self, diags: "compiler.Diagnostics") -> typs.Type: # type: ignore
         return self.expression.resolved_type
     
+class Let(Statement):
+    """A local that is computed once and never assigned again"""
+    name = NodeAttr()
+    let_type = NodeLink()
+    value = NodeLink()
+    def __init__(self, name: str, value: Expression, let_type: Optional[typs.Type] = None):
+        super().__init__(NodeType.LET)
+        self.name = name
+        self.let_type = let_type
+        self.value = value
+    def resolve_type(self, diags: "compiler.Diagnostics") -> typs.Type: # type: ignore
+        if self.let_type is not None:
+            return self.let_type.resolved_type
+        return self.value.resolved_type
+
 class Loop(Block):
     var = NodeAttr()
     count = NodeLink()
+    scope_rels = ("lets",)
     def __init__(self, var: str, count: Optional[Expression], *statements: list[Statement]):
         super().__init__(NodeType.LOOP, can_define_types=False, can_define_functions=False, can_define_variables=False, can_define_statements=True)
         self.var = str(var)
@@ -22,6 +38,10 @@ class Loop(Block):
             count = Constant(count)
         self.count = count
         self.statements = statements
+    def lookup_name(self, name: str) -> Optional[Node]:
+        if name == self.var:
+            return self
+        return super().lookup_name(name)
     def resolve_type(self, diags: "compiler.Diagnostics") -> typs.Type: # type: ignore
         return typs.void_type
 
@@ -10,6 +10,7 @@ class TypeRef(Node):
         self.name = name
 
 class Type(TypeRef):
+    __slots__ = ("is_primitive", "is_algebraic", "is_scalar", "is_float", "is_array", "is_vector", "is_struct", "is_tensor", "is_indexable", "is_void")
     def __init__(self, name: str, node_type: NodeType):
         super().__init__(name, node_type)
         self.is_primitive = False
@@ -82,6 +83,7 @@ class Alias(TypeRef):
         return None
 
 class Array(Type):
+    __slots__ = ("nobuffer_layout",)
     element_type = NodeLink()
     num_elements = NodeAttr()
     def __init__(self, element_type: Type, length: Optional[int]):
@@ -163,6 +165,7 @@ class Scalar(Algebraic):
         self.is_scalar = True
 
 class Integer(Scalar):
+    __slots__ = ("nobuffer_layout",)
     bits = NodeAttr()
     signed = NodeAttr()
     def __init__(self, bits: int, signed: bool):
@@ -204,6 +207,7 @@ def get_float_layout(bits: int) -> TypeLayout:
     return layout
 
 class Float(Scalar):
+    __slots__ = ("cached_layout",)
     bits = NodeAttr()
     def __init__(self, bits: int):
         super().__init__(get_float_name(bits), NodeType.FLOAT)
@@ -322,6 +326,7 @@ def round_up(k: int, n: int) -> int:
     return ((n + k - 1) // k) * k
 
 class Struct(Type):
+    __slots__ = ("nobuffer_layout",)
     fields = NodeLinks()
     def __init__(self, name, *fields: Optional[list[Field]]):
         super().__init__(name, NodeType.STRUCT)
@@ -371,6 +376,7 @@ def get_tensor_mm_shape(a_shape: tuple, b_shape: tuple) -> tuple:
     return (a_shape[0], b_shape[1])
 
 class Tensor(Algebraic):
+    __slots__ = ("num_elements",)
     element_type = NodeLink()
     shape = NodeAttr()
     def __init__(self, shape: tuple, element_type: Type):
@@ -434,6 +440,7 @@ def get_vector_layout(element_type: Type, size: int) -> TypeLayout:
     return layout
 
 class Vector(Algebraic):
+    __slots__ = ("num_elements", "nobuffer_layout")
     element_type = NodeLink()
     size = NodeAttr()
     def __init__(self, element_type: Type, size: int):
@@ -509,6 +516,9 @@ builtin_types = {
 }
 builtin_types.update(scalar_types)
 
+for t in builtin_types.values():
+    t.freeze()
+
 def try_parse_builtin_type(name: str) -> Optional[Type]:
     if name in builtin_types:
         return builtin_types[name]
@@ -0,0 +1,82 @@
+from alang.nodes import CodeCache, CodeOptions, CompileSession, Module, code_cache
+from alang.typs import float_type, tensor_type
+
+def build_module(name: str = "cached") -> Module:
+    m = Module(name)
+    at = tensor_type((2, 3), float_type)
+    bt = tensor_type((3, 2), float_type)
+    m.define("mm").param("a", at).param("b", bt).ret("a @ b")
+    m.define("scale", ("x", "float")).ret("x * 2.0")
+    return m
+
+def test_repeated_get_code_hits():
+    m = build_module()
+    code = m.c_code
+    hits, misses = code_cache.hits, code_cache.misses
+    assert m.c_code == code
+    assert m.get_code("c") == code
+    assert code_cache.hits == hits + 2
+    assert code_cache.misses == misses
+    m.get_code("c", CodeOptions(auto_entry_points=True))
+    assert code_cache.misses == misses + 1
+
+def test_mutation_invalidates():
+    m = build_module()
+    m.c_code
+    m.functions[1].statements[0].value.right.value = 3.0
+    fresh = build_module()
+    fresh.functions[1].statements[0].value.right.value = 3.0
+    assert m.c_code == fresh.c_code
+    assert "3.0" in m.c_code
+
+def test_html_render_reuses_module_code():
+    m = build_module()
+    m.html_code
+    misses = code_cache.misses
+    m.html_code
+    assert code_cache.misses == misses
+
+def test_least_recently_used_are_evicted():
+    cache = CodeCache(max_size=2)
+    modules = [build_module(f"m{i}") for i in range(3)]
+    options = CodeOptions()
+    def get(m: Module) -> str:
+        with CompileSession(options) as session:
+            return cache.get_code(m, "c", options, session)
+    for m in modules:
+        get(m)
+    cache.clear()
+    get(modules[0])
+    get(modules[1])
+    get(modules[2])
+    assert len(cache.entries) == 2
+    assert get(modules[1]) == modules[1].c_code
+    assert cache.hits == 1
+    get(modules[0])
+    assert cache.misses == 4
+
+def test_get_codes_compiles_once():
+    from alang.compiler import Compiler
+    languages = ["wgsl", "js", "c", "swift"]
+    expected = [build_module("many").get_code(lang) for lang in languages]
+    num_compiles = 0
+    compile = Compiler.compile
+    def counting_compile(self):
+        nonlocal num_compiles
+        num_compiles += 1
+        compile(self)
+    Compiler.compile = counting_compile
+    try:
+        codes = build_module("many").get_codes(languages)
+    finally:
+        Compiler.compile = compile
+    assert codes == expected
+    assert num_compiles == 1
+
+def test_other_modules_dont_invalidate():
+    m = build_module("kept")
+    code = m.c_code
+    build_module("other").c_code
+    hits = code_cache.hits
+    assert m.c_code == code
+    assert code_cache.hits == hits + 1
@@ -0,0 +1,53 @@
+import json
+from io import StringIO
+from alang.compiler import Compiler, CompileStats
+from alang.nodes import CodeOptions, Module
+from alang.typs import float_type, tensor_type
+
+def build_module() -> Module:
+    m = Module("stats")
+    m.define("mm").param("a", tensor_type((2, 3), float_type)).param("b", tensor_type((3, 2), float_type)).ret("a @ b")
+    m.define("f", ("x", "float")).set("y", "x * 2.0").ret("y + 1.0")
+    return m
+
+def test_full_compile_stats():
+    m = build_module()
+    c = Compiler(m, CodeOptions())
+    c.compile()
+    s = c.stats
+    assert not s.incremental
+    assert s.wall_time > 0 and s.cpu_time >= 0
+    names = list(s.passes.keys())
+    assert names[:3] == ["resolve", "resolve.names", "resolve.types"]
+    assert s.passes["resolve"].num_runs == 1
+    types = s.passes["resolve.types"]
+    assert types.num_nodes_visited > 0
+    assert types.num_iterations == 2
+    assert types.iterations[-1][1] == 0
+    assert s.num_support_definitions > 0
+    assert s.num_support_groups > 0
+
+def test_incremental_compile_stats():
+    m = build_module()
+    m.c_code
+    m.functions[1].statements[0].value.right.value = 3.0
+    c = Compiler(m, CodeOptions())
+    c.compile()
+    s = c.stats
+    assert s.incremental
+    ps = s.passes["resolve.incremental"]
+    assert ps.num_iterations >= 1
+    assert ps.num_nodes_visited > 0
+    assert "resolve.names" not in s.passes
+
+def test_write_code_returns_stats_and_exports():
+    m = build_module()
+    out = StringIO()
+    stats = m.write_code(out, "c")
+    assert isinstance(stats, CompileStats)
+    assert stats.passes["emit"].num_runs == 1
+    d = json.loads(stats.to_json())
+    assert [p["name"] for p in d["passes"]] == list(stats.passes.keys())
+    assert d["num_support_definitions"] == stats.num_support_definitions
+    text = stats.format()
+    assert "resolve.types" in text and "support definitions" in text
@@ -0,0 +1,77 @@
+import io
+import re
+
+from alang.compiler import Compiler
+from alang.exprs import Funcall
+from alang.nodes import CodeOptions, Module, define
+from alang.opt import count_instructions
+from alang.stmts import ExprStmt, Set
+from alang.typs import float_type, int_type, tensor_type
+
+def matmul(element_type):
+    at = tensor_type((3, 5), element_type)
+    bt = tensor_type((5, 7), element_type)
+    return define("f").param("a", at).param("b", bt).ret("a @ b")
+
+def count_compiled_instructions(f, opt_level: int) -> int:
+    c = Compiler(f, CodeOptions(opt_level=opt_level))
+    c.compile()
+    return count_instructions(c.ast) + sum(count_instructions(d) for d in c.support_definitions)
+
+def get_code_without_sr(f, language: str) -> str:
+    c = Compiler(f, CodeOptions(opt_level=2))
+    # Strength reduction would turn the row offset into an induction variable
+    c.pass_manager.remove("sr")
+    c.compile()
+    out = io.StringIO()
+    c.write_code(out, language)
+    return out.getvalue()
+
+def test_matmul_row_offset_is_bound_once():
+    f = matmul(int_type)
+    code = get_code_without_sr(f, "wgsl")
+    assert "let cse0 = (out_r * 5);" in code
+    assert "a[cse0]" in code and "(out_r * 5)" not in code.replace("let cse0 = (out_r * 5);", "")
+    assert "int32_t cse0 = out_r * 5;" in get_code_without_sr(f, "c")
+    assert "let cse0: " in get_code_without_sr(f, "swift")
+    assert "const cse0 = (out_r * 5);" in get_code_without_sr(f, "js")
+    # Not at lower levels
+    assert "cse0" not in f.get_code("wgsl", CodeOptions(opt_level=1))
+    # With strength reduction the offset is an induction variable, which isn't copied to a let
+    for lang in ["wgsl", "c"]:
+        code = f.get_code(lang, CodeOptions(opt_level=2))
+        assert re.search(r"\b(cse|licm)\d+ = \w+;", code) is None
+        assert "a[iv0]" in code
+
+def test_matmul_instruction_counts():
+    for element_type in [int_type, float_type]:
+        f = matmul(element_type)
+        o0 = count_compiled_instructions(f, 0)
+        o1 = count_compiled_instructions(f, 1)
+        o2 = count_compiled_instructions(f, 2)
+        assert o0 >= o1 > o2, (element_type, o0, o1, o2)
+
+def test_assigned_names_are_not_shared():
+    g = define("g", ("x", "int"))
+    g.set("y", "0")
+    g.stmt(Set(g.parse_expr("y"), g.parse_expr("x * 3 + 1")))
+    g.stmt(Set(g.parse_expr("y"), g.parse_expr("y * 2 + x * 3")))
+    g.ret("y * 2 + x * 3")
+    code = g.get_code("c", CodeOptions(opt_level=2))
+    assert "int32_t cse0 = x * 3;" in code
+    assert "return y * 2 + cse0;" in code
+
+def test_module_variables_assigned_by_calls_are_not_shared():
+    m = Module("clobber")
+    m.var("acc", "int")
+    bump = m.define("bump", ("k", "int"))
+    bump.stmt(Set(bump.parse_expr("acc"), bump.parse_expr("acc + k")))
+    f = m.define("f", ("x", "int"))
+    f.var("a", "int")
+    f.var("c", "int")
+    f.stmt(Set(f.parse_expr("a"), f.parse_expr("acc * 3 + x")))
+    f.stmt(ExprStmt(Funcall("bump", [f.parse_expr("x")])))
+    f.stmt(Set(f.parse_expr("c"), f.parse_expr("acc * 3 + x")))
+    f.ret("a + c")
+    code = m.get_code("c", CodeOptions(opt_level=2))
+    assert "cse0" not in code and "c = acc * 3 + x;" in code
@@ -0,0 +1,50 @@
+from alang.compiler import Compiler
+from alang.exprs import Funcall
+from alang.nodes import CodeOptions, Module
+from alang.opt import DeadCodeEliminationPass
+from alang.stmts import Set
+from alang.typs import float_type, tensor_type
+
+def build_module() -> Module:
+    m = Module("dce")
+    m.struct("Unused", ("a", "float"))
+    m.var("unused_g", "float")
+    m.var("out", "float")
+    m.define("g", ("x", "float")).ret("x * 2.0")
+    m.define("unused").param("a", tensor_type((2, 3), float_type)).param("b", tensor_type((3, 2), float_type)).ret("a @ b")
+    main = m.define("main", ("x", "float"))
+    main.set("t", "x + 1.0")
+    main.set("dead", "x * 3.0")
+    main.stmt(Set(main.parse_expr("dead"), main.parse_expr("dead + t")))
+    main.stmt(Set(main.parse_expr("out"), Funcall("g", ["t"])))
+    main.stage = "compute"
+    return m
+
+def test_prunes_unreachable_items():
+    m = build_module()
+    for lang in ["c", "wgsl", "swift", "metal", "glsl"]:
+        code = m.get_code(lang, CodeOptions(opt_level=1))
+        for name in ["Unused", "unused_g", "unused", "mul_float2x3_float3x2", "dead"]:
+            assert name not in code, (lang, name)
+        assert "g(t)" in code
+    code = m.get_code("wgsl")
+    assert "mul_float2x3_float3x2" in code and "dead" in code
+    # The caller's tree is left alone
+    assert len(m.functions) == 3 and len(m.functions[2].variables) == 2
+
+def test_user_roots():
+    m = build_module()
+    m.functions[2].stage = None
+    c = Compiler(m, CodeOptions(opt_level=1, passes=(DeadCodeEliminationPass(roots=("unused",)),)))
+    c.compile()
+    assert [f.name for f in c.ast.functions] == ["unused"]
+    assert [s.name for s in c.support_definitions] == ["float2x3", "float3x2", "mul_float2x3_float3x2", "float2x2"]
+    assert len(c.ast.types) == 0 and len(c.ast.variables) == 0
+    assert c.stats.passes["dce"].iterations == [(5, 0)]
+
+def test_library_keeps_items():
+    m = build_module()
+    m.functions[2].stage = None
+    code = m.get_code("wgsl", CodeOptions(opt_level=1))
+    assert "Unused" in code and "unused_g" in code and "mul_float2x3_float3x2" in code
+    assert "dead" not in code
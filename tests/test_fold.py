@@ -0,0 +1,48 @@
+import struct
+
+from alang.exprs import Binop, bops
+from alang.nodes import CodeOptions, define
+from alang.opt import fold_values
+from alang.typs import int_type, tensor_type
+
+def test_fold_values():
+    assert fold_values("div", -7, 2) == -3
+    assert fold_values("mod", -7, 2) == -1
+    assert fold_values("div", 7, 0) is None
+    assert fold_values("shl", 1, 40) is None
+    assert fold_values("mul", 1 << 20, 1 << 20) is None
+    assert fold_values("lt", 2, 3) == 1
+    assert fold_values("and", 2, 0) == 0
+    assert fold_values("mod", 7.0, 2.0) is None
+    assert fold_values("add", 1, 2.0) is None
+    assert fold_values("matmul", 2, 3) is None
+    for op in bops:
+        if op.name != "matmul":
+            assert fold_values(op.name, 6, 3) is not None, op.name
+
+def test_floats_fold_at_their_precision():
+    f32 = fold_values("add", 0.1, 0.2)
+    assert f32 != 0.1 + 0.2 and f32 == struct.unpack("f", struct.pack("f", f32))[0]
+    assert abs(f32 - 0.3) < 1e-7
+    assert fold_values("add", 0.1, 0.2, 64) == 0.1 + 0.2
+    assert fold_values("div", 1.0, 3.0, 16) == 0.333251953125
+    # Results that overflow to infinity aren't folded
+    assert fold_values("mul", 1e30, 1e30) is None
+    assert fold_values("mul", 1e30, 1e30, 64) == 1e30 * 1e30
+
+def test_matmul_indices_are_simplified():
+    at = tensor_type((1, 2), int_type)
+    bt = tensor_type((2, 1), int_type)
+    f = define("f").param("a", at).param("b", bt).ret("a @ b")
+    code = f.get_code("wgsl", CodeOptions(opt_level=1))
+    assert "o[(out_r + out_c)] = ((a[(out_r * 2)] * b[out_c]) + (a[((out_r * 2) + 1)] * b[(out_c + 1)]));" in code
+    assert "(out_r * 1)" in f.wgsl_code
+
+def test_integer_chains_and_identities():
+    g = define("g", ("x", "int"), ("y", "float")).set("z", "(x + 1) + (2 + x) - 3 + 4 * 5")
+    g.ret(Binop(g.parse_expr("y * 1.0 + z + 2 * 3.0 + (y + 1.0) + 2.0"), "+", Binop(Binop(7, ">>", 1), "<<", "x")))
+    code = g.get_code("c", CodeOptions(opt_level=1))
+    assert "int32_t z = x + x + 20;" in code
+    assert "return y + z + 6.0 + " in code and "(3 << x)" in code
+    # Float sums are not reassociated
+    assert "1.0 + 2.0" in code
@@ -0,0 +1,70 @@
+import io
+
+from alang.compiler import Compiler
+from alang.exprs import Binop, Funcall
+from alang.nodes import CodeOptions, Module
+from alang.typs import float_type, int_type
+
+def build_module(num_functions: int, scale: int = 0, callee: str = "f0") -> Module:
+    m = Module("lib")
+    m.var("bias", "float")
+    for i in range(num_functions):
+        m.define(f"f{i}", ("x", "float")).set("y", f"x * {i} + bias").ret("y + 1")
+    m.define("g", ("x", "float")).ret(Binop(Funcall(callee, ["x"]), "*", scale))
+    return m
+
+def compile_code(m: Module, language: str = "c") -> tuple[Compiler, str]:
+    c = Compiler(m, CodeOptions())
+    c.compile()
+    out = io.StringIO()
+    c.write_code(out, language)
+    return c, out.getvalue()
+
+def rename_first(m: Module) -> Module:
+    m.functions[0].name = "h"
+    return m
+
+def test_edit_recompiles_only_what_changed():
+    num_functions = 400
+    m = build_module(num_functions)
+    compile_code(m)
+    state = m.compile_state
+    assert state is not None
+    g = m.functions[-1]
+    g.statements[0].value.right.value = 5
+    c, code = compile_code(m)
+    assert state.num_processed < 20
+    assert code == compile_code(build_module(num_functions, scale=5))[1]
+
+def test_rename_reresolves_users():
+    m = build_module(50)
+    compile_code(m)
+    rename_first(m)
+    c, code = compile_code(m)
+    assert [d.message for d in c.diags.messages] == ["Name f0 not found"]
+    assert code == compile_code(rename_first(build_module(50)))[1]
+    m.functions[-1].statements[0].value.left.func.name = "h"
+    c, code = compile_code(m)
+    assert len(c.diags.messages) == 0
+    assert code == compile_code(rename_first(build_module(50, callee="h")))[1]
+
+def test_type_changes_reach_callers():
+    m = build_module(20, callee="f3")
+    compile_code(m)
+    f3 = m.functions[3]
+    f3.parameters[0].parameter_type = int_type
+    c, code = compile_code(m)
+    m2 = build_module(20, callee="f3")
+    m2.functions[3].parameters[0].parameter_type = int_type
+    assert code == compile_code(m2)[1]
+    assert m.functions[-1].return_type is not None
+
+def test_added_function_is_compiled():
+    m = build_module(10)
+    compile_code(m)
+    m.define("k", ("x", "float")).ret("x * bias")
+    c, code = compile_code(m)
+    m2 = build_module(10)
+    m2.define("k", ("x", "float")).ret("x * bias")
+    assert code == compile_code(m2)[1]
+    assert m.functions[-1].return_type is float_type
@@ -0,0 +1,96 @@
+from alang.compiler import Compiler
+from alang.exprs import Binop, Funcall, Name
+from alang.nodes import CodeOptions, Module, define
+from alang.opt import InliningPass
+from alang.stmts import Set
+from alang.typs import float_type, tensor_type
+
+def build_module() -> Module:
+    m = Module("inline")
+    m.var("out", "int")
+    m.define("g", ("x", "int")).ret("x * 2 + 1")
+    h = m.define("h", ("x", "int"), ("y", "int"))
+    h.set("t", "x * y")
+    h.set("u", "t + x")
+    h.ret("u * t")
+    main = m.define("main", ("x", "int"))
+    main.set("t", "x + 1")
+    main.stmt(Set(main.parse_expr("out"), Funcall("g", [main.parse_expr("t * 3")])))
+    main.stmt(Set(main.parse_expr("out"), Funcall("h", [main.parse_expr("out"), main.parse_expr("t + 3")])))
+    main.stage = "compute"
+    return m
+
+def test_inlines_and_removes_callees():
+    m = build_module()
+    code = m.get_code("c", CodeOptions(opt_level=2))
+    assert "g(" not in code and "h(" not in code
+    assert "out = t * 6 + 1;" in code
+    # Arguments that aren't simple are bound, and clashing locals are renamed
+    assert "int32_t y_0 = t + 3;" in code
+    assert "t_0 = out * y_0;" in code and "out = u * t_0;" in code
+    assert "out = h(out, t + 3);" in m.get_code("c", CodeOptions(opt_level=1))
+    c = Compiler(m, CodeOptions(opt_level=2))
+    c.compile()
+    assert c.stats.get_pass("inline").counts == {"inlined": 2, "removed": 2}
+
+def test_cost_model():
+    m = build_module()
+    code = m.get_code("c", CodeOptions(opt_level=2, passes=(InliningPass(max_nodes=8),)))
+    assert "out = t * 6 + 1;" in code
+    assert "int32_t h(int32_t x, int32_t y)" in code and "g(" not in code
+    code = m.get_code("c", CodeOptions(opt_level=2, passes=(InliningPass(budget=4),)))
+    assert "out = g(t * 3);" in code
+    # Libraries keep their functions
+    m.functions[2].stage = None
+    assert "int32_t g(int32_t x)" in m.get_code("c", CodeOptions(opt_level=2))
+
+def test_callee_names_are_not_hidden():
+    m = Module("hidden")
+    m.var("k", "int")
+    m.define("g", ("x", "int")).ret("x + k")
+    main = m.define("main", ("x", "int"))
+    main.set("k", "x")
+    main.ret(Funcall("g", ["k"]))
+    assert "return g(k);" in m.get_code("c", CodeOptions(opt_level=2))
+
+def test_matmul_is_inlined():
+    at = tensor_type((2, 3), float_type)
+    bt = tensor_type((3, 2), float_type)
+    f = define("f").param("a", at).param("b", bt).ret("a @ b")
+    code = f.get_code("wgsl", CodeOptions(opt_level=2))
+    assert "mul_float2x3_float3x2" not in code
+    assert "var o: float2x2;" in code and "return o;" in code
+    assert "mul_float2x3_float3x2(a, b)" in f.get_code("wgsl", CodeOptions(opt_level=1))
+
+def test_arguments_are_read_before_calls_in_the_body():
+    m = Module("clobber")
+    m.var("acc", "int")
+    bump = m.define("bump", ("k", "int"))
+    bump.stmt(Set(bump.parse_expr("acc"), bump.parse_expr("acc + k")))
+    bump.ret("acc")
+    m.define("g", ("v", "int")).ret(Binop(Funcall("bump", [1]), "+", Name("v")))
+    m.define("h", ("x", "int")).ret(Funcall("g", [m.parse_expr("acc * 3")]))
+    code = m.get_code("c", CodeOptions(opt_level=2))
+    assert "int32_t v_0 = acc * 3;" in code and "return bump(1) + v_0;" in code
+
+def test_arguments_are_not_bound_before_earlier_calls():
+    m = Module("order")
+    m.var("acc", "int")
+    bump = m.define("bump", ("k", "int"))
+    bump.stmt(Set(bump.parse_expr("acc"), bump.parse_expr("acc + k")))
+    bump.ret("acc")
+    m.define("g", ("v", "int")).ret("v * v")
+    m.define("h").ret(Binop(Funcall("bump", [1]), "+", Funcall("g", [m.parse_expr("acc + 1")])))
+    code = m.get_code("c", CodeOptions(opt_level=2))
+    # acc + 1 is read after bump(1) changes acc
+    assert "v_0" not in code and "return bump(1) + g(acc + 1);" in code
+
+def test_unused_arguments_are_not_bound():
+    m = Module("unused")
+    m.var("out", "int")
+    m.define("k", ("a", "int"), ("b", "int")).ret("a * 2")
+    main = m.define("main", ("x", "int"), ("y", "int"))
+    main.stmt(Set(main.parse_expr("out"), Funcall("k", [main.parse_expr("x"), main.parse_expr("y * (x - 2)")])))
+    main.stage = "compute"
+    code = m.get_code("c", CodeOptions(opt_level=2))
+    assert "out = x * 2;" in code and "b_0" not in code and "y * (x - 2)" not in code
@@ -0,0 +1,96 @@
+from alang.compiler import Compiler
+from alang.ir import BINOP, CONST, PHI, SSAPass, dominates, get_dominators, get_uses, lower_function, optimize
+from alang.nodes import CodeOptions, define
+from alang.stmts import Loop, Return, Set
+from alang.typs import float_type, tensor_type
+
+def sum_loop():
+    g = define("g", ("x", "int"))
+    g.set("s", "0")
+    g.loop("i", 10, Set(g.parse_expr("s"), g.parse_expr("s + i * x")))
+    g.ret("s")
+    return g
+
+def lower(f, opt_level: int = 0):
+    c = Compiler(f, CodeOptions(opt_level=opt_level))
+    c.compile()
+    return lower_function(c.ast)
+
+def test_loops_have_phis_and_dominators():
+    ir = lower(sum_loop())
+    loop = ir.loops[0]
+    phis = ir.get_phis(loop.header)
+    assert len(phis) == 2 and loop.counter in phis
+    s = [p for p in phis if p != loop.counter][0]
+    assert ir.hints[s] == "s" and len(ir.args[s]) == 2
+    # s is returned and added to in the body
+    assert sorted(ir.ops[u] for u in get_uses(ir)[s]) == sorted([BINOP, ir.ops[ir.blocks[loop.exit].insts[-1]]])
+    idom = get_dominators(ir)
+    assert idom[loop.body] == loop.header and idom[loop.exit] == loop.header
+    assert dominates(idom, 0, loop.latch) and not dominates(idom, loop.body, loop.exit)
+    assert "phi v" in ir.format()
+
+def test_optimizations():
+    g = define("g", ("x", "int"))
+    g.set("y", "x * 5")
+    g.set("z", "y + x * 5")
+    g.loop("i", 4, Set(g.parse_expr("z"), g.parse_expr("z + 0")))
+    g.ret("z")
+    ir = lower(g)
+    n = ir.num_instructions
+    counts = optimize(ir)
+    assert counts["folded"] == 1 and counts["numbered"] > 1 and counts["phis"] == 1 and counts["removed"] > 0
+    assert ir.num_instructions < n
+    # The loop only carried z around
+    assert ir.get_phis(ir.loops[0].header) == [ir.loops[0].counter]
+    assert PHI not in [ir.ops[v] for v in ir.blocks[ir.loops[0].body].insts]
+    # x * 5 is computed once
+    ret = ir.blocks[ir.loops[0].exit].insts[-1]
+    add = ir.args[ret][0]
+    assert ir.args[add][0] == ir.args[add][1] and CONST in ir.ops
+
+def test_round_trip():
+    code = sum_loop().get_code("c", CodeOptions(opt_level=2, passes=(SSAPass(),)))
+    assert "int32_t s;" in code and "s = 0;" in code
+    assert "s = s + i * x;" in code and "return s;" in code
+    # Phis set together read the old values
+    g = define("fib", ("x", "int"))
+    g.set("a", "1")
+    g.set("b", "x")
+    g.loop("i", 5, Set(g.parse_expr("a"), g.parse_expr("b")), Set(g.parse_expr("b"), g.parse_expr("a + b")))
+    g.ret("a * 100 + b")
+    code = g.get_code("js", CodeOptions(opt_level=2, passes=(SSAPass(),)))
+    assert "const a_0 = b;" in code and "b = (b + b);" in code and "a = a_0;" in code
+    h = define("h", ("x", "int"))
+    h.loop("i", 5, Loop("j", 4, Return(h.parse_expr("i + j + x"))))
+    h.ret("x")
+    code = h.get_code("js", CodeOptions(opt_level=2, passes=(SSAPass(),)))
+    assert "return (i + x);" in code and code.count("for") == 2
+
+def test_matmul_round_trip():
+    at = tensor_type((3, 5), float_type)
+    bt = tensor_type((5, 7), float_type)
+    f = define("f").param("a", at).param("b", bt).ret("a @ b")
+    c = Compiler(f, CodeOptions(opt_level=2, passes=(SSAPass(),)))
+    c.compile()
+    counts = c.stats.get_pass("ssa").counts
+    assert counts["functions"] == 1 and counts["numbered"] > 0
+    code = f.get_code("wgsl", CodeOptions(opt_level=2, passes=(SSAPass(),)))
+    assert "var o: float3x7;" in code and "for (var out_c" in code and "return o;" in code
+    assert "iv0 = (iv0 + 5);" in code
+
+def test_lowered_variables_keep_their_address_space():
+    at = tensor_type((3, 5), float_type)
+    f = define("f").param("a", at).var("t", at, address_space="function").ret("t")
+    c = Compiler(f, CodeOptions(opt_level=2, passes=(SSAPass(),)))
+    c.compile()
+    t = [v for v in c.ast.variables if v.name == "t"][0]
+    assert t.address_space == "function" and t.access_mode == "read_write"
+    # Promoting a private scalar to SSA values would make it a function local
+    g = define("g", ("x", "int")).var("w", "int", address_space="private")
+    g.stmt(Set(g.parse_expr("w"), g.parse_expr("w + x")))
+    g.ret("w")
+    c = Compiler(g, CodeOptions(opt_level=2, passes=(SSAPass(),)))
+    c.compile()
+    assert "functions" not in c.stats.get_pass("ssa").counts
+    assert c.ast.variables[0].address_space == "private"
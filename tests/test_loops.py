@@ -0,0 +1,78 @@
+import io
+
+from alang.compiler import Compiler
+from alang.exprs import Funcall
+from alang.nodes import CodeOptions, Module, define
+from alang.opt import LoopUnrollingPass, count_instructions
+from alang.stmts import ExprStmt, Set
+from alang.typs import float_type, tensor_type
+
+def matmul():
+    at = tensor_type((3, 5), float_type)
+    bt = tensor_type((5, 7), float_type)
+    return define("f").param("a", at).param("b", bt).ret("a @ b")
+
+def sum_loop(count: int):
+    g = define("g", ("x", "int"))
+    g.set("s", "0")
+    g.loop("i", count, Set(g.parse_expr("s"), g.parse_expr("s + i * x")))
+    g.ret("s")
+    return g
+
+def test_row_offsets_are_hoisted():
+    c = Compiler(matmul(), CodeOptions(opt_level=2))
+    c.pass_manager.remove("sr")
+    c.compile()
+    out = io.StringIO()
+    c.write_code(out, "wgsl")
+    code = out.getvalue()
+    hoisted = code.index("let licm0 = (out_r * 7);")
+    assert code.index("let cse0 = (out_r * 5);") < hoisted < code.index("for (var out_c")
+    assert "o[(licm0 + out_c)]" in code
+
+def test_matmul_inner_loop_is_unrolled():
+    f = matmul()
+    code = f.get_code("c", CodeOptions(opt_level=3))
+    assert "out_c" not in code and "for (int32_t out_r" in code
+    assert "o[iv1 + 6] = licm1 * b[6] + " in code
+    c = Compiler(f, CodeOptions(opt_level=3))
+    c.compile()
+    assert c.stats.get_pass("unroll").counts == {"unrolled": 1}
+    assert c.stats.get_pass("licm").counts["hoisted"] > 0
+    assert "unrolled 1" in c.stats.format()
+    assert c.stats.get_pass("unroll").to_dict()["counts"] == {"unrolled": 1}
+    o2 = Compiler(f, CodeOptions(opt_level=2))
+    o2.compile()
+    assert count_instructions(c.ast) < count_instructions(o2.ast)
+
+def test_partial_unrolling():
+    g = sum_loop(10)
+    code = g.get_code("js", CodeOptions(opt_level=3, passes=(LoopUnrollingPass(factor=4, max_nodes=40),)))
+    assert "i < 2;" in code
+    assert code.count("s = (s + ") == 6
+    assert code.index("s = (s + (x * 9));") > code.index("}")
+    # Too big to unroll at all
+    code = g.get_code("js", CodeOptions(opt_level=3, passes=(LoopUnrollingPass(factor=4, max_nodes=10),)))
+    assert "i < 10;" in code and code.count("s = (s + ") == 1
+    # Small enough to unroll fully
+    code = g.get_code("js", CodeOptions(opt_level=3))
+    assert "for" not in code and "s = (s + (x * 9));" in code
+    # The first iteration folds to s = s, which is dropped
+    assert "s = s;" not in code and code.count("s = (s + ") == 9
+    assert "for (let i" in g.get_code("js", CodeOptions(opt_level=2))
+
+def test_loop_counters_resolve():
+    g = sum_loop(3)
+    assert "ERROR" not in g.get_code("c")
+
+def test_module_variables_assigned_by_calls_stay_in_loops():
+    m = Module("clobber")
+    m.var("acc", "int")
+    bump = m.define("bump", ("k", "int"))
+    bump.stmt(Set(bump.parse_expr("acc"), bump.parse_expr("acc + k")))
+    f = m.define("f", ("x", "int"))
+    f.set("s", "0")
+    f.loop("i", 100, ExprStmt(Funcall("bump", [f.parse_expr("x")])), Set(f.parse_expr("s"), f.parse_expr("s + acc * x")))
+    f.ret("s")
+    code = m.get_code("c", CodeOptions(opt_level=2))
+    assert "licm" not in code and "s = s + acc * x;" in code
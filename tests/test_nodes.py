@@ -98,3 +98,249 @@ def test_write_code_to_already_open_writer():
 void f() {
 }
 """.strip()
+
+def test_nodes_are_slotted():
+    from alang.exprs import Binop
+    b = Binop("x", "+", 1)
+    assert not hasattr(b, "__dict__")
+    assert [a.name for a in b.node_attrs] == ["operator"]
+    assert list(b.node_rels.keys()) == ["left", "right"]
+    try:
+        b.not_an_attribute = 1
+        assert False
+    except AttributeError:
+        pass
+
+def test_link_relations():
+    f = Function("f", None, "x", "y")
+    assert [p.name for p in f.get_rels("parameters")] == ["x", "y"]
+    assert f.get_rel("parameters").name == "x"
+    assert f.get_rels("statements") == ()
+    assert f.get_rel("return_type") is None
+    f.return_type = float_type
+    assert f.return_type is float_type
+    assert [rel for rel, _ in f.links] == ["parameters", "parameters", "return_type"]
+    # Links keep the order they were made in
+    f.param("z")
+    assert [(rel, getattr(c, "name", None)) for rel, c in f.links] == [("parameters", "x"), ("parameters", "y"), ("return_type", "float"), ("parameters", "z")]
+    # Reads can't change the relation
+    params = f.parameters
+    assert isinstance(params, tuple)
+    f.parameters = params[:1]
+    assert [p.name for p in params] == ["x", "y", "z"] and [p.name for p in f.parameters] == ["x"]
+    assert [rel for rel, _ in f.links] == ["return_type", "parameters"]
+
+def test_replace_link():
+    from alang.exprs import Binop, Name
+    b = Binop("x", "+", "y")
+    old_left = b.left
+    b.left = Name("z")
+    assert b.left.name == "z"
+    assert old_left.last_backlink is None
+    assert b.left.last_backlink is b
+    assert [(rel, c.name) for rel, c in b.links] == [("right", "y"), ("left", "z")]
+
+def test_visitor_dispatch_table():
+    from alang.nodes import DepthFirstVisitor, DepthFirstWalker, NodeType
+    class CountNames(DepthFirstWalker):
+        def __init__(self):
+            super().__init__()
+            self.names = []
+        def visit_name(self, node, parent, rel, acc):
+            assert acc is None
+            self.names.append(node.name)
+    assert CountNames.visit_table[NodeType.NAME] is CountNames.visit_name
+    assert CountNames.visit_table[NodeType.BINOP] is DepthFirstVisitor.visit_binop
+    f = Function("f", None, "x").set("y", "2*x + z").ret("y")
+    v = CountNames()
+    v.visit(f, None, None)
+    assert v.names == ["x", "z", "y"]
+
+def test_writer_dispatch_table():
+    from alang.langs.wgsl import WGSLWriter
+    from alang.nodes import NodeType
+    assert WGSLWriter.node_writers[NodeType.BINOP] is WGSLWriter.write_binop
+    out = StringIO()
+    w = WGSLWriter(out, None, None)
+    try:
+        w.write_node(float_type)
+        assert False
+    except ValueError:
+        pass
+
+def test_deep_expression_traversal():
+    from alang.compiler import Compiler, CodeOptions
+    from alang.exprs import Binop, Name
+    from alang.nodes import NodeType
+    expr = Name("x")
+    for i in range(4999):
+        expr = Binop(expr, "+", Name("x"))
+    f = Function("f", "float", ("x", "float")).ret(expr)
+    assert len(f.find_reachable_with_type(NodeType.BINOP)) == 4999
+    c = Compiler(f, CodeOptions())
+    c.compile()
+    assert c.diags.num_errors == 0
+    assert f.statements[0].value.resolved_type.is_float
+
+def test_nested_traversals():
+    from alang.nodes import DepthFirstWalker, NodeType
+    class NestedFinder(DepthFirstWalker):
+        def __init__(self):
+            super().__init__()
+            self.counts = []
+        def visit_binop(self, node, parent, rel, acc):
+            self.counts.append(len(node.find_reachable_with_type(NodeType.NAME)))
+    f = Function("f", None, "x").set("y", "(x + z) * x")
+    v = NestedFinder()
+    v.visit(f, None, None)
+    assert v.counts == [2, 3]
+    assert len(f.find_reachable_with_type(NodeType.NAME)) == 3
+
+def test_reachability_index():
+    from alang.nodes import NodeType, ReachabilityIndex
+    from alang.stmts import Return
+    m = Module("reach")
+    f = m.define("f", "x").ret("x")
+    assert m.find_reachable_with_type(NodeType.FUNCTION) == [f]
+    assert f.find_reachable_with_type(NodeType.RETURN) == [f.statements[0]]
+    g = m.define("g", "y").ret("y + 1")
+    assert m.find_reachable_with_type(NodeType.FUNCTION) == [f, g]
+    assert len(m.find_reachable_with_type(NodeType.RETURN)) == 2
+    f.statements = [Return(f.parse_expr("x * 2")), Return(f.parse_expr("x"))]
+    assert f.find_reachable_with_type(NodeType.RETURN) == list(f.statements)
+    assert len(m.find_reachable_with_type(NodeType.RETURN)) == 3
+    assert len(m.find_reachable_with_type(NodeType.BINOP)) == 2
+    m.functions = [g]
+    assert m.find_reachable_with_type(NodeType.FUNCTION) == [g]
+    assert len(m.find_reachable_with_type(NodeType.RETURN)) == 1
+    fresh = ReachabilityIndex(m)
+    for t in [NodeType.NAME, NodeType.CONSTANT, NodeType.PARAMETER, NodeType.BINOP]:
+        assert m.find_reachable_with_type(t) == fresh.find(t)
+    # Only trees under an index or compile state pay for tracking edits
+    other = Module("other")
+    h = other.define("h", "x").ret("x")
+    assert not h.statements[0]._tracked
+    m.functions = [g, h]
+    assert h.statements[0].value._tracked and len(m.find_reachable_with_type(NodeType.RETURN)) == 2
+
+def test_symbol_tables():
+    from alang.compiler import Compiler, CodeOptions
+    from alang.nodes import Scope
+    m = Module("symbols")
+    for i in range(1000):
+        m.var(f"g{i}", "float")
+    s = m.struct("Point", ("x", "float"))
+    f = m.define("f", ("g7", "int")).ret("g7 + g8")
+    assert m.lookup_variable("g999").name == "g999"
+    assert f.lookup_variable("g5") is m.variables[5]
+    assert f.lookup_type("Point") is s
+    scope = Scope(f, Scope(m, None))
+    assert scope.lookup("g7") is f.parameters[0]
+    assert scope.lookup("g8") is m.variables[8]
+    assert scope.lookup("f") is f
+    m.variables = m.variables[:10]
+    assert m.lookup_variable("g999") is None
+    assert m.lookup_variable("g9") is m.variables[9]
+    c = Compiler(m, CodeOptions())
+    c.compile()
+    b = f.statements[0].value
+    assert b.left.resolved_node is f.parameters[0]
+    assert b.right.resolved_node is m.variables[8]
+
+def test_fingerprints():
+    from alang.compiler import SupportDefinitions
+    def build(name):
+        m = Module(name)
+        m.var("g", "float")
+        m.define("f", ("x", "float")).set("y", "2*x + g").ret("y")
+        return m
+    a = build("m")
+    b = build("m")
+    assert a.id != b.id
+    assert a.fingerprint() == b.fingerprint()
+    assert a.structurally_equals(b)
+    assert not a.structurally_equals(build("n"))
+    fp = a.fingerprint()
+    a.functions[0].statements[0].value.name = "z"
+    assert a.fingerprint() != fp
+    a.functions[0].statements[0].value.name = "y"
+    assert a.fingerprint() == fp
+    b.functions[0].ret("g")
+    assert b.fingerprint() != fp
+    defs = SupportDefinitions()
+    defs.add("a", [a.functions[0]])
+    defs.add("b", [build("m").functions[0]])
+    assert defs.get("b") is defs.get("a")
+    assert defs.num_changes == 1
+
+def test_snapshots():
+    from concurrent.futures import ThreadPoolExecutor
+    from alang.nodes import Snapshot
+    from alang.typs import int_type
+    m = Module("snap")
+    f = m.define("f", ("x", "float")).ret("x * 2")
+    g = m.define("g", ("y", "float")).ret("y")
+    base = Snapshot(m)
+    a = base.clone()
+    assert a.root is m
+    pa = a.edit(f.parameters[0])
+    pa.parameter_type = int_type
+    assert a.root is not m and base.root is m
+    assert f.parameters[0].parameter_type.name == "float"
+    fa, ga = a.root.functions
+    assert fa is not f and ga is g
+    assert fa.statements[0] is f.statements[0]
+    assert fa.parameters[0] is pa
+    b = a.clone()
+    pb = b.edit(pa)
+    assert pb is not pa
+    pb.name = "z"
+    assert pa.name == "x"
+    assert a.edit(pa) is not pa
+    with ThreadPoolExecutor(2) as pool:
+        base_code, a_code = pool.map(lambda s: s.get_code("c"), [base, a])
+    assert "float f(float x)" in base_code
+    assert "int32_t f(int32_t x)" in a_code
+    # Writing again reuses the compiled copy until the snapshot changes
+    tree = a.materialize()
+    assert a.get_code("c") == a_code and a.materialize() is tree
+    a.edit(fa.statements[0].value.right).value = 3
+    assert a.materialize() is not tree and "x * 3" in a.get_code("c")
+    assert f.resolved_type is None and f.return_type is None
+    m2 = Module("snap")
+    m2.define("f", ("x", "float")).ret("x * 2")
+    m2.define("g", ("y", "float")).ret("y")
+    assert m.structurally_equals(m2)
+
+def test_memory_returns_to_baseline():
+    import gc
+    import tracemalloc
+    from alang.nodes import code_cache, define, get_current_module
+    from alang.typs import float_type
+    def compile_once(i):
+        with Module(f"scratch{i}") as m:
+            assert get_current_module() is m
+            define("f", ("x", "float")).ret(f"x * {i} + 1.5")
+            m.get_code("c")
+    num_global_functions = len(global_module.functions)
+    compile_once(0)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        # The code cache keeps up to max_size outputs, so fill it first
+        for i in range(code_cache.max_size):
+            compile_once(i)
+        gc.collect()
+        baseline, _ = tracemalloc.get_traced_memory()
+        for i in range(300):
+            compile_once(code_cache.max_size + i)
+        gc.collect()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # Each further output would keep about 800 bytes if the cache weren't bounded
+    assert len(code_cache.entries) <= code_cache.max_size
+    assert current - baseline < 32 * 1024
+    assert get_current_module() is global_module
+    assert len(global_module.functions) == num_global_functions
+    assert float_type.last_backlink is None
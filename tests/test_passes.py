@@ -0,0 +1,54 @@
+from alang.compiler import Compiler, Pass, PassManager
+from alang.nodes import CodeOptions, Module, NodeType
+
+class DoubleConstants(Pass):
+    name = "double_constants"
+    requires = ("resolve",)
+    opt_level = 1
+    changes_tree = True
+    def run(self, compiler: Compiler) -> bool:
+        constants = compiler.ast.find_reachable_with_type(NodeType.CONSTANT)
+        for c in constants:
+            c.value = c.value * 2
+        return len(constants) > 0
+
+class Named(Pass):
+    def __init__(self, name: str, requires: tuple[str, ...] = (), opt_level: int = 0):
+        self.name = name
+        self.requires = requires
+        self.opt_level = opt_level
+
+def build_module() -> Module:
+    m = Module("passes")
+    m.define("f", ("x", "int")).ret("x * 21")
+    return m
+
+def test_custom_pass_runs_at_its_level():
+    m = build_module()
+    assert "x * 21" in m.get_code("c", CodeOptions(passes=(DoubleConstants(),)))
+    code = m.get_code("c", CodeOptions(opt_level=1, passes=(DoubleConstants(),)))
+    assert "x * 42" in code
+    # The caller's tree is not changed
+    assert m.functions[0].statements[0].value.right.value == 21
+
+def test_pipeline_orders_by_requirements():
+    pm = PassManager([Named("c", ("b",)), Named("a"), Named("b", ("a",)), Named("o2", ("a",), opt_level=2)])
+    assert [p.name for p in pm.get_pipeline(0)] == ["a", "b", "c"]
+    assert [p.name for p in pm.get_pipeline(2)] == ["a", "b", "c", "o2"]
+    pm = PassManager([Named("a"), Named("b", ("a",)), Named("c", ("b",))])
+    pm.add(Named("first"), before="a")
+    pm.add(Named("after_b", ("b",)), after="b")
+    assert [p.name for p in pm.get_pipeline(0)] == ["first", "a", "b", "after_b", "c"]
+
+def test_missing_requirement_is_an_error():
+    pm = PassManager([Named("a", ("missing",))])
+    try:
+        pm.get_pipeline(0)
+        assert False
+    except ValueError:
+        pass
+    try:
+        CodeOptions(opt_level=4)
+        assert False
+    except ValueError:
+        pass
@@ -0,0 +1,66 @@
+from alang.compiler import Compiler
+from alang.exprs import Binop, Constant, Index, Name
+from alang.nodes import CodeOptions, define
+from alang.opt import RangeAnalysis, ValueRange, get_index_type
+from alang.serialize import dumps, loads
+from alang.stmts import Let, Loop, Set
+from alang.typs import byte_type, float_type, int_type, sbyte_type, short_type, tensor_type, ushort_type
+
+def test_expression_ranges():
+    i = Name("i")
+    x = Name("x")
+    row = Binop(Binop(i, "*", 8), "+", 3)
+    Loop("i", 4, Let("row", row), Set(x, Binop(Name("row"), "%", 5)), Set(x, Binop(i, "<<", 2)), Set(x, Binop(i, "*", x)))
+    ranges = RangeAnalysis()
+    assert ranges.get_range(i) == ValueRange(0, 3)
+    assert ranges.get_range(row) == ValueRange(3, 27)
+    stmts = row.last_backlink.last_backlink.statements
+    assert ranges.get_range(stmts[1].value) == ValueRange(0, 4)
+    assert ranges.get_range(stmts[2].value) == ValueRange(0, 12)
+    # Nothing is known about x
+    assert ranges.get_range(stmts[3].value) is None
+    assert ranges.get_range(Binop(Constant(1 << 20), "*", Constant(1 << 20))) is None
+
+def test_index_types():
+    assert get_index_type(ValueRange(0, 200)) is byte_type
+    assert get_index_type(ValueRange(-5, 5)) is sbyte_type
+    assert get_index_type(ValueRange(0, 1000)) is ushort_type
+    assert get_index_type(ValueRange(-1000, 1000)) is short_type
+    assert get_index_type(ValueRange(0, 1 << 20)) is int_type
+    assert get_index_type(None) is int_type
+
+def scale(n: int):
+    t = tensor_type((8,), float_type)
+    f = define("scale").param("a", t).param("x", "int")
+    f.loop("i", n, Set(Index("a", "i"), Index("a", "x") * 2.0))
+    return f
+
+def test_proven_indices_are_unchecked():
+    f = scale(8)
+    code = f.get_code("c", CodeOptions(opt_level=2))
+    assert "a[i] = a[x] * 2.0;" in code
+    assert "a[i|0] = (a[x] * 2.0);" in f.get_code("js", CodeOptions(opt_level=2))
+    assert "a[i] = a[x] * 2.0;" in f.get_code("glsl", CodeOptions(opt_level=2))
+    assert "a[i] = a[x] * 2.0;" in f.get_code("c", CodeOptions(opt_level=1))
+    c = Compiler(f, CodeOptions(opt_level=2))
+    c.compile()
+    assert c.stats.get_pass("bounds").counts == {"in_bounds": 1, "unproven": 1}
+    # The marks survive serialization
+    ast = loads(dumps(c.ast))
+    assert sorted(n.in_bounds for n in ast.find_reachable_with_type("index")) == [False, True]
+
+def test_low_precedence_indices_are_grouped():
+    t = tensor_type((8,), float_type)
+    f = define("halves").param("a", t)
+    i = lambda: Name("i")
+    f.loop("i", 16, Set(Index("a", Binop(i(), ">>", 1)), Index("a", Binop(i(), "&", 7)) * 2.0), Set(Index("a", Binop(i(), "<", 4)), Constant(1.0)))
+    c = Compiler(f, CodeOptions(opt_level=2))
+    c.compile()
+    assert c.stats.get_pass("bounds").counts["in_bounds"] >= 2
+    code = f.get_code("c", CodeOptions(opt_level=2))
+    assert "a[i >> 1] = a[i & 7] * 2.0;" in code and "a[i < 4] = 1.0;" in code
+    assert "a[i >> 1] = a[i & 7] * 2.0;" in f.get_code("metal", CodeOptions(opt_level=2))
+
+def test_out_of_bounds_loops_are_checked():
+    f = scale(9)
+    assert "a[i] = a[x] * 2.0;" in f.get_code("c", CodeOptions(opt_level=2))
@@ -0,0 +1,50 @@
+import io
+
+from alang.compiler import Compiler
+from alang.nodes import CodeOptions, Module, Node
+from alang.serialize import load_class
+from alang.typs import float_type, tensor_type
+
+def build_module() -> Module:
+    m = Module("lib")
+    m.var("scale", "float")
+    at = tensor_type((2, 3), float_type)
+    bt = tensor_type((3, 2), float_type)
+    m.define("mm").param("a", at).param("b", bt).ret("a @ b")
+    m.define("a_rather_long_function_name", ("x", "float")).set("y", "x * scale + 1").ret("y * y - 0.5")
+    return m
+
+def test_node_round_trip():
+    m = build_module()
+    data = m.to_bytes()
+    m2 = Node.from_bytes(data)
+    assert m2 is not m
+    assert m2.fingerprint() == m.fingerprint()
+    assert m2.get_code("c") == build_module().get_code("c")
+    assert m2.lookup_variable("scale") is m2.variables[0]
+    assert m2.functions[1].parameters[0].parameter_type is float_type
+    assert data.count(b"a_rather_long_function_name") == 1
+
+def test_compiled_round_trip():
+    options = CodeOptions(auto_entry_points=True)
+    m = build_module()
+    c = Compiler(m, options)
+    c.compile()
+    c2 = Compiler.from_bytes(c.to_bytes(), options)
+    assert len(c2.support_definitions) == len(c.support_definitions)
+    assert c2.entry_points[0][1] == "compute"
+    f = c2.ast.functions[1]
+    assert f.return_type is float_type
+    name = f.statements[0].value.left.left
+    assert name.resolved_node is f.variables[0]
+    out = io.StringIO()
+    c2.write_code(out, "wgsl")
+    assert out.getvalue() == build_module().get_code("wgsl", options)
+
+def test_only_alang_classes_load():
+    assert load_class("alang.funcs:Function").__name__ == "Function"
+    try:
+        load_class("os:system")
+        assert False
+    except ValueError:
+        pass
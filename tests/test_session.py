@@ -0,0 +1,66 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+from alang.langs.writer import get_emit_start_method
+from alang.nodes import CodeOptions, CompileSession, Module, get_current_session
+from alang.typs import tensor_type, float_type
+
+def build_matmul_module(i: int) -> Module:
+    m = Module(f"m{i}")
+    at = tensor_type((2, 3 + i % 3), float_type)
+    bt = tensor_type((3 + i % 3, 2), float_type)
+    m.define("mm").param("a", at).param("b", bt).ret("a @ b")
+    m.define(f"scale{i}", ("x", "float")).ret(f"x * {i}")
+    return m
+
+def compile_all(i: int) -> list[str]:
+    m = build_matmul_module(i)
+    return [m.get_code(lang, CodeOptions(auto_entry_points=True)) for lang in ["c", "wgsl", "js"]]
+
+def test_write_code_does_not_change_options():
+    options = CodeOptions(auto_entry_points=True)
+    build_matmul_module(0).get_code("wgsl", options)
+    assert not hasattr(options, "entry_points")
+
+def test_sessions_allocate_distinct_ids():
+    with CompileSession() as a:
+        assert get_current_session() is a
+        a_ids = [Module("a").id for _ in range(10)]
+        with CompileSession() as b:
+            b_ids = [Module("b").id for _ in range(10)]
+        assert get_current_session() is a
+    assert len(set(a_ids) | set(b_ids)) == 20
+
+def test_repeated_writes_are_identical():
+    m = build_matmul_module(1)
+    assert m.get_code("wgsl") == m.get_code("wgsl")
+
+def test_parallel_compiles_match_serial():
+    num_modules = 12
+    serial = [compile_all(i) for i in range(num_modules)]
+    with ThreadPoolExecutor(8) as pool:
+        for _ in range(3):
+            parallel = list(pool.map(compile_all, range(num_modules)))
+            assert parallel == serial
+
+def test_parallel_emission_matches_serial():
+    m = Module("big")
+    for i in range(70):
+        at = tensor_type((2, 3 + i % 3), float_type)
+        bt = tensor_type((3 + i % 3, 2), float_type)
+        m.define(f"mm{i}").param("a", at).param("b", bt).ret("a @ b")
+        m.define(f"scale{i}", ("x", "float")).ret(f"x * {i}")
+    for lang in ["wgsl", "c", "js"]:
+        serial = m.get_code(lang, CodeOptions(auto_entry_points=True))
+        parallel = m.get_code(lang, CodeOptions(auto_entry_points=True, emit_workers=2))
+        assert parallel == serial
+    # Other threads are running, so the module is written serially
+    done = threading.Event()
+    t = threading.Thread(target=done.wait)
+    t.start()
+    try:
+        assert get_emit_start_method() is None
+        assert m.get_code("c", CodeOptions(auto_entry_points=True, emit_workers=2)) == m.get_code("c", CodeOptions(auto_entry_points=True))
+    finally:
+        done.set()
+        t.join()
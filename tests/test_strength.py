@@ -0,0 +1,64 @@
+from alang.compiler import Compiler
+from alang.exprs import Funcall, Index
+from alang.nodes import CodeOptions, Module, define
+from alang.opt import count_instructions
+from alang.stmts import ExprStmt, Loop, Set
+from alang.typs import float_type, tensor_type
+
+def elementwise(shape: tuple[int, ...]):
+    t = tensor_type(shape, float_type)
+    names = ["i", "j", "k", "l"][:len(shape)]
+    f = define("add").param("a", t).param("b", t).param("o", t)
+    idx = lambda: t.get_flat_index(names)
+    body = Set(Index("o", idx()), Index("a", idx()) + Index("b", idx()))
+    for name, n in reversed(list(zip(names[1:], shape[1:]))):
+        body = Loop(name, n, body)
+    f.loop(names[0], shape[0], body)
+    return f
+
+def count_compiled_instructions(f, without_sr: bool) -> int:
+    c = Compiler(f, CodeOptions(opt_level=2))
+    if without_sr:
+        c.pass_manager.remove("sr")
+    c.compile()
+    return count_instructions(c.ast)
+
+def test_rank3_offsets_are_induction_variables():
+    f = elementwise((3, 5, 7))
+    c = Compiler(f, CodeOptions(opt_level=2))
+    c.compile()
+    assert c.stats.get_pass("sr").counts == {"induction_variables": 3, "shifts": 0}
+    code = f.get_code("wgsl", CodeOptions(opt_level=2))
+    assert "iv2 = 0;" in code and "iv1 = iv2;" in code and "iv0 = iv1;" in code
+    assert "iv0 = (iv0 + 1);" in code and "iv1 = (iv1 + 7);" in code and "iv2 = (iv2 + 35);" in code
+    assert "o[iv0] = (a[iv0] + b[iv0]);" in code
+    assert "int32_t iv0;" in f.get_code("c", CodeOptions(opt_level=2))
+    assert "(i * 5)" in f.get_code("wgsl", CodeOptions(opt_level=1))
+
+def test_fewer_operations():
+    for shape in [(3, 5, 7), (2, 3, 4, 5)]:
+        f = elementwise(shape)
+        assert count_compiled_instructions(f, False) < count_compiled_instructions(f, True)
+    code = elementwise((2, 3, 4, 5)).get_code("js", CodeOptions(opt_level=2))
+    assert "iv3 = (iv3 + 60);" in code
+    assert " * " not in code
+
+def test_powers_of_two_are_shifts():
+    t = tensor_type((4, 8), float_type)
+    g = define("g").param("a", t).param("x", "int").ret(Index("a", "x * 4 + 1"))
+    assert "return a[(x << 2) + 1];" in g.get_code("c", CodeOptions(opt_level=2))
+    assert "return a[x * 4 + 1];" in g.get_code("c", CodeOptions(opt_level=1))
+
+def test_module_variables_assigned_by_calls_are_not_frozen():
+    m = Module("clobber")
+    m.var("acc", "int")
+    bump = m.define("bump", ("k", "int"))
+    bump.stmt(Set(bump.parse_expr("acc"), bump.parse_expr("acc + k")))
+    t = tensor_type((64,), float_type)
+    f = m.define("f").param("a", t).param("x", "int")
+    f.loop("i", 8, ExprStmt(Funcall("bump", [f.parse_expr("x")])), Set(Index("a", "i * 3 + acc"), f.parse_expr("1.0")))
+    code = m.get_code("c", CodeOptions(opt_level=2))
+    assert "iv0" not in code and "a[i * 3 + acc] = 1.0;" in code
+    # Without the call the offset is an induction variable
+    f.statements[0].statements = [f.statements[0].statements[1]]
+    assert "iv0 = acc;" in m.get_code("c", CodeOptions(opt_level=2))
@@ -14,3 +14,23 @@ def test_infer_const_return_type():
     c = Compiler(f, CodeOptions())
     c.compile()
     assert f.return_type.name == "int"
+
+def test_long_return_type_chain():
+    from alang.compiler import Diagnostics, TypeInference, iter_post_order
+    from alang.exprs import Funcall
+    from alang.nodes import Module
+    # Each function returns the next one's result so every link needs the one after it
+    m = Module("chain")
+    n = 300
+    for i in range(n - 1):
+        m.define(f"f{i}", ("x", "float")).ret(Funcall(f"f{i + 1}", ["x"]))
+    m.define(f"f{n - 1}", ("x", "float")).ret("x * 2.0")
+    c = Compiler(m, CodeOptions())
+    c.resolve_names()
+    inference = TypeInference(Diagnostics())
+    nodes = list(iter_post_order(m))
+    inference.run(nodes)
+    assert all(f.return_type.name == "float" for f in m.functions)
+    assert inference.num_visits < 2 * len(nodes)
+    c.compile()
+    assert len(c.diags.messages) == 0